@@ -0,0 +1,5 @@
+"""
+elasticindex のベンチマーク
+
+python -m benchmarks で実行する。詳しくは __main__.py を参照。
+"""
@@ -0,0 +1,127 @@
+"""
+ネットワーク無しで動くベンチマーク
+
+$ python -m benchmarks
+$ python -m benchmarks --hits 5000 --doc-size 2000 --output bench.json
+$ python -m benchmarks --only search paginator
+
+実際の ES のレスポンスを記録して、それを再生することもできる
+$ python -m benchmarks --record recordings.json --host 127.0.0.1:9200
+$ python -m benchmarks --replay recordings.json
+
+結果は JSON で出力する。
+"""
+
+import argparse
+import json
+import platform
+import sys
+from os.path import abspath, dirname
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument(
+        '--docs', type=int, default=10000, help='rebuild_index の件数'
+    )
+    parser.add_argument(
+        '--hits', type=int, default=1000, help='1回の検索で返す件数'
+    )
+    parser.add_argument(
+        '--doc-size', type=int, default=200, help='ドキュメントの文字数'
+    )
+    parser.add_argument('--bulk-size', type=int, default=1000)
+    parser.add_argument(
+        '--iterations',
+        type=int,
+        default=10000,
+        help='軽いベンチマークの繰り返し回数 (重いものはこの 1/100)',
+    )
+    parser.add_argument(
+        '--serializer', default=None, help='ELASTICINDEX_SERIALIZER'
+    )
+    parser.add_argument(
+        '--only', nargs='*', default=None, help='実行するベンチマーク名'
+    )
+    parser.add_argument('--output', default=None, help='結果の JSON の出力先')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--record', default=None, help='レスポンスの記録先')
+    group.add_argument('--replay', default=None, help='再生する記録ファイル')
+    parser.add_argument(
+        '--host', default='127.0.0.1:9200', help='--record 時の ES'
+    )
+    return parser.parse_args(argv)
+
+
+def setup_django(options):
+    from runtests import SETTINGS
+
+    connection_class = 'benchmarks.transport.SyntheticConnection'
+    if options.record:
+        connection_class = 'benchmarks.transport.RecordingConnection'
+    elif options.replay:
+        connection_class = 'benchmarks.transport.ReplayConnection'
+
+    host, _, port = options.host.partition(':')
+    benchmark_settings = dict(
+        SETTINGS,
+        ELASTICINDEX_HOSTS=[{'host': host, 'port': int(port or 9200)}],
+        ELASTICINDEX_CONNECTION_CLASS=connection_class,
+        ELASTICINDEX_SERIALIZER=options.serializer,
+    )
+    settings.configure(**benchmark_settings)
+    django.setup()
+
+    from django.core.management import call_command
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def main(argv=None):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    setup_django(options)
+
+    import elasticsearch
+
+    from . import suite
+    from .transport import (
+        RecordingConnection,
+        ReplayConnection,
+        SyntheticConnection,
+    )
+
+    SyntheticConnection.hit_count = options.hits
+    SyntheticConnection.doc_size = options.doc_size
+    SyntheticConnection.total = max(options.docs, options.hits)
+    if options.replay:
+        ReplayConnection.load(options.replay)
+
+    results = suite.run(options, names=options.only)
+    if options.record:
+        RecordingConnection.save(options.record)
+
+    output = {
+        'environment': {
+            'python': platform.python_version(),
+            'elasticsearch_py': elasticsearch.__versionstr__,
+            'serializer': options.serializer or 'json',
+            'transport': settings.ELASTICINDEX_CONNECTION_CLASS,
+        },
+        'options': vars(options),
+        'results': [r.as_dict() for r in results],
+    }
+    text = json.dumps(output, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""
+ベンチマーク本体
+
+どれも tests.models の DummyModel / DummyESDocument を使い、
+ES との通信は settings.ELASTICINDEX_CONNECTION_CLASS の Connection が受ける。
+"""
+
+import time
+from collections import OrderedDict
+
+from django.core.paginator import Paginator
+from elasticsearch.exceptions import ImproperlyConfigured
+
+from elasticindex.instrumentation import collect
+from elasticindex.serializers import dumps_bulk_body, get_serializer
+from tests.models import DummyESDocument, DummyModel
+
+
+class BenchmarkResult(object):
+    def __init__(self, name, iterations, seconds, **extra):
+        self.name = name
+        self.iterations = iterations
+        self.seconds = seconds
+        self.extra = extra
+
+    def as_dict(self):
+        d = OrderedDict(
+            [
+                ('name', self.name),
+                ('iterations', self.iterations),
+                ('seconds', self.seconds),
+                (
+                    'ops_per_sec',
+                    self.iterations / self.seconds if self.seconds else None,
+                ),
+            ]
+        )
+        d.update(self.extra)
+        return d
+
+
+def _timeit(func, iterations):
+    start = time.perf_counter()
+    for _i in range(iterations):
+        func()
+    return time.perf_counter() - start
+
+
+def _make_hits(count, doc_size):
+    return [
+        {
+            '_id': 'doc-{}'.format(i),
+            '_score': 1.0,
+            '_source': {'key': 'doc-{}'.format(i), 'value': 'x' * doc_size},
+        }
+        for i in range(count)
+    ]
+
+
+def bench_rebuild_index(options):
+    docs = options.docs
+    if DummyModel.objects.count() != docs:
+        DummyModel.objects.all().delete()
+        DummyModel.objects.bulk_create(
+            DummyModel(key='doc-{}'.format(i), value='x' * options.doc_size)
+            for i in range(docs)
+        )
+    with collect() as collector:
+        start = time.perf_counter()
+        stats = DummyESDocument.rebuild_index(bulk_size=options.bulk_size)
+        seconds = time.perf_counter() - start
+    request_bytes = collector.summary()['request_bytes']
+    return BenchmarkResult(
+        'rebuild_index',
+        docs,
+        seconds,
+        docs_per_sec=docs / seconds,
+        bytes_per_sec=request_bytes / seconds,
+        request_bytes=request_bytes,
+        bulk_requests=collector.count,
+        phases=stats.phases,
+        bulk_p50_ms=stats.latency_percentile(50),
+        bulk_p99_ms=stats.latency_percentile(99),
+    )
+
+
+def bench_queryset_chain(options):
+    qs = DummyESDocument.objects.all()
+
+    def _chain():
+        o = qs.query({"term": {"key": "doc-1"}})
+        o.order_by({"key": "desc"}).limit(20).offset(40)
+
+    iterations = options.iterations
+    return BenchmarkResult(
+        'queryset_chain', iterations, _timeit(_chain, iterations)
+    )
+
+
+def bench_queryset_clone(options):
+    qs = DummyESDocument.objects.query(
+        {
+            "bool": {
+                "must": [{"match": {"value": "x"}}],
+                "filter": [{"terms": {"key": ['doc-1', 'doc-2', 'doc-3']}}],
+            }
+        }
+    ).order_by([{"key": "desc"}])
+    iterations = options.iterations
+    return BenchmarkResult(
+        'queryset_clone', iterations, _timeit(qs._clone, iterations)
+    )
+
+
+def bench_hit_hydration(options):
+    hits = _make_hits(1000, options.doc_size)
+
+    def _hydrate():
+        for hit in hits:
+            DummyESDocument(hit)
+
+    iterations = max(options.iterations // 100, 1)
+    seconds = _timeit(_hydrate, iterations)
+    return BenchmarkResult(
+        'hit_hydration_1k',
+        iterations,
+        seconds,
+        ms_per_1k_hits=seconds * 1000 / iterations,
+    )
+
+
+def bench_search(options):
+    """
+    レスポンスのデコードとハイドレーションを含めた検索
+    """
+    qs = DummyESDocument.objects.query({"match": {"value": "x"}}).limit(
+        options.hits
+    )
+
+    def _search():
+        list(qs.all())
+
+    iterations = max(options.iterations // 100, 1)
+    with collect() as collector:
+        seconds = _timeit(_search, iterations)
+    return BenchmarkResult(
+        'search',
+        iterations,
+        seconds,
+        hits=options.hits,
+        ms_per_1k_hits=seconds * 1000 / iterations / options.hits * 1000,
+        response_bytes=collector.summary()['response_bytes'],
+    )
+
+
+def bench_paginator(options):
+    qs = DummyESDocument.objects.query({"match": {"value": "x"}}).order_by(
+        {"key": "asc"}
+    )
+    pages = 10
+
+    def _paginate():
+        paginator = Paginator(qs.all(), 20)
+        for page_number in range(1, min(pages, paginator.num_pages) + 1):
+            list(paginator.page(page_number).object_list)
+
+    iterations = max(options.iterations // 100, 1)
+    with collect() as collector:
+        seconds = _timeit(_paginate, iterations)
+    return BenchmarkResult(
+        'paginator',
+        iterations,
+        seconds,
+        pages=pages,
+        requests=collector.count,
+    )
+
+
+def bench_bulk_serialization(options):
+    bulk_body = []
+    for hit in _make_hits(options.bulk_size, options.doc_size):
+        bulk_body.append({'index': {'_id': hit['_id']}})
+        bulk_body.append(hit['_source'])
+
+    iterations = max(options.iterations // 100, 1)
+    results = []
+    for name in ('json', 'orjson', 'ujson'):
+        try:
+            serializer = get_serializer(name)
+        except ImproperlyConfigured:
+            # orjson / ujson が入っていない
+            continue
+        seconds = _timeit(
+            lambda s=serializer: dumps_bulk_body(s, bulk_body), iterations
+        )
+        results.append(
+            BenchmarkResult(
+                'bulk_serialization[{}]'.format(name),
+                iterations,
+                seconds,
+                docs=options.bulk_size,
+                docs_per_sec=options.bulk_size * iterations / seconds,
+            )
+        )
+    return results
+
+
+BENCHMARKS = OrderedDict(
+    [
+        ('rebuild_index', bench_rebuild_index),
+        ('queryset_chain', bench_queryset_chain),
+        ('queryset_clone', bench_queryset_clone),
+        ('hit_hydration', bench_hit_hydration),
+        ('search', bench_search),
+        ('paginator', bench_paginator),
+        ('bulk_serialization', bench_bulk_serialization),
+    ]
+)
+
+
+def run(options, names=None):
+    """
+    :rtype: list of BenchmarkResult
+    """
+    results = []
+    for name, func in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        result = func(options)
+        if isinstance(result, list):
+            results.extend(result)
+        else:
+            results.append(result)
+    return results
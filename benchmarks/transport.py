@@ -0,0 +1,195 @@
+"""
+ネットワークを使わずに ES のレスポンスを返す Connection
+
+SyntheticConnection: 件数・ドキュメントサイズを指定してレスポンスを合成する
+RecordingConnection: 実際の ES へのリクエストとレスポンスを記録する
+ReplayConnection: 記録したレスポンスを再生する (無いものは合成)
+
+settings.ELASTICINDEX_CONNECTION_CLASS にドットパスを指定して使う。
+"""
+
+import json
+from collections import defaultdict, deque
+
+from elasticindex.instrumentation import InstrumentedUrllib3HttpConnection
+from elasticindex.memory import (
+    INFO_RESPONSE,
+    LocalConnection,
+    loads_body,
+    split_path,
+)
+
+
+class SyntheticConnection(LocalConnection):
+    """
+    ES のレスポンスを合成して返す Connection
+
+    検索結果は hit_count 件 (size が小さければ size 件) で、
+    各ドキュメントの value は doc_size 文字になる。
+    合成したレスポンスはキャッシュするので、サーバ側の処理時間はほぼ0。
+    """
+
+    # 1回の検索で返す最大件数
+    hit_count = 1000
+    # _source の value の文字数
+    doc_size = 200
+    # count や hits.total で返す件数
+    total = 10000
+
+    _search_cache = {}
+
+    def respond(self, method, url, params, body):
+        """
+        :return: (ステータスコード, レスポンスの JSON 文字列)
+        """
+        parts = split_path(url)
+        if not parts:
+            return 200, json.dumps(INFO_RESPONSE)
+        if parts[-1] == '_bulk':
+            return 200, self.respond_bulk(body)
+        if parts[-1] == '_search':
+            return 200, self.respond_search(parts[0], loads_body(body))
+        if parts[-1] == '_count':
+            return 200, json.dumps({'count': self.total})
+        if len(parts) == 1:
+            # インデックスの作成・削除・存在確認
+            return 200, json.dumps({'acknowledged': True, 'index': parts[0]})
+        if len(parts) >= 2 and parts[1] in ('_doc', '_create', '_update'):
+            return 200, self.respond_doc(method, parts)
+        return 404, json.dumps({'error': 'unknown path {}'.format(url)})
+
+    def make_source(self, i):
+        return {'key': 'doc-{}'.format(i), 'value': 'x' * self.doc_size}
+
+    def respond_search(self, index, body):
+        size = min(body.get('size', 10), self.hit_count)
+        offset = body.get('from', 0)
+        size = max(min(size, self.total - offset), 0)
+        cache_key = (index, size, offset, self.doc_size, self.total)
+        if cache_key not in self._search_cache:
+            hits = [
+                {
+                    '_index': index,
+                    '_type': '_doc',
+                    '_id': 'doc-{}'.format(i),
+                    '_score': 1.0,
+                    '_source': self.make_source(i),
+                }
+                for i in range(offset, offset + size)
+            ]
+            self._search_cache[cache_key] = json.dumps(
+                {
+                    'took': 1,
+                    'timed_out': False,
+                    '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                    'hits': {
+                        'total': {'value': self.total, 'relation': 'eq'},
+                        'max_score': 1.0,
+                        'hits': hits,
+                    },
+                }
+            )
+        return self._search_cache[cache_key]
+
+    def respond_bulk(self, body):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        lines = body.splitlines()
+        items = []
+        i = 0
+        while i < len(lines):
+            action = json.loads(lines[i])
+            op_type = next(iter(action))
+            meta = action[op_type]
+            items.append(
+                {
+                    op_type: {
+                        '_id': meta.get('_id'),
+                        'status': 200 if op_type == 'delete' else 201,
+                        'result': 'created',
+                    }
+                }
+            )
+            i += 1 if op_type == 'delete' else 2
+        return json.dumps({'took': 1, 'errors': False, 'items': items})
+
+    def respond_doc(self, method, parts):
+        index = parts[0]
+        doc_id = parts[2] if len(parts) > 2 else 'generated'
+        if method == 'GET':
+            return json.dumps(
+                {
+                    '_index': index,
+                    '_id': doc_id,
+                    '_score': None,
+                    'found': True,
+                    '_source': self.make_source(0),
+                }
+            )
+        result = 'deleted' if method == 'DELETE' else 'created'
+        return json.dumps({'_index': index, '_id': doc_id, 'result': result})
+
+
+class RecordingConnection(InstrumentedUrllib3HttpConnection):
+    """
+    実際の ES に接続し、レスポンスを records に溜める
+    """
+
+    records = []
+
+    def perform_request(
+        self,
+        method,
+        url,
+        params=None,
+        body=None,
+        timeout=None,
+        ignore=(),
+        headers=None,
+    ):
+        status, response_headers, raw = super().perform_request(
+            method,
+            url,
+            params=params,
+            body=body,
+            timeout=timeout,
+            ignore=ignore,
+            headers=headers,
+        )
+        self.records.append(
+            {'method': method, 'url': url, 'status': status, 'body': raw}
+        )
+        return status, response_headers, raw
+
+    @classmethod
+    def save(cls, path):
+        with open(path, 'w') as f:
+            json.dump(cls.records, f)
+
+
+class ReplayConnection(SyntheticConnection):
+    """
+    RecordingConnection で記録したレスポンスを返す
+    同じメソッド・パスのレスポンスが複数あれば順番に返し、一巡したら最初に戻る。
+    記録に無いリクエストは SyntheticConnection と同じく合成する。
+    """
+
+    recordings = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            records = json.load(f)
+        recordings = defaultdict(deque)
+        for record in records:
+            key = (record['method'], record['url'].split('?', 1)[0])
+            recordings[key].append((record['status'], record['body']))
+        cls.recordings = dict(recordings)
+
+    def respond(self, method, url, params, body):
+        responses = self.recordings.get((method, url.split('?', 1)[0]))
+        if not responses:
+            return super().respond(method, url, params, body)
+        response = responses[0]
+        responses.rotate(-1)
+        return response
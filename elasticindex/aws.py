@@ -0,0 +1,504 @@
+"""
+Amazon ES / OpenSearch Serverless に IAM (SigV4) 署名付きで接続する
+
+クレデンシャルは次の順に探す (CredentialsChain)
+    1. settings.ELASTICINDEX_AWS_IAM の access_id / secret_key
+    2. 環境変数 AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+    3. STS AssumeRoleWithWebIdentity
+       (AWS_WEB_IDENTITY_TOKEN_FILE と AWS_ROLE_ARN。EKS の IRSA など)
+    4. ECS タスクロール (AWS_CONTAINER_CREDENTIALS_*_URI)
+    5. EC2 インスタンスロール (IMDSv2)
+
+有効期限のあるクレデンシャルはキャッシュし、期限の REFRESH_MARGIN 秒前に
+取り直す。署名は AWSSigV4Connection が urllib3 のコネクションプール上で行う。
+"""
+
+import datetime
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+from urllib.parse import quote, urlencode
+
+import urllib3
+from django.core.exceptions import ImproperlyConfigured
+
+from .instrumentation import InstrumentedUrllib3HttpConnection
+
+logger = logging.getLogger('elasticindex')
+
+# 有効期限のこの秒数前になったらクレデンシャルを取り直す
+REFRESH_MARGIN = 300
+
+# メタデータエンドポイント (ECS / EC2) への接続タイムアウト
+METADATA_TIMEOUT = 1.0
+
+ECS_METADATA_HOST = 'http://169.254.170.2'
+EC2_METADATA_HOST = 'http://169.254.169.254'
+
+
+class Credentials(object):
+    """
+    :param expiration: 有効期限 (aware な datetime)。無期限なら None
+    """
+
+    def __init__(self, access_key, secret_key, token=None, expiration=None):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.token = token
+        self.expiration = expiration
+
+    def __repr__(self):
+        return '<Credentials: {} expiration={}>'.format(
+            self.access_key, self.expiration
+        )
+
+    def expires_within(self, seconds):
+        if self.expiration is None:
+            return False
+        remaining = self.expiration - _now()
+        return remaining.total_seconds() < seconds
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _parse_expiration(value):
+    """
+    ISO8601 の文字列 ('2026-10-19T12:00:00Z') または epoch 秒
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _credentials_from_json(data):
+    """
+    ECS / EC2 メタデータ、STS の Credentials の形式
+    """
+    return Credentials(
+        data['AccessKeyId'],
+        data['SecretAccessKey'],
+        data.get('Token') or data.get('SessionToken'),
+        _parse_expiration(data.get('Expiration')),
+    )
+
+
+_http = None
+
+
+def _get_http():
+    """
+    クレデンシャル取得用の PoolManager (プロセスで1つ)
+    """
+    global _http
+    if _http is None:
+        _http = urllib3.PoolManager(
+            timeout=urllib3.Timeout(
+                connect=METADATA_TIMEOUT, read=METADATA_TIMEOUT * 5
+            ),
+            retries=urllib3.Retry(total=2, backoff_factor=0.1),
+        )
+    return _http
+
+
+def _request_json(method, url, headers=None):
+    response = _get_http().request(method, url, headers=headers)
+    if response.status != 200:
+        raise ValueError(
+            '{} {} returned {}'.format(method, url, response.status)
+        )
+    return json.loads(response.data.decode('utf-8'))
+
+
+# ---- providers
+# どれも、クレデンシャルが得られれば Credentials を、
+# その方法が使えない環境なら None を返す
+
+
+class SettingsProvider(object):
+    name = 'settings'
+
+    def __init__(self, iam):
+        self.iam = iam
+
+    def load(self):
+        if not self.iam.get('access_id'):
+            return None
+        return Credentials(
+            self.iam['access_id'],
+            self.iam['secret_key'],
+            self.iam.get('session_token'),
+        )
+
+
+class EnvironmentProvider(object):
+    name = 'environment'
+
+    def load(self):
+        access_key = os.environ.get('AWS_ACCESS_KEY_ID')
+        secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
+        if not access_key or not secret_key:
+            return None
+        return Credentials(
+            access_key,
+            secret_key,
+            os.environ.get('AWS_SESSION_TOKEN'),
+            _parse_expiration(os.environ.get('AWS_CREDENTIAL_EXPIRATION')),
+        )
+
+
+class WebIdentityProvider(object):
+    name = 'web-identity'
+
+    def __init__(self, region):
+        self.region = region
+
+    def load(self):
+        token_file = os.environ.get('AWS_WEB_IDENTITY_TOKEN_FILE')
+        role_arn = os.environ.get('AWS_ROLE_ARN')
+        if not token_file or not role_arn:
+            return None
+        with open(token_file) as f:
+            token = f.read().strip()
+        params = {
+            'Action': 'AssumeRoleWithWebIdentity',
+            'Version': '2011-06-15',
+            'RoleArn': role_arn,
+            'RoleSessionName': os.environ.get(
+                'AWS_ROLE_SESSION_NAME', 'django-elasticindex'
+            ),
+            'WebIdentityToken': token,
+        }
+        url = 'https://sts.{}.amazonaws.com/?{}'.format(
+            self.region, urlencode(params)
+        )
+        data = _request_json('GET', url, {'Accept': 'application/json'})
+        result = data['AssumeRoleWithWebIdentityResponse'][
+            'AssumeRoleWithWebIdentityResult'
+        ]
+        return _credentials_from_json(result['Credentials'])
+
+
+class ContainerProvider(object):
+    name = 'container'
+
+    def load(self):
+        relative_uri = os.environ.get('AWS_CONTAINER_CREDENTIALS_RELATIVE_URI')
+        full_uri = os.environ.get('AWS_CONTAINER_CREDENTIALS_FULL_URI')
+        if relative_uri:
+            url = ECS_METADATA_HOST + relative_uri
+        elif full_uri:
+            url = full_uri
+        else:
+            return None
+        headers = {}
+        token = os.environ.get('AWS_CONTAINER_AUTHORIZATION_TOKEN')
+        token_file = os.environ.get('AWS_CONTAINER_AUTHORIZATION_TOKEN_FILE')
+        if token_file:
+            with open(token_file) as f:
+                token = f.read().strip()
+        if token:
+            headers['Authorization'] = token
+        return _credentials_from_json(_request_json('GET', url, headers))
+
+
+class InstanceMetadataProvider(object):
+    name = 'instance'
+
+    def load(self):
+        if os.environ.get('AWS_EC2_METADATA_DISABLED', '').lower() == 'true':
+            return None
+        http = _get_http()
+        try:
+            response = http.request(
+                'PUT',
+                EC2_METADATA_HOST + '/latest/api/token',
+                headers={'X-aws-ec2-metadata-token-ttl-seconds': '21600'},
+                retries=False,
+            )
+        except urllib3.exceptions.HTTPError:
+            # EC2 の外
+            return None
+        if response.status != 200:
+            return None
+        headers = {'X-aws-ec2-metadata-token': response.data.decode('ascii')}
+        base = (
+            EC2_METADATA_HOST + '/latest/meta-data/iam/security-credentials/'
+        )
+        response = http.request('GET', base, headers=headers)
+        if response.status != 200:
+            # インスタンスにロールが付いていない
+            return None
+        role = response.data.decode('utf-8').splitlines()[0].strip()
+        return _credentials_from_json(
+            _request_json('GET', base + role, headers)
+        )
+
+
+class CredentialsChain(object):
+    """
+    providers を順に試して、最初に得られたクレデンシャルを使う。
+    得たクレデンシャルはキャッシュし、期限が近づいたら取り直す。
+    スレッドセーフ。
+    """
+
+    def __init__(self, providers, refresh_margin=REFRESH_MARGIN):
+        self.providers = providers
+        self.refresh_margin = refresh_margin
+        self._credentials = None
+        self._lock = threading.Lock()
+
+    def get_credentials(self):
+        credentials = self._credentials
+        if credentials is not None and not credentials.expires_within(
+            self.refresh_margin
+        ):
+            return credentials
+        with self._lock:
+            # 他のスレッドが先に取り直しているかもしれない
+            credentials = self._credentials
+            if credentials is None or credentials.expires_within(
+                self.refresh_margin
+            ):
+                self._credentials = self._refresh(credentials)
+            return self._credentials
+
+    def _refresh(self, current):
+        try:
+            return self._load()
+        except Exception:
+            if current is not None and not current.expires_within(0):
+                # 取り直しに失敗しても、期限内なら今のものを使い続ける
+                logger.warning(
+                    'Failed to refresh AWS credentials.', exc_info=True
+                )
+                return current
+            raise
+
+    def _load(self):
+        for provider in self.providers:
+            credentials = provider.load()
+            if credentials is not None:
+                logger.debug(
+                    'AWS credentials loaded from {}.'.format(provider.name)
+                )
+                return credentials
+        raise ImproperlyConfigured('AWS credentials are not found.')
+
+
+def get_default_providers(iam, region):
+    return [
+        SettingsProvider(iam),
+        EnvironmentProvider(),
+        WebIdentityProvider(region),
+        ContainerProvider(),
+        InstanceMetadataProvider(),
+    ]
+
+
+# ---- SigV4
+
+_signing_key_cache = {}
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _get_signing_key(secret_key, date_stamp, region, service):
+    """
+    署名キーは日付単位で変わるので、それまでは使い回す
+    """
+    cache_key = (secret_key, date_stamp, region, service)
+    signing_key = _signing_key_cache.get(cache_key)
+    if signing_key is None:
+        if len(_signing_key_cache) > 100:
+            _signing_key_cache.clear()
+        k_date = _hmac(('AWS4' + secret_key).encode('utf-8'), date_stamp)
+        k_region = _hmac(k_date, region)
+        k_service = _hmac(k_region, service)
+        signing_key = _hmac(k_service, 'aws4_request')
+        _signing_key_cache[cache_key] = signing_key
+    return signing_key
+
+
+def _quote(value):
+    # elasticsearch-py はクエリパラメータの値を bytes にしている
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return quote(str(value), safe='-_.~')
+
+
+def sign_request(
+    credentials,
+    region,
+    service,
+    method,
+    host,
+    path,
+    params=None,
+    body=None,
+    now=None,
+    content_sha256_header=True,
+):
+    """
+    SigV4 の署名ヘッダを作る
+    :param host: Host ヘッダの値 (デフォルト以外のポートなら host:port)
+    :param path: URL エンコード済みのパス
+    :param body: bytes (圧縮するなら圧縮後)
+    :param content_sha256_header: x-amz-content-sha256 を付ける
+        (aoss では必須)
+    :return: リクエストに追加するヘッダ (host は含まない)
+    """
+    now = now or _now()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date_stamp = amz_date[:8]
+    payload_hash = hashlib.sha256(body or b'').hexdigest()
+
+    headers = {'host': host, 'x-amz-date': amz_date}
+    if content_sha256_header:
+        headers['x-amz-content-sha256'] = payload_hash
+    if credentials.token:
+        headers['x-amz-security-token'] = credentials.token
+    header_names = sorted(headers)
+    signed_headers = ';'.join(header_names)
+    canonical_headers = ''.join(
+        '{}:{}\n'.format(name, headers[name].strip()) for name in header_names
+    )
+    canonical_query = '&'.join(
+        '{}={}'.format(_quote(k), _quote(v))
+        for k, v in sorted((params or {}).items())
+    )
+    canonical_request = '\n'.join(
+        [
+            method,
+            # パスはエンコード済みのものをもう一度エンコードする
+            quote(path or '/', safe='/-_.~'),
+            canonical_query,
+            canonical_headers,
+            signed_headers,
+            payload_hash,
+        ]
+    )
+    scope = '{}/{}/{}/aws4_request'.format(date_stamp, region, service)
+    string_to_sign = '\n'.join(
+        [
+            'AWS4-HMAC-SHA256',
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+        ]
+    )
+    signing_key = _get_signing_key(
+        credentials.secret_key, date_stamp, region, service
+    )
+    signature = hmac.new(
+        signing_key, string_to_sign.encode('utf-8'), hashlib.sha256
+    ).hexdigest()
+    headers['authorization'] = (
+        'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, '
+        'Signature={}'.format(
+            credentials.access_key, scope, signed_headers, signature
+        )
+    )
+    del headers['host']
+    return headers
+
+
+class AWSSigV4Connection(InstrumentedUrllib3HttpConnection):
+    """
+    リクエストごとに SigV4 署名をする urllib3 の Connection
+
+    Elasticsearch(..., connection_class=AWSSigV4Connection,
+                  aws_credentials=chain, aws_region='ap-northeast-1',
+                  aws_service='es')
+
+    http_compress の場合、署名は圧縮後のボディに対して行う必要があるので、
+    圧縮は親クラスではなくここで行う。
+    """
+
+    def __init__(
+        self,
+        *args,
+        aws_credentials=None,
+        aws_region=None,
+        aws_service='es',
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.aws_credentials = aws_credentials
+        self.aws_region = aws_region
+        self.aws_service = aws_service
+        self._compress_body = self.http_compress
+        self.http_compress = False
+        default_port = 443 if self.use_ssl else 80
+        if self.port in (None, default_port):
+            self.host_header = self.hostname
+        else:
+            self.host_header = '{}:{}'.format(self.hostname, self.port)
+
+    def _sign(self, method, url, params, body, headers):
+        headers = dict(headers or {})
+        if body and self._compress_body:
+            body = gzip.compress(body)
+            headers['content-encoding'] = 'gzip'
+        headers.update(
+            sign_request(
+                self.aws_credentials.get_credentials(),
+                self.aws_region,
+                self.aws_service,
+                method,
+                self.host_header,
+                self.url_prefix + url,
+                params=params,
+                body=body,
+            )
+        )
+        return body, headers
+
+    def perform_request(
+        self,
+        method,
+        url,
+        params=None,
+        body=None,
+        timeout=None,
+        ignore=(),
+        headers=None,
+    ):
+        body, headers = self._sign(method, url, params, body, headers)
+        return super().perform_request(
+            method,
+            url,
+            params=params,
+            body=body,
+            timeout=timeout,
+            ignore=ignore,
+            headers=headers,
+        )
+
+    def perform_request_stream(
+        self,
+        method,
+        url,
+        params=None,
+        body=None,
+        headers=None,
+        chunk_size=65536,
+    ):
+        body, headers = self._sign(method, url, params, body, headers)
+        return super().perform_request_stream(
+            method,
+            url,
+            params=params,
+            body=body,
+            headers=headers,
+            chunk_size=chunk_size,
+        )
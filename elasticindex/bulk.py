@@ -0,0 +1,230 @@
+"""
+バッファリングしてまとめて bulk 送信するライター
+
+    with MyDocument.bulk_writer(max_docs=1000) as w:
+        for obj in MyModel.objects.all():
+            w.index(obj)
+    w.errors  # 失敗したアイテム
+
+件数・バイト数のどちらかが閾値を超えるか、flush_interval 秒経つと
+バックグラウンドのスレッドが client.bulk を送る。
+with を抜けるときに残りを送り切る (with を使わない場合は close() を呼ぶ)。
+"""
+
+import logging
+import queue
+import threading
+
+from .client import WRITE
+from .instrumentation import instrument
+from .serializers import dumps_bytes
+
+logger = logging.getLogger('elasticindex')
+
+
+class BulkWriter(object):
+    """
+    :param document_cls: ElasticDocument のサブクラス
+    :param max_docs: この件数が溜まったら送る
+    :param max_bytes: シリアライズ後のサイズ (UTF-8 のバイト数) がこれを超えたら送る
+    :param flush_interval: この秒数ごとに、溜まっている分を送る
+    :param kwargs: client.bulk にそのまま渡す (refresh など)
+    """
+
+    def __init__(
+        self,
+        document_cls,
+        max_docs=1000,
+        max_bytes=5000000,
+        flush_interval=2.0,
+        timeout=None,
+        **kwargs,
+    ):
+        self.document_cls = document_cls
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.kwargs = kwargs
+        self.client = document_cls.get_es_client(timeout=timeout, role=WRITE)
+        self.serializer = self.client.transport.serializer
+
+        # bulk で失敗したアイテム (レスポンスの items の要素) や例外
+        self.errors = []
+        self.sent_docs = 0
+
+        self._lock = threading.Lock()
+        # flush_interval による送信中に flush() が先に戻らないようにする
+        self._send_lock = threading.Lock()
+        self._lines = []
+        self._docs = 0
+        self._bytes = 0
+        # 送信待ちのバッチ。1つ送信中に1つまで溜める (それ以上は待たせる)
+        self._batches = queue.Queue(maxsize=1)
+        self._thread = None
+        self._closed = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """
+        送信スレッドを起動する
+        with を使わない場合も、最初の書き込みか flush() で起動する
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name='elasticindex-bulk-writer',
+                    daemon=True,
+                )
+                self._thread.start()
+
+    # ---- actions
+
+    def index(self, source_model):
+        """
+        Django モデルインスタンスからドキュメントを作って index する
+        """
+        cls = self.document_cls
+        self.index_dict(
+            cls.get_id_of_source_model(source_model),
+            cls.data_dict_for_index(source_model),
+            routing=cls.get_routing_of_source_model(source_model),
+        )
+
+    def index_dict(self, doc_id, data_dict, routing=None):
+        cls = self.document_cls
+        meta = cls.bulk_action_meta(
+            doc_id, routing=routing, index=cls.get_index_for_write(data_dict)
+        )
+        self._add({'index': meta}, data_dict)
+
+    def update(
+        self, doc_id, doc, doc_as_upsert=False, routing=None, index=None
+    ):
+        """
+        部分更新。doc_as_upsert=True なら、無ければ作る
+        :param index: 時間で分割したインデックスで、doc に PARTITION_FIELD が
+            無い場合は、ドキュメントのあるパーティションを指定する
+        """
+        cls = self.document_cls
+        body = {'doc': doc}
+        if doc_as_upsert:
+            body['doc_as_upsert'] = True
+        if index is None and cls.PARTITION_FIELD in doc:
+            index = cls.get_index_for_write(doc)
+        meta = cls.bulk_action_meta(doc_id, routing=routing, index=index)
+        self._add({'update': meta}, body)
+
+    def delete(self, doc_id, routing=None, index=None):
+        """
+        :param index: 時間で分割したインデックスの場合は、
+            ドキュメントのあるパーティション
+        """
+        meta = self.document_cls.bulk_action_meta(
+            doc_id, routing=routing, index=index
+        )
+        self._add({'delete': meta})
+
+    def _add(self, action, source=None):
+        if self._closed:
+            raise RuntimeError('BulkWriter is already closed.')
+        self.start()
+        # 送信スレッドでまとめてシリアライズするより、
+        # ここでシリアライズしたほうがサイズを正確に数えられる。
+        # 日本語は1文字3バイトになるので、文字数ではなく bytes にして数える
+        lines = [dumps_bytes(self.serializer, action)]
+        if source is not None:
+            lines.append(dumps_bytes(self.serializer, source))
+        size = sum(len(line) + 1 for line in lines)
+
+        batch = None
+        with self._lock:
+            self._lines.extend(lines)
+            self._docs += 1
+            self._bytes += size
+            if self._docs >= self.max_docs or self._bytes >= self.max_bytes:
+                batch = self._take_batch()
+        if batch:
+            self._batches.put(batch)
+
+    def _take_batch(self):
+        """
+        ロックを取った状態で呼ぶ
+        """
+        if not self._lines:
+            return None
+        batch = (self._lines, self._docs)
+        self._lines = []
+        self._docs = 0
+        self._bytes = 0
+        return batch
+
+    # ---- flush
+
+    def flush(self):
+        """
+        溜まっている分を送り、送信が終わるまで待つ
+        """
+        self.start()
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self._batches.put(batch)
+        self._batches.join()
+        with self._send_lock:
+            pass
+
+    def close(self):
+        """
+        残りを送り切って、送信スレッドを止める
+        """
+        if self._closed:
+            return
+        self.start()
+        self.flush()
+        self._closed = True
+        self._batches.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                batch = self._batches.get(timeout=self.flush_interval)
+            except queue.Empty:
+                with self._send_lock:
+                    with self._lock:
+                        batch = self._take_batch()
+                    if batch:
+                        self._send(*batch)
+                continue
+            try:
+                if batch is None:
+                    return
+                self._send(*batch)
+            finally:
+                self._batches.task_done()
+
+    def _send(self, lines, docs):
+        body = b'\n'.join(lines) + b'\n'
+        index = self.document_cls.INDEX
+        logger.debug('bulk writer: sending {} docs.'.format(docs))
+        try:
+            with instrument('bulk', index) as event:
+                result = self.client.bulk(body, index=index, **self.kwargs)
+                event.set_result(result)
+        except Exception as e:
+            logger.exception('bulk writer: bulk request failed.')
+            self.errors.append({'exception': e, 'docs': docs})
+            return
+        self.sent_docs += docs
+        if result.get('errors'):
+            for item in result['items']:
+                (op_result,) = item.values()
+                if 'error' in op_result:
+                    self.errors.append(item)
@@ -1,54 +1,190 @@
 """
 settings に ELASTICINDEX_AWS_IAM があれば、
-IAM クレデンシャルで Amazon ES への接続を行う
+IAM クレデンシャル (SigV4 署名) で Amazon ES への接続を行う (elasticindex.aws)
+
+settings.ELASTICINDEX_BACKEND が 'memory' なら、ES の代わりに
+プロセス内のメモリ上のストア (elasticindex.memory) を使う
+
+settings.ELASTICINDEX_READ_HOSTS / ELASTICINDEX_WRITE_HOSTS があれば、
+検索系 (role='read') と書き込み系 (role='write') で接続先を分ける。
+無ければ ELASTICINDEX_HOSTS を使う。
+
+settings.ELASTICINDEX_SERIALIZER でJSONシリアライザを、
+settings.ELASTICINDEX_HTTP_COMPRESS でリクエストボディの gzip 圧縮を指定できる。
 """
 
+import json
+import os
+import threading
+
 import elasticsearch
 from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .instrumentation import InstrumentedUrllib3HttpConnection
+from .serializers import get_serializer
 
 DEFAULT_TIMEOUT = 10
 
+# get_es_client の role
+READ = 'read'
+WRITE = 'write'
+
+# settings.ELASTICINDEX_SERIALIZER の値ごとのシリアライザインスタンス
+_serializer_cache = {}
+
+
+def _get_serializer():
+    """
+    settings.ELASTICINDEX_SERIALIZER に応じたシリアライザ。
+    インスタンスはプロセス内で使い回す。
+    """
+    name = getattr(settings, 'ELASTICINDEX_SERIALIZER', None)
+    if name not in _serializer_cache:
+        _serializer_cache[name] = get_serializer(name)
+    return _serializer_cache[name]
+
 
-def get_es_client(*, timeout=None):
+def _get_client_kwargs(*, timeout=None):
     """
+    get_es_client と _get_es_client_aws で共通の Elasticsearch の引数
+    """
+    return {
+        'timeout': timeout or DEFAULT_TIMEOUT,
+        'serializer': _get_serializer(),
+        # bulk や search のリクエストボディを gzip 圧縮する
+        'http_compress': bool(
+            getattr(settings, 'ELASTICINDEX_HTTP_COMPRESS', False)
+        ),
+    }
+
+
+def _get_connection_class():
+    """
+    settings.ELASTICINDEX_CONNECTION_CLASS (ドットパス) があればそれを使う。
+    ベンチマーク用の記録/再生 Connection などを差し込むため。
+    """
+    path = getattr(settings, 'ELASTICINDEX_CONNECTION_CLASS', None)
+    if path:
+        return import_string(path)
+    return InstrumentedUrllib3HttpConnection
+
+
+def get_hosts(role=None):
+    """
+    role に応じた接続先
+    :param role: READ, WRITE または None
+    """
+    hosts = None
+    if role == READ:
+        hosts = getattr(settings, 'ELASTICINDEX_READ_HOSTS', None)
+    elif role == WRITE:
+        hosts = getattr(settings, 'ELASTICINDEX_WRITE_HOSTS', None)
+    return hosts or settings.ELASTICINDEX_HOSTS
+
+
+def get_es_client(*, timeout=None, role=None, hosts=None):
+    """
+    :param role: READ (検索) か WRITE (書き込み・インデックス操作)
+    :param hosts: 指定すると role より優先する
     :return: Elasticsearch
     :rtype: Elasticsearch
     """
+    if getattr(settings, 'ELASTICINDEX_BACKEND', None) == 'memory':
+        return _get_es_client_memory(timeout=timeout)
+    hosts = hosts or get_hosts(role)
     if getattr(settings, 'ELASTICINDEX_AWS_IAM', None):
-        return _get_es_client_aws(timeout=timeout)
+        return _get_es_client_aws(timeout=timeout, hosts=hosts)
     return elasticsearch.Elasticsearch(
-        settings.ELASTICINDEX_HOSTS, timeout=timeout or DEFAULT_TIMEOUT
+        hosts,
+        connection_class=_get_connection_class(),
+        **_get_client_kwargs(timeout=timeout),
     )
 
 
-def _get_es_client_aws(*, timeout=None):
+# AWS 用の Elasticsearch クライアント (接続先などの組み合わせごと)
+# コネクションプールとクレデンシャルのキャッシュをプロセス内で共有する
+_aws_clients = {}
+_aws_lock = threading.Lock()
+
+
+def _get_aws_service_name(iam, hosts):
+    if iam.get('service'):
+        return iam['service']
+    # OpenSearch Serverless の場合
+    if hosts and hosts[0].get('host', '').endswith('.aoss.amazonaws.com'):
+        return 'aoss'
+    return 'es'
+
+
+def _get_es_client_aws(*, timeout=None, hosts=None):
     """
-    IAM を使って、Amazon ES にアクセスする場合
+    IAM を使って、Amazon ES (OpenSearch Serverless) にアクセスする場合
+    クライアントは使い回すので、呼び出しごとの接続・署名器の作成は無い。
     :rtype: Elasticsearch
     """
-    from requests_aws4auth import AWS4Auth
+    from .aws import AWSSigV4Connection
 
     iam = settings.ELASTICINDEX_AWS_IAM
-
-    service_name = 'es'
-    if settings.ELASTICINDEX_HOSTS:
-        # OpenSearch Serverless の場合
-        if (
-            settings.ELASTICINDEX_HOSTS[0]
-            .get('host', '')
-            .endswith('.aoss.amazonaws.com')
-        ):
-            service_name = 'aoss'
-
-    awsauth = AWS4Auth(
-        iam['access_id'], iam['secret_key'], iam['region'], service_name
+    hosts = hosts or settings.ELASTICINDEX_HOSTS
+    kwargs = _get_client_kwargs(timeout=timeout)
+    cache_key = (
+        json.dumps(iam, sort_keys=True, default=str),
+        json.dumps(hosts, sort_keys=True, default=str),
+        kwargs['timeout'],
+        kwargs['http_compress'],
+        id(kwargs['serializer']),
     )
+    client = _aws_clients.get(cache_key)
+    if client is not None:
+        return client
+
+    with _aws_lock:
+        client = _aws_clients.get(cache_key)
+        if client is None:
+            region = iam.get('region') or os.environ.get('AWS_REGION')
+            client = elasticsearch.Elasticsearch(
+                hosts=hosts,
+                use_ssl=True,
+                verify_certs=True,
+                connection_class=AWSSigV4Connection,
+                aws_credentials=_get_aws_credentials(iam, region),
+                aws_region=region,
+                aws_service=_get_aws_service_name(iam, hosts),
+                **kwargs,
+            )
+            _aws_clients[cache_key] = client
+    return client
+
+
+# settings.ELASTICINDEX_AWS_IAM ごとの CredentialsChain
+_aws_credentials = {}
+
+
+def _get_aws_credentials(iam, region):
+    """
+    ロックを取った状態で呼ぶ
+    """
+    from .aws import CredentialsChain, get_default_providers
+
+    key = json.dumps(iam, sort_keys=True, default=str)
+    if key not in _aws_credentials:
+        _aws_credentials[key] = CredentialsChain(
+            get_default_providers(iam, region)
+        )
+    return _aws_credentials[key]
+
+
+def _get_es_client_memory(*, timeout=None):
+    """
+    ES の代わりに、プロセス内のメモリ上のストアを使う場合
+    (settings.ELASTICINDEX_BACKEND = 'memory')
+    :rtype: Elasticsearch
+    """
+    from .memory import MemoryConnection
 
     return elasticsearch.Elasticsearch(
-        hosts=settings.ELASTICINDEX_HOSTS,
-        http_auth=awsauth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=elasticsearch.connection.RequestsHttpConnection,
-        timeout=timeout or DEFAULT_TIMEOUT,
+        hosts=[{'host': 'memory'}],
+        connection_class=MemoryConnection,
+        **_get_client_kwargs(timeout=timeout),
     )
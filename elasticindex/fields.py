@@ -1,3 +1,6 @@
+from django.core.exceptions import ImproperlyConfigured
+
+
 class ElasticDocumentField(object):
     """
     ElasticDocument用のField
@@ -53,3 +56,60 @@ class ElasticDocumentField(object):
 
     def has_default_value(self):
         return self.default is not self.NotProvided
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImproperlyConfigured('DenseVectorField requires numpy.')
+    return numpy
+
+
+class DenseVectorField(ElasticDocumentField):
+    """
+    埋め込みベクトル用の Field (dense_vector)
+    embedding = DenseVectorField(dims=384) みたいに使う。
+
+    インデックス時は NumPy の配列 (float32) のまま渡し、シリアライザに変換させる。
+    ELASTICINDEX_SERIALIZER = 'orjson' なら Python のリストを経由せずに
+    JSON にする。検索結果の値は NumPy の配列になる。
+
+    :param dims: 次元数
+    :param similarity: 'cosine', 'dot_product', 'l2_norm' など
+    :param index: False なら kNN 検索用のインデックスを作らない
+    :param dtype: 検索結果を NumPy の配列にするときの型
+    """
+
+    def __init__(
+        self,
+        dims,
+        similarity='cosine',
+        index=True,
+        dtype='float32',
+        mapping=None,
+        **kwargs,
+    ):
+        vector_mapping = {
+            "type": "dense_vector",
+            "dims": dims,
+            "index": index,
+        }
+        if index:
+            vector_mapping["similarity"] = similarity
+        vector_mapping.update(mapping or {})
+        super().__init__(mapping=vector_mapping, **kwargs)
+        self.dims = dims
+        self.dtype = dtype
+
+    def get_value_for_index_of_source_model(self, source_model):
+        value = super().get_value_for_index_of_source_model(source_model)
+        if value is None:
+            return None
+        # orjson は C 連続の配列しか直接シリアライズできない
+        return _numpy().ascontiguousarray(value, dtype=self.dtype)
+
+    def get_value_from_index_source_value(self, index_source_value):
+        if index_source_value is None:
+            return None
+        return _numpy().asarray(index_source_value, dtype=self.dtype)
@@ -0,0 +1,392 @@
+"""
+Elasticsearch への呼び出しの計測
+
+ES を呼ぶたびに QueryEvent を1つ作り、以下に流す。
+  - Django シグナル query_executed (sender は QueryEvent のクラス)
+  - settings.ELASTICINDEX_QUERY_CALLBACKS に書いた関数 (ドットパスのリスト)
+    statsd や OpenTelemetry への送信はここで行う想定
+  - collect() で有効にした QueryCollector (リクエスト単位の集計)
+  - logger 'elasticindex' の DEBUG ログ
+
+リクエスト/レスポンスのバイト数は、Connection クラス側
+(InstrumentedUrllib3HttpConnection など) で記録する。
+
+Connection には perform_request_stream (レスポンスボディをチャンクで読む)
+も付けている。elasticindex.streaming で使う。
+"""
+
+import contextvars
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+from elasticsearch.connection import (
+    RequestsHttpConnection,
+    Urllib3HttpConnection,
+)
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('elasticindex')
+
+# ES 呼び出しが終わるたびに送られる。 kwargs: event
+query_executed = Signal()
+
+# 実行中の QueryEvent (Connection からバイト数を書き込むため)
+_current_event = contextvars.ContextVar(
+    'elasticindex_current_event', default=None
+)
+# 有効な QueryCollector のタプル (ネスト可)
+_active_collectors = contextvars.ContextVar(
+    'elasticindex_active_collectors', default=()
+)
+
+_callbacks_cache = {}
+
+
+class QueryEvent(object):
+    """
+    ES 呼び出し1回分の計測結果
+
+    :param operation: 'search', 'count', 'get', 'bulk', 'index',
+        'indices.create' など
+    :param index: 対象のインデックス名
+    """
+
+    def __init__(self, operation, index, body=None):
+        self.operation = operation
+        self.index = index
+        self.body = body
+        # 実測時間 (秒)
+        self.elapsed = None
+        # ES が返した took (ミリ秒)
+        self.took = None
+        # 返ってきたヒット数 (count の場合は件数)
+        self.hits = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.error = False
+        self.exception = None
+
+    @property
+    def elapsed_ms(self):
+        if self.elapsed is None:
+            return None
+        return self.elapsed * 1000
+
+    def set_result(self, result):
+        """
+        ES のレスポンスから took / hits を拾う
+        """
+        if not isinstance(result, dict):
+            return
+        self.took = result.get('took')
+        if 'hits' in result:
+            self.hits = len(result['hits'].get('hits', ()))
+        elif 'count' in result:
+            self.hits = result['count']
+        elif 'items' in result:
+            self.hits = len(result['items'])
+            if result.get('errors'):
+                self.error = True
+
+    def as_dict(self):
+        return OrderedDict(
+            [
+                ('operation', self.operation),
+                ('index', self.index),
+                ('elapsed_ms', self.elapsed_ms),
+                ('took', self.took),
+                ('hits', self.hits),
+                ('request_bytes', self.request_bytes),
+                ('response_bytes', self.response_bytes),
+                ('error', self.error),
+            ]
+        )
+
+    def __repr__(self):
+        return '<QueryEvent {} {} {:.1f}ms>'.format(
+            self.operation, self.index, self.elapsed_ms or 0
+        )
+
+
+class QueryCollector(object):
+    """
+    QueryEvent を溜めて集計する。
+    ミドルウェアや debug-toolbar のパネルから使う。
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, event):
+        self.events.append(event)
+
+    @property
+    def count(self):
+        return len(self.events)
+
+    @property
+    def total_time(self):
+        """
+        ES 呼び出しにかかった実測時間の合計 (秒)
+        """
+        return sum(e.elapsed or 0 for e in self.events)
+
+    def summary(self):
+        """
+        :rtype: dict
+        """
+        by_operation = OrderedDict()
+        for event in self.events:
+            stat = by_operation.setdefault(
+                event.operation,
+                {'count': 0, 'time_ms': 0.0, 'took': 0, 'errors': 0},
+            )
+            stat['count'] += 1
+            stat['time_ms'] += event.elapsed_ms or 0
+            stat['took'] += event.took or 0
+            stat['errors'] += int(event.error)
+        return {
+            'count': self.count,
+            'time_ms': self.total_time * 1000,
+            'request_bytes': sum(e.request_bytes for e in self.events),
+            'response_bytes': sum(e.response_bytes for e in self.events),
+            'errors': sum(int(e.error) for e in self.events),
+            'by_operation': by_operation,
+        }
+
+
+@contextmanager
+def collect(collector=None):
+    """
+    with 内の ES 呼び出しを QueryCollector に集める
+
+        with collect() as collector:
+            ...
+        collector.summary()
+    """
+    collector = collector or QueryCollector()
+    token = _active_collectors.set(_active_collectors.get() + (collector,))
+    try:
+        yield collector
+    finally:
+        _active_collectors.reset(token)
+
+
+def _get_callbacks():
+    names = tuple(getattr(settings, 'ELASTICINDEX_QUERY_CALLBACKS', ()))
+    if names not in _callbacks_cache:
+        _callbacks_cache[names] = [import_string(name) for name in names]
+    return _callbacks_cache[names]
+
+
+def emit(event):
+    """
+    計測済みの QueryEvent を各所に流す
+    """
+    for collector in _active_collectors.get():
+        collector.add(event)
+    for callback in _get_callbacks():
+        try:
+            callback(event)
+        except Exception:
+            # 計測のせいで本来の処理を失敗させない
+            logger.exception('query callback {!r} failed.'.format(callback))
+    query_executed.send(sender=QueryEvent, event=event)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            '{}: {} time:{:.1f}ms, took:{}, hits:{}, body:{}'.format(
+                event.operation,
+                event.index,
+                event.elapsed_ms,
+                event.took,
+                event.hits,
+                event.body,
+            )
+        )
+
+
+@contextmanager
+def instrument(operation, index, body=None):
+    """
+    ES 呼び出しを計測するコンテクストマネージャ
+
+        with instrument('search', index, body) as event:
+            result = client.search(...)
+            event.set_result(result)
+    """
+    event = QueryEvent(operation, index, body=body)
+    token = _current_event.set(event)
+    start_time = time.perf_counter()
+    try:
+        yield event
+    except Exception as e:
+        event.error = True
+        event.exception = e
+        raise
+    finally:
+        event.elapsed = time.perf_counter() - start_time
+        _current_event.reset(token)
+        emit(event)
+
+
+class InstrumentedConnectionMixin(object):
+    """
+    実行中の QueryEvent にリクエスト/レスポンスのバイト数を記録する
+    Connection 用 Mixin
+    """
+
+    def perform_request_stream(
+        self,
+        method,
+        url,
+        params=None,
+        body=None,
+        headers=None,
+        chunk_size=None,
+    ):
+        """
+        レスポンスボディを bytes のチャンクのイテレータで返す
+        ここでは perform_request の結果を1チャンクとして返すだけ。
+        ストリーミングできる Connection はオーバーライドする。
+        :return: (ステータスコード, レスポンスヘッダ, チャンクのイテレータ)
+        """
+        status, response_headers, raw = self.perform_request(
+            method, url, params=params, body=body, headers=headers
+        )
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+        return status, response_headers, iter([raw])
+
+    def _record_bytes(self, body, response):
+        event = _current_event.get()
+        if event is None:
+            return
+        # デコード済みの str は文字数ではなく、UTF-8 のバイト数で数える
+        if body:
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            event.request_bytes += len(body)
+        if response:
+            if isinstance(response, str):
+                response = response.encode('utf-8')
+            event.response_bytes += len(response)
+
+    def log_request_success(
+        self, method, full_url, path, body, status_code, response, duration
+    ):
+        self._record_bytes(body, response)
+        return super().log_request_success(
+            method, full_url, path, body, status_code, response, duration
+        )
+
+    def log_request_fail(
+        self,
+        method,
+        full_url,
+        path,
+        body,
+        duration,
+        status_code=None,
+        response=None,
+        exception=None,
+    ):
+        self._record_bytes(body, response)
+        return super().log_request_fail(
+            method,
+            full_url,
+            path,
+            body,
+            duration,
+            status_code=status_code,
+            response=response,
+            exception=exception,
+        )
+
+
+class InstrumentedUrllib3HttpConnection(
+    InstrumentedConnectionMixin, Urllib3HttpConnection
+):
+    def perform_request_stream(
+        self,
+        method,
+        url,
+        params=None,
+        body=None,
+        headers=None,
+        chunk_size=65536,
+    ):
+        """
+        urllib3 のレスポンスを preload せずに、チャンクごとに読む
+        トランスポートのリトライは行わない。
+        """
+        path = self.url_prefix + url
+        if params:
+            path = '{}?{}'.format(path, urlencode(params))
+        full_url = self.host + path
+        request_headers = self.headers.copy()
+        request_headers.update(headers or ())
+        orig_body = body
+        if self.http_compress and body:
+            body = self._gzip_compress(body)
+            request_headers['content-encoding'] = 'gzip'
+
+        start = time.time()
+        try:
+            response = self.pool.urlopen(
+                method,
+                path,
+                body,
+                retries=Retry(False),
+                headers=request_headers,
+                preload_content=False,
+            )
+        except Exception as e:
+            self.log_request_fail(
+                method,
+                full_url,
+                path,
+                orig_body,
+                time.time() - start,
+                exception=e,
+            )
+            if isinstance(e, ReadTimeoutError):
+                raise ConnectionTimeout('TIMEOUT', str(e), e)
+            raise ConnectionError('N/A', str(e), e)
+
+        response_headers = {k.lower(): v for k, v in response.headers.items()}
+        if not (200 <= response.status < 300):
+            raw = response.data.decode('utf-8', 'surrogatepass')
+            response.release_conn()
+            self.log_request_fail(
+                method,
+                full_url,
+                path,
+                orig_body,
+                time.time() - start,
+                response.status,
+                raw,
+            )
+            self._raise_error(response.status, raw)
+
+        def _chunks():
+            try:
+                for chunk in response.stream(chunk_size, decode_content=True):
+                    yield chunk
+            finally:
+                response.release_conn()
+
+        return response.status, response_headers, _chunks()
+
+
+class InstrumentedRequestsHttpConnection(
+    InstrumentedConnectionMixin, RequestsHttpConnection
+):
+    pass
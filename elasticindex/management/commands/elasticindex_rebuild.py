@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    help = (
+        'ElasticDocument の rebuild_index を実行し、進捗とフェーズごとの'
+        '内訳を表示する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'document',
+            help='ElasticDocument のクラスのドットパス '
+            '(例: myapp.documents.ArticleDocument)',
+        )
+        parser.add_argument(
+            '--bulk-size',
+            type=int,
+            default=1000,
+            help='bulk 1回の行数。0 なら bulk を使わない',
+        )
+        parser.add_argument('--limit', type=int, default=None)
+        parser.add_argument('--offset', type=int, default=None)
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='進捗を表示する間隔 (秒)',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            document_cls = import_string(options['document'])
+        except ImportError as e:
+            raise CommandError(str(e))
+
+        last_written = [0.0]
+
+        def _progress(stats):
+            now = time.monotonic()
+            if now - last_written[0] < options['interval']:
+                return
+            last_written[0] = now
+            self.stdout.write(stats.format_progress())
+
+        stats = document_cls.rebuild_index(
+            limit=options['limit'],
+            offset=options['offset'],
+            bulk_size=options['bulk_size'],
+            progress_callback=_progress,
+        )
+        self.stdout.write(stats.format_summary())
@@ -0,0 +1,112 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from elasticindex.slowlog import SlowQueryDocument
+
+
+class Command(BaseCommand):
+    help = (
+        'スロークエリを、クエリの形と対象インデックスごとに'
+        '合計時間の大きい順で表示する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit', type=int, default=10, help='表示するクエリの形の数'
+        )
+        parser.add_argument(
+            '--index', default=None, help='対象インデックスで絞り込む'
+        )
+        parser.add_argument(
+            '--profile',
+            action='store_true',
+            help='プロファイルの内訳 (時間のかかった句) も表示する',
+        )
+
+    def get_body(self, *, limit, index):
+        query = {"match_all": {}}
+        if index:
+            query = {"term": {"target_index": index}}
+        latest = {
+            "top_hits": {
+                "size": 1,
+                "sort": [{"elapsed_ms": "desc"}],
+            }
+        }
+        return {
+            "size": 0,
+            "query": query,
+            "aggs": {
+                "shapes": {
+                    "terms": {
+                        "field": "shape_hash",
+                        "size": limit,
+                        "order": {"total_ms": "desc"},
+                    },
+                    "aggs": {
+                        "total_ms": {"sum": {"field": "elapsed_ms"}},
+                        "max_ms": {"max": {"field": "elapsed_ms"}},
+                        "avg_ms": {"avg": {"field": "elapsed_ms"}},
+                        "worst": latest,
+                        "profiled": {
+                            "filter": {"term": {"profiled": True}},
+                            "aggs": {"worst": latest},
+                        },
+                    },
+                }
+            },
+        }
+
+    def handle(self, *args, **options):
+        if not SlowQueryDocument.index.exists():
+            self.stdout.write('No slow queries recorded.')
+            return
+
+        qs = SlowQueryDocument.objects.set_body(
+            self.get_body(limit=options['limit'], index=options['index'])
+        )
+        list(qs)
+        buckets = qs.latest_raw_result['aggregations']['shapes']['buckets']
+        if not buckets:
+            self.stdout.write('No slow queries recorded.')
+            return
+
+        for bucket in buckets:
+            worst = SlowQueryDocument(bucket['worst']['hits']['hits'][0])
+            self.stdout.write(
+                '{shape} {index} {operation}: total:{total:.1f}ms '
+                'count:{count} avg:{avg:.1f}ms max:{max:.1f}ms'.format(
+                    shape=bucket['key'],
+                    index=worst.target_index,
+                    operation=worst.operation,
+                    total=bucket['total_ms']['value'],
+                    count=bucket['doc_count'],
+                    avg=bucket['avg_ms']['value'],
+                    max=bucket['max_ms']['value'],
+                )
+            )
+            self.stdout.write('    {}'.format(json.dumps(worst.body_dict)))
+
+            if not options['profile']:
+                continue
+            profiled_hits = bucket['profiled']['worst']['hits']['hits']
+            if not profiled_hits:
+                continue
+            self.write_profile(SlowQueryDocument(profiled_hits[0]))
+
+    def write_profile(self, document):
+        for shard in document.profile_list:
+            self.stdout.write('    shard {}'.format(shard['id']))
+            for depth, type_, description, nanos in shard['query']:
+                self.stdout.write(
+                    '      {}{} {:.2f}ms {}'.format(
+                        '  ' * depth, type_, (nanos or 0) / 1e6, description
+                    )
+                )
+            for depth, name, nanos in shard['collector']:
+                self.stdout.write(
+                    '      {}{} {:.2f}ms'.format(
+                        '  ' * depth, name, (nanos or 0) / 1e6
+                    )
+                )
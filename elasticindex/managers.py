@@ -1,13 +1,25 @@
 import copy
+import datetime
 import logging
-import time
 from collections import OrderedDict
-from contextlib import contextmanager
 
 import six
 from django.utils.functional import cached_property
 
-from .client import get_es_client
+from .client import READ, WRITE
+from .instrumentation import QueryEvent, emit, instrument
+from .partitions import (
+    DAILY,
+    MONTHLY,
+    ROLLOVER,
+    get_pattern,
+    join_index_names,
+    next_start,
+    parse_partition_name,
+    to_datetime,
+)
+from .serializers import dumps_bulk_body
+from .streaming import StreamingSearch
 
 logger = logging.getLogger('elasticindex')
 
@@ -28,6 +40,10 @@ class ElasticQuerySet:
         self.latest_raw_result = None
         self.query_finished = False
         self.timeout = None
+        # True なら検索も書き込み用の接続先に送る (read your writes)
+        self.use_write_hosts = False
+        # with_source_models() の指定
+        self.source_models_options = None
 
     def __len__(self):
         return len(self.result_list)
@@ -76,6 +92,8 @@ class ElasticQuerySet:
             copy.deepcopy(self.body),
             **copy.deepcopy(self.kwargs),
         )
+        qs.use_write_hosts = self.use_write_hosts
+        qs.source_models_options = self.source_models_options
         return qs
 
     @cached_property
@@ -88,22 +106,128 @@ class ElasticQuerySet:
         elasticsearch の search をそのまま実行
         :rtype: generator
         """
-        with self.log_query():
+        with self.log_query() as event:
             result = self.es_client.search(
-                index=self.model_cls.INDEX, body=self.body, **self.kwargs
+                index=self.search_index, body=self.body, **self.search_kwargs
             )
+            event.set_result(result)
+        self.record_slow_query('search', self.body, event)
 
-        if isinstance(result['hits']['total'], dict):
+        self._set_total(result)
+        self.latest_raw_result = result
+        documents = (
+            self._make_document(hit) for hit in result['hits']['hits']
+        )
+        if self.source_models_options is not None:
+            documents = self._attach_source_models(list(documents))
+        yield from documents
+
+    def _make_document(self, hit):
+        """
+        検索結果のヒット1件からドキュメントを作る
+        """
+        return self.model_cls(hit)
+
+    def _set_total(self, result):
+        total = result['hits']['total']
+        if isinstance(total, dict):
             # ES 7 以降は hits.total が dict になっている
-            self.latest_total_count = result['hits']['total']['value']
-            self.latest_total_relation = result['hits']['total']['relation']
-        elif isinstance(result['hits']['total'], int):
+            self.latest_total_count = total['value']
+            self.latest_total_relation = total['relation']
+        elif isinstance(total, int):
             # ES 6 までは hits.total が int
-            self.latest_total_count = result['hits']['total']
+            self.latest_total_count = total
 
-        self.latest_raw_result = result
-        for hit in result['hits']['hits']:
-            yield self.model_cls(hit)
+    def stream(self, keep_raw_result=False, chunk_size=65536):
+        """
+        レスポンスを読みながら、ヒットを1件ずつドキュメントにして返す
+        レスポンス全体を dict にしないので、大きいページでもメモリが少なく、
+        最初の1件が早く返る。結果はキャッシュしない。with_source_models() は効かない。
+
+        読み終わると latest_total_count や latest_raw_result
+        (hits.hits は空。keep_raw_result=True ならヒットも残す) が入る。
+        :rtype: generator
+        """
+        streaming = StreamingSearch(
+            self.es_client,
+            self.search_index,
+            self.body,
+            params=self.search_kwargs,
+            keep_hits=keep_raw_result,
+            chunk_size=chunk_size,
+        )
+        event = QueryEvent('search', self.instrument_index, body=self.body)
+        try:
+            for hit in streaming:
+                yield self._make_document(hit)
+        except Exception as e:
+            event.error = True
+            event.exception = e
+            raise
+        finally:
+            # 呼び出し側の処理時間は含めない
+            event.elapsed = streaming.elapsed
+            event.request_bytes = streaming.request_bytes
+            event.response_bytes = streaming.response_bytes
+            event.hits = streaming.hit_count
+            if streaming.result is not None:
+                event.took = streaming.result.get('took')
+            emit(event)
+
+        self.record_slow_query('search', self.body, event)
+        self._set_total(streaming.result)
+        self.latest_raw_result = streaming.result
+
+    def with_source_models(
+        self, select_related=None, prefetch_related=None, drop_missing=True
+    ):
+        """
+        検索結果の各ドキュメントに、元モデルのインスタンスを
+        .source_instance として付ける。
+        元モデルは検索結果1ページにつき in_bulk の1クエリでまとめて取得する。
+        (MultiDocumentQuerySet では元モデルごとに1クエリ)
+
+        :param select_related: 元モデルのクエリセットの select_related
+        :param prefetch_related: 元モデルのクエリセットの prefetch_related
+        :param drop_missing: True なら DB に行が無いドキュメントを結果から除く。
+            False なら残して .source_instance を None にする
+        :rtype: ElasticQuerySet
+        """
+        o = self._clone()
+        o.source_models_options = {
+            'select_related': select_related,
+            'prefetch_related': prefetch_related,
+            'drop_missing': drop_missing,
+        }
+        return o
+
+    def _attach_source_models(self, documents):
+        options = self.source_models_options
+        pks = []
+        pks_by_class = OrderedDict()
+        for document in documents:
+            pk = type(document).get_source_model_pk(document.es_id)
+            pks.append(pk)
+            pks_by_class.setdefault(type(document), []).append(pk)
+
+        instances = {}
+        for document_cls, class_pks in pks_by_class.items():
+            source_qs = document_cls.source_model._default_manager.all()
+            for method_name in ('select_related', 'prefetch_related'):
+                lookups = options[method_name]
+                if lookups:
+                    if isinstance(lookups, str):
+                        lookups = [lookups]
+                    source_qs = getattr(source_qs, method_name)(*lookups)
+            instances[document_cls] = source_qs.in_bulk(class_pks)
+
+        attached = []
+        for document, pk in zip(documents, pks):
+            document.source_instance = instances[type(document)].get(pk)
+            if document.source_instance is None and options['drop_missing']:
+                continue
+            attached.append(document)
+        return attached
 
     def set_timeout(self, timeout):
         """
@@ -113,31 +237,93 @@ class ElasticQuerySet:
         o.timeout = timeout
         return o
 
+    def read_your_writes(self):
+        """
+        検索・取得を、読み込み用ではなく書き込み用の接続先に送る
+        書き込み直後の内容を確実に読みたい場合に使う
+        :rtype: ElasticQuerySet
+        """
+        o = self._clone()
+        o.use_write_hosts = True
+        return o
+
+    @property
+    def search_index(self):
+        """
+        検索対象のインデックス名
+        時間で分割したインデックスなら、query の range に重なるパーティション
+        """
+        return self.model_cls.get_index_for_search(self.body.get('query'))
+
+    @property
+    def search_kwargs(self):
+        if self.model_cls.PARTITION in (DAILY, MONTHLY):
+            # まだ作られていないパーティションがあってもエラーにしない
+            return dict(
+                {'ignore_unavailable': True, 'allow_no_indices': True},
+                **self.kwargs,
+            )
+        return self.kwargs
+
     @cached_property
     def es_client(self):
         """
+        検索・取得用のクライアント
         :rtype: Elasticsearch
         """
-        return get_es_client(timeout=self.timeout)
+        return self.model_cls.get_es_client(
+            timeout=self.timeout,
+            role=WRITE if self.use_write_hosts else READ,
+        )
+
+    @cached_property
+    def es_write_client(self):
+        """
+        削除・bulk 用のクライアント
+        :rtype: Elasticsearch
+        """
+        return self.model_cls.get_es_client(timeout=self.timeout, role=WRITE)
 
-    def get_by_id(self, id):
+    def get_by_id(self, id, routing=None):
         """
         Elasticsearch のIDで1件取得
         :param id:
+        :param routing: 書き込み時にルーティングを指定した場合は同じ値
+            省略時は .routing() で指定した値
         :return:
         """
-        result = self.es_client.get(self.model_cls.INDEX, id)
+        if self.model_cls.PARTITION:
+            # どのパーティションにあるか分からないので、ids で検索する
+            qs = self.query({"ids": {"values": [id]}}).limit(1)
+            if routing is not None:
+                qs = qs.routing(routing)
+            documents = list(qs)
+            self.latest_raw_result = qs.latest_raw_result
+            if not documents:
+                raise self.model_cls.DoesNotExist(id)
+            return documents[0]
+
+        if routing is None:
+            routing = self.kwargs.get('routing')
+        params = {'routing': routing} if routing is not None else {}
+        with instrument('get', self.model_cls.INDEX) as event:
+            result = self.es_client.get(self.model_cls.INDEX, id, **params)
+            event.hits = int(bool(result.get('found')))
         self.latest_raw_result = result
         if not result['found']:
             raise self.model_cls.DoesNotExist(id)
         return self.model_cls(result)
 
-    def delete_by_id(self, id, **kwargs):
+    def delete_by_id(self, id, index=None, **kwargs):
         """
         Elasticsearch のIDで1件削除
         :param id: elasticsearch document id
+        :param index: 時間で分割したインデックスの場合は、ドキュメントのある
+            パーティション (検索結果の document.es_result['_index'])
         """
-        result = self.es_client.delete(self.model_cls.INDEX, id, **kwargs)
+        index = index or self.model_cls.INDEX
+        with instrument('delete', index):
+            result = self.es_write_client.delete(index, id, **kwargs)
         self.latest_raw_result = result
         return result
 
@@ -194,6 +380,54 @@ class ElasticQuerySet:
         o.body['query'] = filter_query_dict
         return o
 
+    def knn(
+        self,
+        field,
+        vector,
+        k=10,
+        num_candidates=None,
+        filter=None,
+        boost=None,
+        hybrid=False,
+        query_boost=None,
+    ):
+        """
+        kNN (近似最近傍) 検索。ES 8.4 以降の検索 API の knn オプション
+            qs.knn("embedding", query_vector, k=20, filter={"term": {...}})
+
+        :param vector: NumPy の配列かリスト
+        :param num_candidates: シャードごとの候補数。省略時は k の10倍 (100以上)
+        :param filter: kNN の候補を絞るクエリ (dict か dict のリスト)
+        :param boost: kNN のスコアの重み (hybrid のとき)
+        :param hybrid: True なら query() の条件のスコアと kNN のスコアを合計する。
+            False なら query() の条件は使わず、kNN の結果だけを返す
+        :param query_boost: query() の条件のスコアの重み (hybrid のとき)
+        :rtype: ElasticQuerySet
+        """
+        if hasattr(vector, 'tolist'):
+            vector = vector.tolist()
+        knn = {
+            "field": field,
+            "query_vector": list(vector),
+            "k": k,
+            "num_candidates": num_candidates or min(max(k * 10, 100), 10000),
+        }
+        if filter:
+            knn["filter"] = filter
+        if boost is not None:
+            knn["boost"] = boost
+
+        o = self._clone()
+        o.body['knn'] = knn
+        if not hybrid:
+            o.body.pop('query', None)
+            o.body.setdefault('size', k)
+        elif query_boost is not None and 'query' in o.body:
+            o.body['query'] = {
+                "bool": {"must": [o.body['query']], "boost": query_boost}
+            }
+        return o
+
     def set_body(self, body_dict):
         """
         replace query body
@@ -223,13 +457,105 @@ class ElasticQuerySet:
         if 'sort' in body:
             del body['sort']
 
-        with self.log_query(label='count', body=body):
+        with self.log_query(label='count', body=body) as event:
             result = self.es_client.count(
-                index=self.model_cls.INDEX, body=body, **self.kwargs
+                index=self.search_index, body=body, **self.search_kwargs
             )
+            event.set_result(result)
+        self.record_slow_query('count', body, event)
         self.latest_raw_result = result
         return result['count']
 
+    def _aggregation_body(self, aggs):
+        """
+        検索条件はそのままで、ヒットを返さず aggs だけを実行する body
+        """
+        body = {
+            k: v
+            for k, v in self.body.items()
+            if k
+            not in ('sort', 'from', 'size', '_source', 'aggs', 'aggregations')
+        }
+        body.update(size=0, _source=False, aggs=aggs)
+        return body
+
+    def _search_aggregations(self, body):
+        with self.log_query(label='aggregate', body=body) as event:
+            result = self.es_client.search(
+                index=self.search_index, body=body, **self.search_kwargs
+            )
+            event.set_result(result)
+        self.record_slow_query('aggregate', body, event)
+        self._set_total(result)
+        self.latest_raw_result = result
+        return result['aggregations']
+
+    def aggregate(self, **aggs):
+        """
+        集計だけを実行する。ヒットは取得しない (size: 0, _source: false)
+
+            qs.aggregate(
+                categories={"terms": {"field": "category"}},
+                max_price={"max": {"field": "price"}},
+            )
+            -> {'categories': [{'key': 'book', 'doc_count': 3}, ...],
+                'max_price': 1200.0}
+
+        バケットを返す集計はバケットのリスト (keyed なら dict) に、
+        value を返すメトリクスは値になる。サブ集計も同じように変換する。
+        それ以外 (stats など) は ES の結果の dict のまま。
+        :rtype: OrderedDict
+        """
+        result = self._search_aggregations(self._aggregation_body(aggs))
+        return OrderedDict(
+            (name, parse_aggregation(result[name])) for name in aggs
+        )
+
+    def iter_composite(self, sources, page_size=1000, aggs=None):
+        """
+        composite 集計のバケットを after_key でページングしながら1つずつ返す
+        メモリに持つのは1ページ分だけなので、バケット数が多くても使える。
+
+            for bucket in qs.iter_composite(
+                    [{"shop": {"terms": {"field": "shop_id"}}}]):
+                bucket['key']['shop'], bucket['doc_count']
+
+        :param sources: composite の sources
+        :param page_size: 1リクエストで取得するバケット数
+        :param aggs: 各バケットのサブ集計
+        :rtype: generator
+        """
+        composite = {'sources': sources, 'size': page_size}
+        while True:
+            agg = {'composite': composite}
+            if aggs:
+                agg['aggs'] = aggs
+            result = self._search_aggregations(
+                self._aggregation_body({'composite': agg})
+            )['composite']
+            for bucket in result['buckets']:
+                yield _parse_bucket(bucket)
+            after_key = result.get('after_key')
+            # page_size に満たなければ最後のページなので、空のページを取りに行かない
+            if len(result['buckets']) < page_size or not after_key:
+                return
+            composite = dict(composite, after=after_key)
+
+    def routing(self, routing):
+        """
+        検索を指定したルーティング値のシャードだけに絞る
+        複数指定する場合はカンマ区切りの文字列かリスト
+        :rtype: ElasticQuerySet
+        """
+        o = self._clone()
+        if isinstance(routing, (list, tuple)):
+            routing = ','.join(str(r) for r in routing)
+        if routing is None:
+            o.kwargs.pop('routing', None)
+        else:
+            o.kwargs['routing'] = routing
+        return o
+
     def order_by(self, order_query_list):
         """
         sort パラメータをつける
@@ -245,32 +571,228 @@ class ElasticQuerySet:
     @property
     def log_query(self):
         """
-        クエリをロギングするコンテクストマネージャ
+        クエリを計測・ロギングするコンテクストマネージャ
+        with の値は instrumentation.QueryEvent
         elasticsearch や elasticsearch.trace のロガーを
         DEBUG レベルで設定するともっと詳しく出る (結果が全部出る)
         """
 
-        @contextmanager
         def _context(label='', body=None):
-            start_time = time.time()
-            yield
-            elapsed_time = time.time() - start_time
-            logger.debug(
-                '{}time:{}ms, body:{}'.format(
-                    '{}: '.format(label) if label else '',
-                    int(elapsed_time * 100),
-                    body or self.body,
-                )
+            return instrument(
+                label or 'search', self.instrument_index, body or self.body
             )
 
         return _context
 
+    @property
+    def instrument_index(self):
+        """
+        計測 (QueryEvent) やスロークエリログに付けるインデックス名
+        """
+        return self.model_cls.INDEX
+
+    def record_slow_query(self, operation, body, event):
+        """
+        閾値を超えた search / count をスロークエリとして記録する
+        """
+        from .slowlog import get_threshold_ms, record_slow_query
+
+        if get_threshold_ms(self.model_cls) is None:
+            return
+        record_slow_query(self, operation, body, event)
+
     def bulk(self, body):
-        return self.es_client.bulk(
-            body,
-            index=self.model_cls.INDEX,
+        if isinstance(body, (list, tuple)):
+            # elasticsearch-py の join は str 前提なので、ここで bytes にする
+            body = dumps_bulk_body(
+                self.es_write_client.transport.serializer, body
+            )
+        with instrument('bulk', self.model_cls.INDEX) as event:
+            result = self.es_write_client.bulk(
+                body,
+                index=self.model_cls.INDEX,
+            )
+            event.set_result(result)
+        return result
+
+
+def _parse_bucket(bucket):
+    """
+    バケット内のサブ集計を parse_aggregation で変換する
+    """
+    parsed = {}
+    for key, value in bucket.items():
+        if key != 'key' and isinstance(value, dict):
+            value = parse_aggregation(value)
+        parsed[key] = value
+    return parsed
+
+
+def parse_aggregation(result):
+    """
+    aggregations の結果1つを使いやすい形にする
+    - terms などバケットを返すもの: バケットのリスト (keyed なら dict)
+    - filter などバケット1つのもの: バケットの dict
+    - value を返すメトリクス (max, avg, cardinality など): 値
+    - それ以外: そのまま
+    """
+    if 'buckets' in result:
+        buckets = result['buckets']
+        if isinstance(buckets, dict):
+            return OrderedDict(
+                (key, _parse_bucket(b)) for key, b in buckets.items()
+            )
+        return [_parse_bucket(b) for b in buckets]
+    if 'doc_count' in result:
+        return _parse_bucket(result)
+    if 'value' in result and not set(result) - {'value', 'value_as_string'}:
+        return result['value']
+    return result
+
+
+class MultiDocumentQuerySet(ElasticQuerySet):
+    """
+    複数の ElasticDocument のインデックスを、1回の search で検索する
+
+        qs = MultiDocumentQuerySet(ProductDocument, ArticleDocument)
+        for document in qs.query(...).order_by(...)[:20]:
+            ...  # ProductDocument か ArticleDocument のインスタンス
+
+    query, sort, from/size は全インデックスで共通。ヒットは _index から
+    ElasticDocument.owns_index で判定したクラスのインスタンスになる。
+    接続先・タイムアウト・スロークエリの設定は最初のクラスのものを使う。
+    """
+
+    def __init__(self, *document_classes, body=None, **kwargs):
+        if not document_classes:
+            raise ValueError('At least one document class is required.')
+        for document_cls in document_classes[1:]:
+            if (document_cls.READ_HOSTS, document_cls.WRITE_HOSTS) != (
+                document_classes[0].READ_HOSTS,
+                document_classes[0].WRITE_HOSTS,
+            ):
+                raise ValueError(
+                    '{} and {} are on different hosts.'.format(
+                        document_classes[0].__name__, document_cls.__name__
+                    )
+                )
+        super().__init__(document_classes[0], body, **kwargs)
+        self.document_classes = document_classes
+        # source() で指定した、クラスごとの _source のフィールド
+        self.source_fields = {}
+        self._classes_by_index = {}
+
+    def _clone(self):
+        """
+        :rtype: MultiDocumentQuerySet
+        """
+        qs = self.__class__(
+            *self.document_classes,
+            body=copy.deepcopy(self.body),
+            **copy.deepcopy(self.kwargs),
+        )
+        qs.use_write_hosts = self.use_write_hosts
+        qs.source_models_options = self.source_models_options
+        qs.source_fields = dict(self.source_fields)
+        return qs
+
+    def source(self, document_cls, fields):
+        """
+        document_cls のヒットで取得する _source のフィールドを絞る
+        取得しなかったフィールドは None (default があれば default) になる。
+        指定しなかったクラスは、そのクラスのフィールドを全部取得する。
+        :rtype: MultiDocumentQuerySet
+        """
+        if document_cls not in self.document_classes:
+            raise ValueError('{} is not searched.'.format(document_cls))
+        o = self._clone()
+        o.source_fields[document_cls] = list(fields)
+        # _source はリクエスト全体で1つなので、各クラスの分の和集合にする
+        includes = []
+        for cls in o.document_classes:
+            for name in o.source_fields.get(cls, cls._cached_fields()):
+                if name not in includes:
+                    includes.append(name)
+        o.body['_source'] = includes
+        return o
+
+    def get_document_class(self, index_name):
+        """
+        検索結果の _index に対応する ElasticDocument のクラス
+        """
+        if index_name not in self._classes_by_index:
+            for document_cls in self.document_classes:
+                if document_cls.owns_index(index_name):
+                    break
+            else:
+                raise ValueError(
+                    'No document class for index {}.'.format(index_name)
+                )
+            self._classes_by_index[index_name] = document_cls
+        return self._classes_by_index[index_name]
+
+    def _make_document(self, hit):
+        document_cls = self.get_document_class(hit['_index'])
+        fields = self.source_fields.get(document_cls)
+        if fields is None:
+            return document_cls(hit)
+        return document_cls(hit, only=fields)
+
+    @property
+    def search_index(self):
+        query = self.body.get('query')
+        return ','.join(
+            document_cls.get_index_for_search(query)
+            for document_cls in self.document_classes
         )
 
+    @property
+    def search_kwargs(self):
+        if any(
+            document_cls.PARTITION in (DAILY, MONTHLY)
+            for document_cls in self.document_classes
+        ):
+            return dict(
+                {'ignore_unavailable': True, 'allow_no_indices': True},
+                **self.kwargs,
+            )
+        return self.kwargs
+
+    @property
+    def instrument_index(self):
+        return ','.join(
+            document_cls.INDEX for document_cls in self.document_classes
+        )
+
+    def get_by_id(self, id, routing=None):
+        """
+        Elasticsearch のIDで1件取得
+        全クラスのインデックスを ids で検索し、ヒットの _index のクラスの
+        インスタンスを返す。同じIDが複数のインデックスにあれば、どれか1件
+        :param routing: 書き込み時にルーティングを指定した場合は同じ値
+        """
+        qs = self.query({"ids": {"values": [id]}}).limit(1)
+        if routing is not None:
+            qs = qs.routing(routing)
+        documents = list(qs)
+        self.latest_raw_result = qs.latest_raw_result
+        if not documents:
+            raise self.model_cls.DoesNotExist(id)
+        return documents[0]
+
+    def delete_by_id(self, id, index=None, **kwargs):
+        """
+        Elasticsearch のIDで1件削除
+        :param index: 省略時は get_by_id で探し、ヒットの _index から削除する
+        """
+        if index is None:
+            document = self.get_by_id(id, routing=kwargs.get('routing'))
+            index = document.es_result['_index']
+            routing = document.es_result.get('_routing')
+            if routing is not None:
+                kwargs.setdefault('routing', routing)
+        return super().delete_by_id(id, index=index, **kwargs)
+
 
 class ElasticDocumentManager(object):
     """
@@ -305,20 +827,32 @@ class ElasticIndexManager(object):
         """
         インデックスの mappings の指定にそのまま使える dict
         """
-        return {"properties": self.mappings_properties}
+        mappings = {"properties": self.mappings_properties}
+        if getattr(self.model_cls, 'ROUTING_REQUIRED', False):
+            mappings["_routing"] = {"required": True}
+        return mappings
 
     def delete(self):
         """
         インデックスを削除
+        時間で分割したインデックスなら、全パーティションとテンプレートを削除
         :return:
         """
-        es = get_es_client()
-        es.indices.delete(
-            self.model_cls.INDEX,
-            ignore=[
-                404,
-            ],
-        )
+        es = self.model_cls.get_es_client(role=WRITE)
+        if self.model_cls.PARTITION:
+            self._delete_indices(self.partitions())
+            with instrument('indices.delete_template', self.model_cls.INDEX):
+                es.indices.delete_index_template(
+                    self.model_cls.INDEX, ignore=[404]
+                )
+            return
+        with instrument('indices.delete', self.model_cls.INDEX):
+            es.indices.delete(
+                self.model_cls.INDEX,
+                ignore=[
+                    404,
+                ],
+            )
 
     @cached_property
     def create_body_params(self):
@@ -329,20 +863,142 @@ class ElasticIndexManager(object):
             body["settings"] = index_setting
         return body
 
+    @cached_property
+    def template_body(self):
+        """
+        パーティションに mappings と INDEX_SETTINGS を適用するテンプレート
+        """
+        return {
+            "index_patterns": [
+                get_pattern(self.model_cls.INDEX, self.model_cls.PARTITION)
+            ],
+            "template": self.create_body_params,
+        }
+
     def create(self):
         """
         インデックスを作成
+        時間で分割したインデックスなら、テンプレートを作成する。
+        パーティションは書き込み時に ES が自動で作る。
+        'rollover' なら、最初のインデックスと書き込み用のエイリアスも作る。
         :return:
         """
-        es = get_es_client()
-        es.indices.create(self.model_cls.INDEX, self.create_body_params)
+        es = self.model_cls.get_es_client(role=WRITE)
+        if not self.model_cls.PARTITION:
+            with instrument('indices.create', self.model_cls.INDEX):
+                es.indices.create(
+                    self.model_cls.INDEX, self.create_body_params
+                )
+            return
+
+        with instrument('indices.put_template', self.model_cls.INDEX):
+            es.indices.put_index_template(
+                self.model_cls.INDEX, self.template_body
+            )
+        if self.model_cls.PARTITION == ROLLOVER:
+            with instrument('indices.create', self.model_cls.INDEX):
+                es.indices.create(
+                    '{}-000001'.format(self.model_cls.INDEX),
+                    {
+                        "aliases": {
+                            self.model_cls.INDEX: {"is_write_index": True}
+                        }
+                    },
+                )
 
     def exists(self):
         """
         インデックスが存在するか
+        時間で分割したインデックスなら、テンプレートが存在するか
+        """
+        es = self.model_cls.get_es_client(role=WRITE)
+        if self.model_cls.PARTITION:
+            with instrument('indices.exists_template', self.model_cls.INDEX):
+                return es.indices.exists_index_template(self.model_cls.INDEX)
+        with instrument('indices.exists', self.model_cls.INDEX):
+            return es.indices.exists(self.model_cls.INDEX)
+
+    def _get_partitions_info(self):
+        """
+        パーティションのインデックス名と、indices.get の情報の dict
+        パターンにマッチしても、owns_index で自分のものと判定できない
+        インデックスは含めない
         """
-        es = get_es_client()
-        return es.indices.exists(self.model_cls.INDEX)
+        es = self.model_cls.get_es_client(role=WRITE)
+        with instrument('indices.get', self.model_cls.INDEX):
+            result = es.indices.get(
+                get_pattern(self.model_cls.INDEX, self.model_cls.PARTITION)
+            )
+        return {
+            name: info
+            for name, info in result.items()
+            if name != self.model_cls.INDEX and self.model_cls.owns_index(name)
+        }
+
+    def partitions(self):
+        """
+        存在するパーティションのインデックス名 (名前順)
+        """
+        return sorted(self._get_partitions_info())
+
+    def drop_partitions(self, older_than):
+        """
+        保持期間を過ぎたパーティションを、インデックスごと削除する
+        (delete_by_query のようにドキュメントを1件ずつ消すより軽い)
+        :param older_than: datetime か、今からさかのぼる timedelta
+            'daily' / 'monthly': 期間の終わりがこれ以前のパーティションを削除
+            'rollover': 作成日時がこれより前のもの (書き込み中のものは除く)
+        :return: 削除したインデックス名のリスト
+        """
+        if isinstance(older_than, datetime.timedelta):
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - older_than
+        else:
+            cutoff = to_datetime(older_than)
+        index = self.model_cls.INDEX
+        granularity = self.model_cls.PARTITION
+
+        names = []
+        for name, info in sorted(self._get_partitions_info().items()):
+            if granularity == ROLLOVER:
+                alias = info.get('aliases', {}).get(index, {})
+                if alias.get('is_write_index'):
+                    continue
+                index_settings = info.get('settings', {}).get('index', {})
+                created = index_settings.get('creation_date')
+                if created and to_datetime(int(created)) < cutoff:
+                    names.append(name)
+                continue
+            start = parse_partition_name(index, granularity, name)
+            if start and next_start(start, granularity) <= cutoff:
+                names.append(name)
+
+        self._delete_indices(names)
+        return names
+
+    def _delete_indices(self, names):
+        """
+        URL が長くなりすぎないよう、分けて削除する
+        """
+        es = self.model_cls.get_es_client(role=WRITE)
+        for expression in join_index_names(names):
+            with instrument('indices.delete', self.model_cls.INDEX):
+                es.indices.delete(expression)
+
+    def rollover(self, conditions=None):
+        """
+        PARTITION = 'rollover' の場合に、条件を満たしていれば
+        新しいインデックスを作って書き込み先を切り替える。cron などで定期的に呼ぶ
+        :param conditions: 省略時は ROLLOVER_CONDITIONS
+        """
+        es = self.model_cls.get_es_client(role=WRITE)
+        with instrument('indices.rollover', self.model_cls.INDEX):
+            return es.indices.rollover(
+                self.model_cls.INDEX,
+                {
+                    "conditions": conditions
+                    or self.model_cls.ROLLOVER_CONDITIONS
+                },
+            )
 
 
 class ElasticDocumentMeta(type):
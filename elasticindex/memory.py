@@ -0,0 +1,1446 @@
+"""
+プロセス内で動く、メモリ上の Elasticsearch もどき
+
+settings.ELASTICINDEX_BACKEND = 'memory' で使う。
+テストやローカル開発で、ES を起動せずに ElasticDocument を動かすためのもの。
+
+elasticsearch-py の Connection として実装しているので、
+Elasticsearch クライアントの API はそのまま使える。
+このライブラリが使う範囲だけを実装している。
+  - index / create / update / delete / get / mget / bulk
+  - search / count
+    (match_all, term, terms, ids, match, multi_match, range, exists,
+    prefix, bool, constant_score, sort, from/size, _source)
+  - knn (dense_vector。近似ではなく全件との類似度で計算する)
+  - aggs (terms (order はサブ集計も可), composite の terms, filter,
+    value_count, cardinality, min, max, sum, avg, top_hits)
+  - indices create / delete / exists / get
+  - index template (_index_template。index_patterns に合う名前の
+    インデックスが自動作成されるときに template を適用する)
+書き込みは即座に検索に反映される (refresh 不要)。
+"""
+
+import copy
+import fnmatch
+import itertools
+import json
+import math
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from urllib.parse import unquote
+
+from elasticsearch.connection import Connection
+
+from .instrumentation import InstrumentedConnectionMixin
+
+RESPONSE_HEADERS = {
+    'content-type': 'application/json; charset=UTF-8',
+    'x-elastic-product': 'Elasticsearch',
+}
+
+INFO_RESPONSE = {
+    'name': 'memory',
+    'cluster_name': 'elasticindex-memory',
+    'version': {'number': '7.17.0', 'build_flavor': 'default'},
+    'tagline': 'You Know, for Search',
+}
+
+# standard トークナイザで、1文字ずつのトークンにする文字 (かな・漢字)
+_CJK = '぀-ヿ㐀-䶿一-鿿豈-﫿'
+_STANDARD_TOKEN_RE = re.compile(
+    r'[{cjk}]|[^\W{cjk}]+'.format(cjk=_CJK), re.UNICODE
+)
+_WHITESPACE_TOKEN_RE = re.compile(r'\S+')
+_LETTER_TOKEN_RE = re.compile(r'[^\W\d_]+', re.UNICODE)
+
+TEXT_TYPES = ('text', 'match_only_text')
+
+
+class MemoryBackendError(Exception):
+    """
+    ES のエラーレスポンスに変換される例外
+    """
+
+    def __init__(self, status, error_type, reason):
+        super().__init__(reason)
+        self.status = status
+        self.error_type = error_type
+        self.reason = reason
+
+    def as_response(self):
+        return {
+            'error': {
+                'root_cause': [
+                    {'type': self.error_type, 'reason': self.reason}
+                ],
+                'type': self.error_type,
+                'reason': self.reason,
+            },
+            'status': self.status,
+        }
+
+
+def _char_class_matches(char, token_chars):
+    if not token_chars:
+        return True
+    if 'letter' in token_chars and char.isalpha():
+        return True
+    if 'digit' in token_chars and char.isdigit():
+        return True
+    if 'whitespace' in token_chars and char.isspace():
+        return True
+    if 'punctuation' in token_chars and not (char.isalnum() or char.isspace()):
+        return True
+    if 'symbol' in token_chars and not (char.isalnum() or char.isspace()):
+        return True
+    return False
+
+
+class Analyzer(object):
+    """
+    インデックス settings の analysis を解釈したアナライザ
+    トークナイザは standard, whitespace, letter, keyword, ngram,
+    edge_ngram に、フィルタは lowercase, uppercase に対応する。
+    それ以外は standard + lowercase として扱う。
+    """
+
+    def __init__(self, tokenizer=None, filters=('lowercase',)):
+        self.tokenizer = tokenizer or {'type': 'standard'}
+        self.filters = filters
+
+    def tokenize(self, text):
+        tokenizer_type = self.tokenizer.get('type', 'standard')
+        if tokenizer_type == 'keyword':
+            return [text]
+        if tokenizer_type == 'whitespace':
+            return _WHITESPACE_TOKEN_RE.findall(text)
+        if tokenizer_type in ('letter', 'lowercase'):
+            return _LETTER_TOKEN_RE.findall(text)
+        if tokenizer_type in ('ngram', 'nGram', 'edge_ngram', 'edgeNGram'):
+            return self._ngrams(text, edge=tokenizer_type.startswith('edge'))
+
+        tokens = _STANDARD_TOKEN_RE.findall(text)
+        max_length = int(self.tokenizer.get('max_token_length', 255))
+        result = []
+        for token in tokens:
+            # 長すぎるトークンは max_token_length ごとに分割される
+            for i in range(0, len(token), max_length):
+                result.append(token[i : i + max_length])
+        return result
+
+    def _ngrams(self, text, edge=False):
+        min_gram = int(self.tokenizer.get('min_gram', 1))
+        max_gram = int(self.tokenizer.get('max_gram', 2))
+        token_chars = self.tokenizer.get('token_chars', [])
+        tokens = []
+        for matches, chars in itertools.groupby(
+            text, key=lambda c: _char_class_matches(c, token_chars)
+        ):
+            if not matches:
+                continue
+            word = ''.join(chars)
+            starts = [0] if edge else range(len(word))
+            for start in starts:
+                for size in range(min_gram, max_gram + 1):
+                    if start + size > len(word):
+                        break
+                    tokens.append(word[start : start + size])
+        return tokens
+
+    def analyze(self, text):
+        tokens = self.tokenize(str(text))
+        for token_filter in self.filters:
+            if token_filter == 'lowercase':
+                tokens = [t.lower() for t in tokens]
+            elif token_filter == 'uppercase':
+                tokens = [t.upper() for t in tokens]
+        return tokens
+
+
+STANDARD_ANALYZER = Analyzer()
+BUILTIN_ANALYZERS = {
+    'standard': STANDARD_ANALYZER,
+    'simple': Analyzer({'type': 'letter'}),
+    'whitespace': Analyzer({'type': 'whitespace'}, filters=()),
+    'keyword': Analyzer({'type': 'keyword'}, filters=()),
+}
+
+
+def _normalize_exact(value):
+    """
+    term クエリなどで値を比較するための正規化
+    """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    return value
+
+
+def _flatten(source, prefix=''):
+    """
+    {'a': {'b': 1}, 'c': [1, 2]} -> {'a.b': [1], 'c': [1, 2]}
+    """
+    values = defaultdict(list)
+
+    def _walk(value, path):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                _walk(v, '{}.{}'.format(path, k) if path else k)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                _walk(v, path)
+        elif value is not None:
+            values[path].append(value)
+
+    _walk(source, prefix)
+    return values
+
+
+def _compare_key(value):
+    """
+    型の違う値が混ざってもソートできるようにするキー
+    """
+    if isinstance(value, bool):
+        return (0, int(value))
+    if isinstance(value, (int, float)):
+        return (0, value)
+    return (1, str(value))
+
+
+class MemoryIndex(object):
+    """
+    インデックス1つ分。ドキュメントと転置インデックスを持つ
+    """
+
+    def __init__(self, name, body=None):
+        body = body or {}
+        self.name = name
+        self.settings = body.get('settings') or {}
+        self.mappings = body.get('mappings') or {}
+        self.properties = copy.deepcopy(self.mappings.get('properties', {}))
+        self.routing_required = bool(
+            self.mappings.get('_routing', {}).get('required')
+        )
+        self.docs = OrderedDict()
+        self.versions = {}
+        self.seq_no = 0
+        # フィールド -> トークン -> ドキュメントID の集合 (text フィールド)
+        self.tokens = defaultdict(lambda: defaultdict(set))
+        # フィールド -> 値 -> ドキュメントID の集合 (それ以外)
+        self.terms = defaultdict(lambda: defaultdict(set))
+        # ドキュメントID -> フラットにした値
+        self.doc_values = {}
+        self.postings = {}
+        self._analyzers = {}
+
+    # ---- mapping / analysis
+
+    @property
+    def analysis(self):
+        index_settings = self.settings.get('index', self.settings)
+        return index_settings.get('analysis') or {}
+
+    def get_analyzer(self, name):
+        if not name:
+            return STANDARD_ANALYZER
+        if name in self._analyzers:
+            return self._analyzers[name]
+        analyzer = BUILTIN_ANALYZERS.get(name, STANDARD_ANALYZER)
+        definition = self.analysis.get('analyzer', {}).get(name)
+        if definition:
+            tokenizer = definition.get('tokenizer', 'standard')
+            tokenizer = self.analysis.get('tokenizer', {}).get(
+                tokenizer, {'type': tokenizer}
+            )
+            filters = definition.get('filter', [])
+            if definition.get('type') in ('standard', None):
+                filters = ['lowercase'] + list(filters)
+            analyzer = Analyzer(tokenizer, filters=filters)
+        self._analyzers[name] = analyzer
+        return analyzer
+
+    def get_field_mapping(self, field):
+        """
+        'a.b' のようなパスから mapping を探す。サブフィールド (fields) も見る
+        """
+        properties = self.properties
+        mapping = None
+        parts = field.split('.')
+        for i, part in enumerate(parts):
+            if mapping is not None and 'fields' in mapping:
+                sub = mapping['fields'].get('.'.join(parts[i:]))
+                if sub is not None:
+                    return sub
+            mapping = properties.get(part)
+            if mapping is None:
+                return None
+            properties = mapping.get('properties', {})
+        return mapping
+
+    def _dynamic_mapping(self, value):
+        if isinstance(value, bool):
+            return {'type': 'boolean'}
+        if isinstance(value, int):
+            return {'type': 'long'}
+        if isinstance(value, float):
+            return {'type': 'float'}
+        return {
+            'type': 'text',
+            'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}},
+        }
+
+    def _ensure_mapping(self, field, value):
+        if self.get_field_mapping(field) is not None:
+            return
+        properties = self.properties
+        parts = field.split('.')
+        for part in parts[:-1]:
+            properties = properties.setdefault(
+                part, {'properties': {}}
+            ).setdefault('properties', {})
+        properties[parts[-1]] = self._dynamic_mapping(value)
+
+    def is_text_field(self, field):
+        mapping = self.get_field_mapping(field)
+        return bool(mapping) and mapping.get('type') in TEXT_TYPES
+
+    def analyzer_for(self, field, search=False):
+        mapping = self.get_field_mapping(field) or {}
+        name = mapping.get('analyzer')
+        if search:
+            name = mapping.get('search_analyzer', name)
+        return self.get_analyzer(name)
+
+    # ---- documents
+
+    def put(self, doc_id, source):
+        doc_id = str(doc_id)
+        created = doc_id not in self.docs
+        if not created:
+            self._unindex(doc_id)
+        self.docs[doc_id] = source
+        self.versions[doc_id] = self.versions.get(doc_id, 0) + 1
+        self.seq_no += 1
+        self._index(doc_id, source)
+        return created
+
+    def remove(self, doc_id):
+        doc_id = str(doc_id)
+        if doc_id not in self.docs:
+            return False
+        self._unindex(doc_id)
+        del self.docs[doc_id]
+        self.versions[doc_id] += 1
+        self.seq_no += 1
+        return True
+
+    def _index(self, doc_id, source):
+        values = _flatten(source)
+        self.doc_values[doc_id] = values
+        postings = []
+        for field, field_values in values.items():
+            self._ensure_mapping(field, field_values[0])
+            mapping = self.get_field_mapping(field) or {}
+            if mapping.get('type') == 'dense_vector':
+                # doc_values だけあればよい
+                continue
+            if mapping.get('type') in TEXT_TYPES:
+                analyzer = self.analyzer_for(field)
+                for value in field_values:
+                    for token in analyzer.analyze(value):
+                        self.tokens[field][token].add(doc_id)
+                        postings.append((self.tokens, field, token))
+            else:
+                for value in field_values:
+                    key = _normalize_exact(value)
+                    self.terms[field][key].add(doc_id)
+                    postings.append((self.terms, field, key))
+            for sub_name, sub_mapping in mapping.get('fields', {}).items():
+                sub_field = '{}.{}'.format(field, sub_name)
+                if sub_mapping.get('type') in TEXT_TYPES:
+                    continue
+                for value in field_values:
+                    key = _normalize_exact(value)
+                    self.terms[sub_field][key].add(doc_id)
+                    postings.append((self.terms, sub_field, key))
+                self.doc_values[doc_id][sub_field] = field_values
+        self.postings[doc_id] = postings
+
+    def _unindex(self, doc_id):
+        for inverted, field, key in self.postings.pop(doc_id, ()):
+            ids = inverted[field].get(key)
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del inverted[field][key]
+        self.doc_values.pop(doc_id, None)
+
+    def hit(self, doc_id, score=None, source_filter=None):
+        source = _filter_source(self.docs[doc_id], source_filter)
+        hit = {
+            '_index': self.name,
+            '_type': '_doc',
+            '_id': doc_id,
+            '_score': score,
+        }
+        if source is not None:
+            hit['_source'] = source
+        return hit
+
+    # ---- queries
+
+    def execute(self, query):
+        """
+        :return: ドキュメントID -> スコア の dict
+        """
+        if not query:
+            return {doc_id: 1.0 for doc_id in self.docs}
+        ((query_type, params),) = query.items()
+        method = getattr(self, '_query_{}'.format(query_type), None)
+        if method is None:
+            raise MemoryBackendError(
+                400,
+                'parsing_exception',
+                'unknown query [{}] (memory backend)'.format(query_type),
+            )
+        return method(params)
+
+    def _query_match_all(self, params):
+        boost = params.get('boost', 1.0) if params else 1.0
+        return {doc_id: boost for doc_id in self.docs}
+
+    def _query_match_none(self, params):
+        return {}
+
+    def _field_params(self, params, value_key='value'):
+        ((field, value),) = (
+            (k, v) for k, v in params.items() if k not in ('boost', '_name')
+        )
+        boost = 1.0
+        if isinstance(value, dict):
+            boost = value.get('boost', 1.0)
+            value = value.get(value_key, value.get('query'))
+        return field, value, boost
+
+    def _term_ids(self, field, value):
+        if self.is_text_field(field):
+            return self.tokens[field].get(str(value), set())
+        return self.terms[field].get(_normalize_exact(value), set())
+
+    def _query_term(self, params):
+        field, value, boost = self._field_params(params)
+        return {doc_id: boost for doc_id in self._term_ids(field, value)}
+
+    def _query_terms(self, params):
+        boost = params.get('boost', 1.0)
+        ((field, values),) = (
+            (k, v) for k, v in params.items() if k not in ('boost', '_name')
+        )
+        ids = set()
+        for value in values:
+            ids |= self._term_ids(field, value)
+        return {doc_id: boost for doc_id in ids}
+
+    def _query_ids(self, params):
+        return {
+            str(doc_id): 1.0
+            for doc_id in params.get('values', ())
+            if str(doc_id) in self.docs
+        }
+
+    def _match_field(self, field, query, operator='or', boost=1.0):
+        if not self.is_text_field(field):
+            return {doc_id: boost for doc_id in self._term_ids(field, query)}
+        tokens = self.analyzer_for(field, search=True).analyze(query)
+        if not tokens:
+            return {}
+        scores = defaultdict(float)
+        matched = defaultdict(int)
+        for token in tokens:
+            for doc_id in self.tokens[field].get(token, ()):
+                scores[doc_id] += boost / len(tokens)
+                matched[doc_id] += 1
+        if operator.lower() == 'and':
+            return {
+                doc_id: score
+                for doc_id, score in scores.items()
+                if matched[doc_id] >= len(tokens)
+            }
+        return dict(scores)
+
+    def _query_match(self, params):
+        field, value, boost = self._field_params(params, value_key='query')
+        operator = 'or'
+        if isinstance(params[field], dict):
+            operator = params[field].get('operator', 'or')
+        return self._match_field(field, value, operator, boost)
+
+    def _query_match_phrase(self, params):
+        # 語順は見ずに、全トークンを含むものを返す
+        field, value, boost = self._field_params(params, value_key='query')
+        return self._match_field(field, value, 'and', boost)
+
+    def _query_multi_match(self, params):
+        scores = {}
+        operator = params.get('operator', 'or')
+        for field in params.get('fields', ()):
+            field, _, field_boost = field.partition('^')
+            boost = float(field_boost or 1.0)
+            result = self._match_field(field, params['query'], operator, boost)
+            for doc_id, score in result.items():
+                scores[doc_id] = max(scores.get(doc_id, 0), score)
+        return scores
+
+    def _query_range(self, params):
+        field, bounds = next(iter(params.items()))
+        result = {}
+        for doc_id, values in self.doc_values.items():
+            if any(_in_range(v, bounds) for v in values.get(field, ())):
+                result[doc_id] = bounds.get('boost', 1.0)
+        return result
+
+    def _query_exists(self, params):
+        field = params['field']
+        return {
+            doc_id: 1.0
+            for doc_id, values in self.doc_values.items()
+            if values.get(field)
+        }
+
+    def _query_prefix(self, params):
+        field, value, boost = self._field_params(params)
+        value = str(value)
+        inverted = self.tokens if self.is_text_field(field) else self.terms
+        ids = set()
+        for key, key_ids in inverted[field].items():
+            if str(key).startswith(value):
+                ids |= key_ids
+        return {doc_id: boost for doc_id in ids}
+
+    def _query_constant_score(self, params):
+        boost = params.get('boost', 1.0)
+        return {doc_id: boost for doc_id in self.execute(params['filter'])}
+
+    def _query_bool(self, params):
+        def _clauses(key):
+            clauses = params.get(key, [])
+            if isinstance(clauses, dict):
+                clauses = [clauses]
+            return [self.execute(c) for c in clauses]
+
+        must = _clauses('must')
+        filters = _clauses('filter')
+        should = _clauses('should')
+        must_not = _clauses('must_not')
+
+        required = must + filters
+        if required:
+            ids = set.intersection(*(set(r) for r in required))
+        else:
+            ids = set(self.docs)
+
+        minimum_should_match = params.get('minimum_should_match')
+        if minimum_should_match is None:
+            minimum_should_match = 0 if required else (1 if should else 0)
+        if str(minimum_should_match).endswith('%'):
+            minimum_should_match = math.ceil(
+                len(should) * float(str(minimum_should_match)[:-1]) / 100
+            )
+        minimum_should_match = int(minimum_should_match)
+        if minimum_should_match:
+            ids = {
+                doc_id
+                for doc_id in ids
+                if sum(doc_id in s for s in should) >= minimum_should_match
+            }
+        for excluded in must_not:
+            ids -= set(excluded)
+
+        boost = params.get('boost', 1.0)
+        scores = {}
+        for doc_id in ids:
+            score = sum(r.get(doc_id, 0) for r in must)
+            score += sum(s.get(doc_id, 0) for s in should)
+            scores[doc_id] = (score or (0.0 if filters else 1.0)) * boost
+        return scores
+
+    def knn(self, params):
+        """
+        全ドキュメントとの類似度を計算する (近似ではない kNN)
+        :return: 上位 k 件の ドキュメントID -> スコア の dict
+        """
+        field = params['field']
+        query_vector = params['query_vector']
+        mapping = self.get_field_mapping(field) or {}
+        similarity = mapping.get('similarity', 'cosine')
+        knn_filter = params.get('filter')
+        if isinstance(knn_filter, list):
+            knn_filter = {'bool': {'filter': knn_filter}}
+        candidates = self.execute(knn_filter) if knn_filter else self.docs
+        boost = params.get('boost', 1.0)
+        scores = {}
+        for doc_id in candidates:
+            vector = self.doc_values[doc_id].get(field)
+            if not vector or len(vector) != len(query_vector):
+                continue
+            scores[doc_id] = (
+                _vector_score(similarity, query_vector, vector) * boost
+            )
+        top = sorted(scores.items(), key=lambda item: -item[1])
+        return dict(top[: int(params.get('k', 10))])
+
+    # ---- search
+
+    def sort_key(self, sort_spec, scores):
+        specs = sort_spec if isinstance(sort_spec, list) else [sort_spec]
+        normalized = []
+        for spec in specs:
+            if isinstance(spec, str):
+                field, order = spec, 'desc' if spec == '_score' else 'asc'
+            else:
+                ((field, order),) = spec.items()
+                if isinstance(order, dict):
+                    order = order.get('order', 'asc')
+            normalized.append((field, order))
+
+        positions = {doc_id: i for i, doc_id in enumerate(self.docs)}
+
+        def _key(doc_id):
+            key = []
+            for field, order in normalized:
+                if field == '_score':
+                    value = (0, scores[doc_id])
+                    missing = False
+                elif field == '_doc':
+                    value = (0, positions[doc_id])
+                    missing = False
+                else:
+                    values = self.doc_values[doc_id].get(field)
+                    missing = not values
+                    value = _compare_key(
+                        (max if order == 'desc' else min)(
+                            values, key=_compare_key
+                        )
+                        if values
+                        else None
+                    )
+                key.append(
+                    (missing, _Reversed(value) if order == 'desc' else value)
+                )
+            return key
+
+        return _key
+
+
+class _Reversed(object):
+    """
+    降順ソート用に比較を反転するラッパー
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _vector_score(similarity, a, b):
+    """
+    ES の dense_vector と同じ、類似度から _score への変換
+    """
+    dot = sum(x * y for x, y in zip(a, b))
+    if similarity == 'l2_norm':
+        return 1 / (1 + sum((x - y) ** 2 for x, y in zip(a, b)))
+    if similarity == 'dot_product':
+        return (1 + dot) / 2
+    if similarity == 'max_inner_product':
+        return 1 / (1 - dot) if dot < 0 else dot + 1
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return (1 + (dot / norm if norm else 0)) / 2
+
+
+def _in_range(value, bounds):
+    for op, bound in bounds.items():
+        if op not in ('gt', 'gte', 'lt', 'lte'):
+            continue
+        if isinstance(value, str) != isinstance(bound, str):
+            try:
+                value, bound = float(value), float(bound)
+            except (TypeError, ValueError):
+                return False
+        if op == 'gt' and not value > bound:
+            return False
+        if op == 'gte' and not value >= bound:
+            return False
+        if op == 'lt' and not value < bound:
+            return False
+        if op == 'lte' and not value <= bound:
+            return False
+    return True
+
+
+def _filter_source(source, source_filter):
+    if source_filter is None or source_filter is True:
+        return source
+    if source_filter is False:
+        return None
+    if isinstance(source_filter, str):
+        source_filter = [source_filter]
+    includes, excludes = source_filter, []
+    if isinstance(source_filter, dict):
+        includes = source_filter.get('includes', source_filter.get('include'))
+        excludes = source_filter.get('excludes', source_filter.get('exclude'))
+    includes = includes or []
+    excludes = excludes or []
+    return {
+        k: v
+        for k, v in source.items()
+        if (not includes or any(fnmatch.fnmatch(k, p) for p in includes))
+        and not any(fnmatch.fnmatch(k, p) for p in excludes)
+    }
+
+
+class MemoryStore(object):
+    """
+    インデックスの集合。プロセス内で1つ (store) を共有する
+    """
+
+    def __init__(self):
+        self.indices = OrderedDict()
+        self.templates = OrderedDict()
+        self.lock = threading.RLock()
+        self._auto_id = itertools.count(1)
+
+    def reset(self):
+        """
+        全インデックスを消す (テストの setUp などで使う)
+        """
+        with self.lock:
+            self.indices.clear()
+            self.templates.clear()
+
+    def resolve(self, index_expression, missing_ok=False):
+        """
+        'a,b' や 'logs-*' を MemoryIndex のリストにする
+        """
+        if not index_expression or index_expression in ('_all', '*'):
+            return list(self.indices.values())
+        result = []
+        for name in index_expression.split(','):
+            if '*' in name:
+                result.extend(
+                    index
+                    for index_name, index in self.indices.items()
+                    if fnmatch.fnmatch(index_name, name)
+                )
+            elif name in self.indices:
+                result.append(self.indices[name])
+            elif not missing_ok:
+                raise MemoryBackendError(
+                    404,
+                    'index_not_found_exception',
+                    'no such index [{}]'.format(name),
+                )
+        return result
+
+    def get_or_create(self, name):
+        if name not in self.indices:
+            self.indices[name] = MemoryIndex(name, self.match_template(name))
+        return self.indices[name]
+
+    def match_template(self, name):
+        """
+        name に合うテンプレートのうち priority が一番高いものの template
+        """
+        matched = [
+            template
+            for template in self.templates.values()
+            if any(
+                fnmatch.fnmatch(name, pattern)
+                for pattern in template.get('index_patterns', ())
+            )
+        ]
+        if not matched:
+            return None
+        matched.sort(key=lambda t: t.get('priority', 0), reverse=True)
+        return matched[0].get('template')
+
+    def generate_id(self):
+        return 'memory-{}-{}'.format(int(time.time()), next(self._auto_id))
+
+
+store = MemoryStore()
+
+
+class LocalConnection(InstrumentedConnectionMixin, Connection):
+    """
+    ネットワークを使わず、respond() の結果をレスポンスとして返す Connection
+    """
+
+    def perform_request(
+        self,
+        method,
+        url,
+        params=None,
+        body=None,
+        timeout=None,
+        ignore=(),
+        headers=None,
+    ):
+        start = time.time()
+        # クエリパラメータは elasticsearch-py が bytes にしている
+        params = {
+            k: v.decode('utf-8') if isinstance(v, bytes) else v
+            for k, v in (params or {}).items()
+        }
+        status, data = self.respond(method, url, params, body)
+        raw = data if isinstance(data, str) else json.dumps(data)
+        duration = time.time() - start
+        full_url = self.host + url
+        if not (200 <= status < 300) and status not in ignore:
+            self.log_request_fail(
+                method, full_url, url, body, duration, status, raw
+            )
+            self._raise_error(status, raw)
+        self.log_request_success(
+            method, full_url, url, body, status, raw, duration
+        )
+        return status, dict(RESPONSE_HEADERS), raw
+
+    def respond(self, method, url, params, body):
+        """
+        :return: (ステータスコード, レスポンスの dict もしくは JSON 文字列)
+        """
+        raise NotImplementedError
+
+
+def split_path(url):
+    """
+    '/index/_doc/id' -> ['index', '_doc', 'id']
+    """
+    return [unquote(p) for p in url.split('?', 1)[0].split('/') if p]
+
+
+def loads_body(body):
+    if not body:
+        return {}
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return json.loads(body)
+
+
+def _iter_bulk(body):
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    lines = iter(line for line in body.splitlines() if line.strip())
+    for line in lines:
+        action = json.loads(line)
+        ((op_type, meta),) = action.items()
+        source = None
+        if op_type != 'delete':
+            source = json.loads(next(lines))
+        yield op_type, meta, source
+
+
+class MemoryConnection(LocalConnection):
+    """
+    MemoryStore に対して ES の API を実行する Connection
+    """
+
+    store = store
+
+    def respond(self, method, url, params, body):
+        parts = split_path(url)
+        with self.store.lock:
+            try:
+                return 200, self.dispatch(method, parts, params, body)
+            except MemoryBackendError as e:
+                return e.status, e.as_response()
+            except _NotFound as e:
+                return 404, e.response
+
+    def dispatch(self, method, parts, params, body):
+        if not parts:
+            return INFO_RESPONSE
+        endpoint = parts[-1]
+        if endpoint == '_bulk':
+            index = parts[0] if len(parts) > 1 else None
+            return self.bulk(index, body)
+        if endpoint == '_search':
+            index = parts[0] if len(parts) > 1 else None
+            return self.search(index, loads_body(body), params)
+        if endpoint == '_count':
+            index = parts[0] if len(parts) > 1 else None
+            return self.count(index, loads_body(body), params)
+        if endpoint == '_mget':
+            index = parts[0] if len(parts) > 1 else None
+            return self.mget(index, loads_body(body))
+        if endpoint == '_refresh':
+            return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+        if parts[0] == '_index_template' and len(parts) == 2:
+            return self.template_api(method, parts[1], loads_body(body))
+        if len(parts) == 1:
+            return self.index_api(method, parts[0], loads_body(body))
+        if len(parts) >= 2 and parts[1] in ('_doc', '_create', '_update'):
+            index, api = parts[0], parts[1]
+            doc_id = parts[2] if len(parts) > 2 else None
+            routing = params.get('routing')
+            if api == '_update':
+                return self.update(index, doc_id, loads_body(body), routing)
+            if method == 'GET' or method == 'HEAD':
+                return self.get(index, doc_id, routing)
+            if method == 'DELETE':
+                return self.delete(index, doc_id, routing)
+            return self.put(
+                index,
+                doc_id,
+                loads_body(body),
+                create=(api == '_create' or params.get('op_type') == 'create'),
+                routing=routing,
+            )
+        raise MemoryBackendError(
+            400,
+            'illegal_argument_exception',
+            'unsupported path /{} (memory backend)'.format('/'.join(parts)),
+        )
+
+    # ---- index APIs
+
+    def index_api(self, method, name, body):
+        if method == 'HEAD':
+            if name not in self.store.indices:
+                raise _NotFound({})
+            return {}
+        if method == 'PUT':
+            if name in self.store.indices:
+                raise MemoryBackendError(
+                    400,
+                    'resource_already_exists_exception',
+                    'index [{}] already exists'.format(name),
+                )
+            self.store.indices[name] = MemoryIndex(name, body)
+            return {
+                'acknowledged': True,
+                'shards_acknowledged': True,
+                'index': name,
+            }
+        if method == 'DELETE':
+            for index in self.store.resolve(name):
+                del self.store.indices[index.name]
+            return {'acknowledged': True}
+        if method == 'GET':
+            return {
+                index.name: {
+                    'mappings': {'properties': index.properties},
+                    'settings': index.settings,
+                }
+                for index in self.store.resolve(name)
+            }
+        raise MemoryBackendError(
+            405, 'method_not_allowed', 'unsupported method {}'.format(method)
+        )
+
+    def template_api(self, method, name, body):
+        templates = self.store.templates
+        if method == 'PUT':
+            templates[name] = body
+            return {'acknowledged': True}
+        if name not in templates:
+            raise MemoryBackendError(
+                404,
+                'resource_not_found_exception',
+                'index template matching [{}] not found'.format(name),
+            )
+        if method == 'HEAD':
+            return {}
+        if method == 'DELETE':
+            del templates[name]
+            return {'acknowledged': True}
+        if method == 'GET':
+            return {
+                'index_templates': [
+                    {'name': name, 'index_template': templates[name]}
+                ]
+            }
+        raise MemoryBackendError(
+            405, 'method_not_allowed', 'unsupported method {}'.format(method)
+        )
+
+    # ---- document APIs
+
+    def _write_result(self, index, doc_id, result):
+        return {
+            '_index': index.name,
+            '_type': '_doc',
+            '_id': doc_id,
+            '_version': index.versions.get(doc_id, 1),
+            'result': result,
+            '_seq_no': index.seq_no,
+            '_primary_term': 1,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+        }
+
+    def _check_routing(self, index, doc_id, routing):
+        if routing is None and index.routing_required:
+            raise MemoryBackendError(
+                400,
+                'routing_missing_exception',
+                'routing is required for [{}]/[{}]'.format(index.name, doc_id),
+            )
+
+    def put(self, index_name, doc_id, source, create=False, routing=None):
+        index = self.store.get_or_create(index_name)
+        self._check_routing(index, doc_id, routing)
+        doc_id = (
+            str(doc_id) if doc_id is not None else self.store.generate_id()
+        )
+        if create and doc_id in index.docs:
+            raise MemoryBackendError(
+                409,
+                'version_conflict_engine_exception',
+                '[{}]: version conflict, document already exists'.format(
+                    doc_id
+                ),
+            )
+        created = index.put(doc_id, source)
+        return self._write_result(
+            index, doc_id, 'created' if created else 'updated'
+        )
+
+    def update(self, index_name, doc_id, body, routing=None):
+        index = self.store.get_or_create(index_name)
+        self._check_routing(index, doc_id, routing)
+        doc_id = str(doc_id)
+        if doc_id in index.docs:
+            source = copy.deepcopy(index.docs[doc_id])
+            _merge(source, body.get('doc', {}))
+        elif body.get('doc_as_upsert'):
+            source = body.get('doc', {})
+        elif 'upsert' in body:
+            source = body['upsert']
+        else:
+            raise MemoryBackendError(
+                404,
+                'document_missing_exception',
+                '[_doc][{}]: document missing'.format(doc_id),
+            )
+        index.put(doc_id, source)
+        return self._write_result(index, doc_id, 'updated')
+
+    def get(self, index_name, doc_id, routing=None):
+        index = self.store.resolve(index_name)[0]
+        self._check_routing(index, doc_id, routing)
+        if doc_id not in index.docs:
+            raise _NotFound(
+                {
+                    '_index': index.name,
+                    '_type': '_doc',
+                    '_id': doc_id,
+                    'found': False,
+                }
+            )
+        hit = index.hit(doc_id)
+        hit.update(
+            {
+                '_version': index.versions[doc_id],
+                '_seq_no': index.seq_no,
+                '_primary_term': 1,
+                'found': True,
+            }
+        )
+        return hit
+
+    def delete(self, index_name, doc_id, routing=None):
+        index = self.store.resolve(index_name)[0]
+        self._check_routing(index, doc_id, routing)
+        if not index.remove(doc_id):
+            result = self._write_result(index, doc_id, 'not_found')
+            raise _NotFound(result)
+        return self._write_result(index, doc_id, 'deleted')
+
+    def mget(self, index_name, body):
+        docs = body.get('docs')
+        if docs is None:
+            docs = [{'_id': doc_id} for doc_id in body.get('ids', ())]
+        result = []
+        for doc in docs:
+            name = doc.get('_index', index_name)
+            doc_id = str(doc['_id'])
+            index = self.store.indices.get(name)
+            if index is None or doc_id not in index.docs:
+                result.append(
+                    {
+                        '_index': name,
+                        '_type': '_doc',
+                        '_id': doc_id,
+                        'found': False,
+                    }
+                )
+                continue
+            hit = index.hit(doc_id, source_filter=doc.get('_source'))
+            hit.pop('_score')
+            hit.update({'_version': index.versions[doc_id], 'found': True})
+            result.append(hit)
+        return {'docs': result}
+
+    def bulk(self, index_name, body):
+        start = time.time()
+        items = []
+        errors = False
+        for op_type, meta, source in _iter_bulk(body):
+            name = meta.get('_index', index_name)
+            doc_id = meta.get('_id')
+            routing = meta.get('routing')
+            try:
+                if op_type == 'delete':
+                    response = self.delete(name, str(doc_id), routing)
+                    status = 200
+                elif op_type == 'update':
+                    response = self.update(name, doc_id, source, routing)
+                    status = 200
+                else:
+                    response = self.put(
+                        name,
+                        doc_id,
+                        source,
+                        create=(op_type == 'create'),
+                        routing=routing,
+                    )
+                    status = 201 if response['result'] == 'created' else 200
+                response['status'] = status
+            except MemoryBackendError as e:
+                errors = True
+                response = {
+                    '_index': name,
+                    '_type': '_doc',
+                    '_id': doc_id,
+                    'status': e.status,
+                    'error': {'type': e.error_type, 'reason': e.reason},
+                }
+            except _NotFound as e:
+                response = dict(e.response, status=404)
+            items.append({op_type: response})
+        return {
+            'took': int((time.time() - start) * 1000),
+            'errors': errors,
+            'items': items,
+        }
+
+    # ---- search APIs
+
+    def _matching(self, index_name, body, params):
+        indices = self.store.resolve(
+            index_name,
+            missing_ok=params.get('ignore_unavailable') == 'true',
+        )
+        query = body.get('query')
+        knn = body.get('knn')
+        for index in indices:
+            if knn:
+                # query もあれば、両方のスコアの合計 (どちらかに合うもの)
+                scores = {}
+                for knn_params in knn if isinstance(knn, list) else [knn]:
+                    for doc_id, score in index.knn(knn_params).items():
+                        scores[doc_id] = scores.get(doc_id, 0) + score
+                if query:
+                    for doc_id, score in index.execute(query).items():
+                        scores[doc_id] = scores.get(doc_id, 0) + score
+            else:
+                scores = index.execute(query)
+            for doc_id, score in scores.items():
+                yield index, doc_id, score
+
+    def search(self, index_name, body, params):
+        start = time.time()
+        matches = list(self._matching(index_name, body, params))
+
+        sort_spec = body.get('sort')
+        if sort_spec:
+            keys = {}
+            for index in {index for index, _, _ in matches}:
+                scores = {d: s for i, d, s in matches if i is index}
+                keys[index.name] = index.sort_key(sort_spec, scores)
+            matches.sort(key=lambda m: keys[m[0].name](m[1]))
+        else:
+            matches.sort(key=lambda m: -m[2])
+
+        offset = int(body.get('from', params.get('from', 0)))
+        size = int(body.get('size', params.get('size', 10)))
+        source_filter = body.get('_source', params.get('_source'))
+        hits = []
+        for index, doc_id, score in matches[offset : offset + size]:
+            hit = index.hit(
+                doc_id,
+                score=None if sort_spec else score,
+                source_filter=source_filter,
+            )
+            hits.append(hit)
+
+        max_score = max((m[2] for m in matches), default=None)
+        response = {
+            'took': int((time.time() - start) * 1000),
+            'timed_out': False,
+            '_shards': {
+                'total': 1,
+                'successful': 1,
+                'skipped': 0,
+                'failed': 0,
+            },
+            'hits': {
+                'total': {'value': len(matches), 'relation': 'eq'},
+                'max_score': None if sort_spec else max_score,
+                'hits': hits,
+            },
+        }
+        aggs = body.get('aggs', body.get('aggregations'))
+        if aggs:
+            response['aggregations'] = _aggregate(
+                aggs, [(index, doc_id) for index, doc_id, _ in matches]
+            )
+        return response
+
+    def count(self, index_name, body, params):
+        return {
+            'count': sum(1 for _ in self._matching(index_name, body, params)),
+            '_shards': {
+                'total': 1,
+                'successful': 1,
+                'skipped': 0,
+                'failed': 0,
+            },
+        }
+
+
+# ---- aggregations
+# matches は (MemoryIndex, ドキュメントID) のリスト
+
+
+def _aggregate(aggs, matches):
+    result = {}
+    for name, spec in aggs.items():
+        sub_aggs = spec.get('aggs', spec.get('aggregations')) or {}
+        (agg_type,) = [
+            k for k in spec if k not in ('aggs', 'aggregations', 'meta')
+        ]
+        func = _AGGREGATIONS.get(agg_type)
+        if func is None:
+            raise MemoryBackendError(
+                400,
+                'parsing_exception',
+                'unknown aggregation [{}] (memory backend)'.format(agg_type),
+            )
+        result[name] = func(spec[agg_type], matches, sub_aggs)
+    return result
+
+
+def _agg_field_values(matches, field):
+    for index, doc_id in matches:
+        yield from index.doc_values[doc_id].get(field, ())
+
+
+def _agg_bucket(key, matches, sub_aggs):
+    bucket = {'key': key, 'doc_count': len(matches)}
+    bucket.update(_aggregate(sub_aggs, matches))
+    return bucket
+
+
+def _agg_bucket_value(bucket, path):
+    """
+    terms の order のキー ('_count', '_key', 'sub_agg', 'sub_agg.value',
+    'filter_agg>sub_agg' など) の、バケットでの値
+    """
+    if path == '_count':
+        return bucket['doc_count']
+    if path == '_key':
+        return bucket['key']
+    path, _dot, metric = path.partition('.')
+    value = bucket
+    for name in path.split('>'):
+        value = value[name]
+    if metric:
+        return value[metric]
+    return value['value'] if 'value' in value else value['doc_count']
+
+
+def _agg_terms(params, matches, sub_aggs):
+    groups = defaultdict(list)
+    for index, doc_id in matches:
+        for value in set(index.doc_values[doc_id].get(params['field'], ())):
+            groups[value].append((index, doc_id))
+    # order がサブ集計を参照しうるので、全バケットを集計してから並べる
+    buckets = [_agg_bucket(k, v, sub_aggs) for k, v in groups.items()]
+    order = params.get('order', {'_count': 'desc'})
+    order = order if isinstance(order, list) else [order]
+    order = [item for spec in order for item in spec.items()]
+    # 同じ値なら ES と同じくキーの昇順
+    order.append(('_key', 'asc'))
+
+    def _key(bucket):
+        key = []
+        for path, direction in order:
+            value = _agg_bucket_value(bucket, path)
+            # 値の無いもの (空バケットの min など) は最後
+            missing = value is None
+            value = _compare_key(value)
+            key.append(
+                (missing, _Reversed(value) if direction == 'desc' else value)
+            )
+        return key
+
+    buckets.sort(key=_key)
+    size = int(params.get('size', 10))
+    return {
+        'doc_count_error_upper_bound': 0,
+        'sum_other_doc_count': sum(b['doc_count'] for b in buckets[size:]),
+        'buckets': buckets[:size],
+    }
+
+
+def _agg_composite(params, matches, sub_aggs):
+    sources = []
+    for source in params['sources']:
+        ((name, spec),) = source.items()
+        ((source_type, source_params),) = spec.items()
+        if source_type != 'terms':
+            raise MemoryBackendError(
+                400,
+                'parsing_exception',
+                'unknown composite source [{}] (memory backend)'.format(
+                    source_type
+                ),
+            )
+        sources.append((name, source_params))
+
+    groups = defaultdict(list)
+    for index, doc_id in matches:
+        values = index.doc_values[doc_id]
+        per_source = [set(values.get(p['field'], ())) for _, p in sources]
+        # 値の無いソースがあるドキュメントはどのバケットにも入らない
+        for key in itertools.product(*per_source):
+            groups[key].append((index, doc_id))
+
+    def _sort_key(key):
+        return tuple(
+            (
+                _Reversed(_compare_key(v))
+                if p.get('order') == 'desc'
+                else _compare_key(v)
+            )
+            for v, (_, p) in zip(key, sources)
+        )
+
+    keys = sorted(groups, key=_sort_key)
+    after = params.get('after')
+    if after:
+        after_key = _sort_key(tuple(after[name] for name, _ in sources))
+        keys = [k for k in keys if after_key < _sort_key(k)]
+    buckets = [
+        dict(
+            _agg_bucket(None, groups[k], sub_aggs),
+            key=OrderedDict(zip([name for name, _ in sources], k)),
+        )
+        for k in keys[: int(params.get('size', 10))]
+    ]
+    result = {'buckets': buckets}
+    if buckets:
+        result['after_key'] = buckets[-1]['key']
+    return result
+
+
+def _agg_filter(params, matches, sub_aggs):
+    scores = {}
+    filtered = []
+    for index, doc_id in matches:
+        if index.name not in scores:
+            scores[index.name] = index.execute(params)
+        if doc_id in scores[index.name]:
+            filtered.append((index, doc_id))
+    bucket = _agg_bucket(None, filtered, sub_aggs)
+    del bucket['key']
+    return bucket
+
+
+def _agg_metric(func, empty=None):
+    def _agg(params, matches, sub_aggs):
+        values = [
+            v
+            for v in _agg_field_values(matches, params['field'])
+            if isinstance(v, (int, float))
+        ]
+        return {'value': float(func(values)) if values else empty}
+
+    return _agg
+
+
+def _agg_top_hits(params, matches, sub_aggs):
+    """
+    集計では検索のスコアを持ち回っていないので、スコアは全部 1.0
+    """
+    matches = list(matches)
+    sort_spec = params.get('sort')
+    if sort_spec:
+        keys = {}
+        scores = defaultdict(lambda: 1.0)
+        for index, _doc_id in matches:
+            if index.name not in keys:
+                keys[index.name] = index.sort_key(sort_spec, scores)
+        matches.sort(key=lambda m: keys[m[0].name](m[1]))
+    offset = int(params.get('from', 0))
+    size = int(params.get('size', 3))
+    score = None if sort_spec else 1.0
+    return {
+        'hits': {
+            'total': {'value': len(matches), 'relation': 'eq'},
+            'max_score': score if matches else None,
+            'hits': [
+                index.hit(
+                    doc_id, score=score, source_filter=params.get('_source')
+                )
+                for index, doc_id in matches[offset : offset + size]
+            ],
+        }
+    }
+
+
+_AGGREGATIONS = {
+    'terms': _agg_terms,
+    'composite': _agg_composite,
+    'filter': _agg_filter,
+    'value_count': lambda params, matches, sub_aggs: {
+        'value': sum(1 for _ in _agg_field_values(matches, params['field']))
+    },
+    'cardinality': lambda params, matches, sub_aggs: {
+        'value': len(set(_agg_field_values(matches, params['field'])))
+    },
+    'min': _agg_metric(min),
+    'max': _agg_metric(max),
+    'sum': _agg_metric(sum, empty=0.0),
+    'avg': _agg_metric(lambda values: sum(values) / len(values)),
+    'top_hits': _agg_top_hits,
+}
+
+
+class _NotFound(Exception):
+    """
+    found: false などの 404 レスポンス (エラーの形式ではないもの)
+    """
+
+    def __init__(self, response):
+        super().__init__(response)
+        self.response = response
+
+
+def _merge(target, doc):
+    for key, value in doc.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
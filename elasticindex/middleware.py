@@ -0,0 +1,34 @@
+import logging
+
+from .instrumentation import collect
+
+logger = logging.getLogger('elasticindex')
+
+
+class QueryCollectorMiddleware(object):
+    """
+    リクエストごとに Elasticsearch の呼び出しを集計するミドルウェア
+
+    request.elasticindex_queries に QueryCollector が付くので、
+    ビューや debug-toolbar のパネルから summary() を参照できる。
+    集計結果は logger 'elasticindex' に DEBUG で出す。
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with collect() as collector:
+            request.elasticindex_queries = collector
+            response = self.get_response(request)
+        if collector.count and logger.isEnabledFor(logging.DEBUG):
+            summary = collector.summary()
+            logger.debug(
+                '{} {}: {} queries, {:.1f}ms'.format(
+                    request.method,
+                    request.path,
+                    summary['count'],
+                    summary['time_ms'],
+                )
+            )
+        return response
@@ -3,11 +3,24 @@ Elasticsearch を Django のモデルっぽく使うクラス
 """
 
 import logging
+import time
 from collections import OrderedDict
 
-from .client import DEFAULT_TIMEOUT, get_es_client
+from .bulk import BulkWriter
+from .client import DEFAULT_TIMEOUT, READ, WRITE, get_es_client
 from .fields import ElasticDocumentField
+from .instrumentation import instrument
 from .managers import ElasticDocumentMeta
+from .partitions import (
+    DAILY,
+    MONTHLY,
+    ROLLOVER,
+    get_partition_name,
+    get_search_index,
+    parse_partition_name,
+)
+from .progress import RebuildStats
+from .serializers import dumps_bulk_body, dumps_bytes
 
 logger = logging.getLogger('elasticindex')
 
@@ -26,6 +39,28 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
 
     source_model = None  # インデックス生成元モデル
 
+    # True なら mappings に _routing: required を付ける。
+    # 書き込み・get 時にルーティングの指定が必須になる
+    ROUTING_REQUIRED = False
+
+    # スロークエリの閾値(ミリ秒)。None なら settings.ELASTICINDEX_SLOW_QUERY_MS
+    SLOW_QUERY_MS = None
+    # スロークエリを profile 付きで再実行する割合 (0 〜 1)
+    # None なら settings.ELASTICINDEX_SLOW_QUERY_PROFILE_RATE
+    SLOW_QUERY_PROFILE_RATE = None
+
+    # このドキュメントだけ接続先を変える場合に指定する。
+    # None なら settings.ELASTICINDEX_READ_HOSTS / ELASTICINDEX_WRITE_HOSTS
+    READ_HOSTS = None
+    WRITE_HOSTS = None
+
+    # 時間でインデックスを分ける場合に指定する (elasticindex.partitions)
+    # 'daily' / 'monthly': PARTITION_FIELD の日時で INDEX-2026.10.19 などに分ける
+    # 'rollover': INDEX をエイリアスにして、ROLLOVER_CONDITIONS で増やす
+    PARTITION = None
+    PARTITION_FIELD = None
+    ROLLOVER_CONDITIONS = {'max_size': '50gb'}
+
     timeout = DEFAULT_TIMEOUT
 
     class DoesNotExist(Exception):
@@ -35,8 +70,14 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
         pass
 
     @classmethod
-    def get_es_client(cls, *, timeout=None):
-        return get_es_client(timeout=timeout or cls.timeout)
+    def get_es_client(cls, *, timeout=None, role=None):
+        """
+        :param role: READ (検索) か WRITE (書き込み・インデックス操作)
+        """
+        hosts = {READ: cls.READ_HOSTS, WRITE: cls.WRITE_HOSTS}.get(role)
+        return get_es_client(
+            timeout=timeout or cls.timeout, role=role, hosts=hosts
+        )
 
     @classmethod
     def _fields(cls):
@@ -80,6 +121,8 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
         filtering_func=None,
         bulk_size=1000,
         timeout=None,
+        progress_callback=None,
+        total=None,
         **kwargs,
     ):
         """
@@ -87,43 +130,84 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
         :param limit:
         :param offset:
         :param filtering_func:
-        :return:
+        :param progress_callback: 送信のたびに RebuildStats を渡して呼ぶ
+        :param total: 行数の見積もり (ETA 用)。None で progress_callback が
+            指定されていれば、クエリセットの count() を使う
+        :return: フェーズごとの時間や件数
+        :rtype: RebuildStats
         """
-        client = cls.get_es_client(timeout=timeout)
+        client = cls.get_es_client(timeout=timeout, role=WRITE)
+        serializer = client.transport.serializer
         qs = cls.source_model.objects.all()
         if filtering_func is not None:
             qs = filtering_func(qs)
         if offset:
-            qs = qs[offset : offset + limit]
+            if limit is not None:
+                qs = qs[offset : offset + limit]
+            else:
+                qs = qs[offset:]
         elif limit:
             qs = qs[:limit]
 
+        if total is None and progress_callback is not None:
+            total = qs.count()
+        stats = RebuildStats(cls.INDEX, total=total)
+
+        def _record(docs, size, start, result):
+            stats.record_request(
+                docs, size, time.perf_counter() - start, result
+            )
+            logger.debug(stats.format_progress())
+            if progress_callback is not None:
+                progress_callback(stats)
+
         if not bulk_size:
             # non bulk mode
             logger.debug('No bulk mode.')
-            for source_model in qs:
+            for source_model in stats.iterate(qs):
                 logger.debug('source_model: {}'.format(source_model))
-                client.index(
-                    cls.INDEX,
-                    cls.data_dict_for_index(source_model),
-                    id=cls.get_id_of_source_model(source_model),
-                    **kwargs,
-                )
-            return
+                with stats.phase('build'):
+                    data_dict = cls.data_dict_for_index(source_model)
+                    routing = cls.get_routing_of_source_model(source_model)
+                # kwargs は全行で共有なので、行ごとの params にする
+                params = dict(kwargs)
+                if routing is not None:
+                    params['routing'] = routing
+                stats.docs_built += 1
+                with stats.phase('serialize'):
+                    body = dumps_bytes(serializer, data_dict)
+                start = time.perf_counter()
+                with instrument('index', cls.INDEX):
+                    result = client.index(
+                        cls.get_index_for_write(data_dict),
+                        body,
+                        id=cls.get_id_of_source_model(source_model),
+                        **params,
+                    )
+                _record(1, len(body), start, result)
+            stats.finish()
+            return stats
 
         # bulk update
         def _get_bulk_body(qs):
             bulk_body = []
-            for source_model in qs:
+            for source_model in stats.iterate(qs):
                 logger.debug('source_model: {}'.format(source_model))
-                bulk_body.append(
-                    {
-                        'index': {
-                            "_id": cls.get_id_of_source_model(source_model)
+                with stats.phase('build'):
+                    data_dict = cls.data_dict_for_index(source_model)
+                    bulk_body.append(
+                        {
+                            'index': cls.bulk_action_meta(
+                                cls.get_id_of_source_model(source_model),
+                                routing=cls.get_routing_of_source_model(
+                                    source_model
+                                ),
+                                index=cls.get_index_for_write(data_dict),
+                            )
                         }
-                    }
-                )
-                bulk_body.append(cls.data_dict_for_index(source_model))
+                    )
+                    bulk_body.append(data_dict)
+                stats.docs_built += 1
                 if len(bulk_body) > bulk_size:
                     yield bulk_body
                     bulk_body = []
@@ -131,9 +215,15 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
                 yield bulk_body
 
         for bulk_body in _get_bulk_body(qs):
-            logger.debug('bulk updating.')
-            # logger.debug('{}'.format(bulk_body))
-            client.bulk(bulk_body, index=cls.INDEX, **kwargs)
+            with stats.phase('serialize'):
+                body = dumps_bulk_body(serializer, bulk_body)
+            start = time.perf_counter()
+            with instrument('bulk', cls.INDEX) as event:
+                result = client.bulk(body, index=cls.INDEX, **kwargs)
+                event.set_result(result)
+            _record(len(bulk_body) // 2, len(body), start, result)
+        stats.finish()
+        return stats
 
     @classmethod
     def update_bulk(cls, bulk_body, timeout=None, **kwargs):
@@ -141,8 +231,29 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
         バルク更新
         :type bulk_body: list
         """
-        client = cls.get_es_client(timeout=timeout)
-        client.bulk(bulk_body, index=cls.INDEX, **kwargs)
+        client = cls.get_es_client(timeout=timeout, role=WRITE)
+        if isinstance(bulk_body, (list, tuple)):
+            # elasticsearch-py の join は str 前提なので、ここで bytes にする
+            bulk_body = dumps_bulk_body(client.transport.serializer, bulk_body)
+        with instrument('bulk', cls.INDEX) as event:
+            event.set_result(client.bulk(bulk_body, index=cls.INDEX, **kwargs))
+
+    @classmethod
+    def bulk_writer(
+        cls, max_docs=1000, max_bytes=5000000, flush_interval=2.0, **kwargs
+    ):
+        """
+        バッファリングして bulk 送信するライター
+        with Doc.bulk_writer() as w: w.index(source_model) のように使う
+        :rtype: BulkWriter
+        """
+        return BulkWriter(
+            cls,
+            max_docs=max_docs,
+            max_bytes=max_bytes,
+            flush_interval=flush_interval,
+            **kwargs,
+        )
 
     @classmethod
     def update(cls, id, data_dict, timeout=None, **kwargs):
@@ -152,8 +263,11 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
         通常はこれは使わず、rebuild_index もしくは rebuild_index_by_source_model を使う
         :type data_dict: dict
         """
-        client = cls.get_es_client(timeout=timeout)
-        client.index(cls.INDEX, data_dict, id=id, **kwargs)
+        client = cls.get_es_client(timeout=timeout, role=WRITE)
+        with instrument('index', cls.INDEX):
+            client.index(
+                cls.get_index_for_write(data_dict), data_dict, id=id, **kwargs
+            )
 
     @classmethod
     def rebuild_index_by_source_model(cls, source_model, **kwargs):
@@ -162,6 +276,9 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
         :param source_model:
         :return:
         """
+        routing = cls.get_routing_of_source_model(source_model)
+        if routing is not None:
+            kwargs['routing'] = routing
         cls.update(
             cls.get_id_of_source_model(source_model),
             cls.data_dict_for_index(source_model),
@@ -181,9 +298,92 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
     def get_id_of_source_model(self, source_model):
         return source_model.pk
 
-    def __init__(self, es_result):
+    @classmethod
+    def get_source_model_pk(cls, es_id):
+        """
+        get_id_of_source_model の逆。ドキュメントIDから元モデルの pk を得る
+        get_id_of_source_model をオーバーライドした場合は、これも合わせる
+        """
+        return cls.source_model._meta.pk.to_python(es_id)
+
+    @classmethod
+    def get_routing_of_source_model(cls, source_model):
+        """
+        ドキュメントのルーティング値。None なら ES のデフォルト (_id)
+        テナントごとに同じシャードに入れたい場合などにオーバーライドする
+        """
+        return None
+
+    @classmethod
+    def bulk_action_meta(cls, id, routing=None, index=None):
+        """
+        bulk のアクション行 ({"index": ...} の中身) を作る
+        :param index: INDEX 以外 (パーティション) に書き込む場合のインデックス名
+        """
+        meta = {"_id": id}
+        if index is not None and index != cls.INDEX:
+            meta["_index"] = index
+        if routing is not None:
+            meta["routing"] = routing
+        return meta
+
+    @classmethod
+    def get_index_for_write(cls, data_dict):
+        """
+        data_dict を書き込むインデックス名
+        PARTITION が 'daily' / 'monthly' なら PARTITION_FIELD の値のパーティション
+        """
+        if cls.PARTITION not in (DAILY, MONTHLY):
+            # 'rollover' なら INDEX は書き込み用のエイリアス
+            return cls.INDEX
+        value = data_dict.get(cls.PARTITION_FIELD)
+        if value is None:
+            raise ValueError(
+                '{} is required to choose a partition of {}.'.format(
+                    cls.PARTITION_FIELD, cls.INDEX
+                )
+            )
+        return get_partition_name(cls.INDEX, cls.PARTITION, value)
+
+    @classmethod
+    def get_index_for_search(cls, query=None):
+        """
+        query で検索するインデックス名
+        PARTITION が 'daily' / 'monthly' なら、query の PARTITION_FIELD の
+        range に重なるパーティションだけにする
+        """
+        if cls.PARTITION not in (DAILY, MONTHLY):
+            return cls.INDEX
+        return get_search_index(
+            cls.INDEX, cls.PARTITION, query, cls.PARTITION_FIELD
+        )
+
+    @classmethod
+    def owns_index(cls, index_name):
+        """
+        検索結果の _index が、このドキュメントのインデックスか
+        INDEX を別のインデックスのエイリアスにしている場合はオーバーライドする
+        """
+        if index_name == cls.INDEX:
+            return True
+        if cls.PARTITION in (DAILY, MONTHLY):
+            return (
+                parse_partition_name(cls.INDEX, cls.PARTITION, index_name)
+                is not None
+            )
+        if cls.PARTITION == ROLLOVER:
+            prefix = '{}-'.format(cls.INDEX)
+            return (
+                index_name.startswith(prefix)
+                and index_name[len(prefix) :].isdigit()
+            )
+        return False
+
+    def __init__(self, es_result, only=None):
         """
         ES検索結果からインスタンスを起こす
+        :param only: _source を絞って検索した場合の、取得したフィールド名
+            それ以外のフィールドは None (default があれば default) にする
         """
         self.es_result = es_result
         self.es_id = es_result['_id']
@@ -195,6 +395,9 @@ class ElasticDocument(object, metaclass=ElasticDocumentMeta):  # flake8: NOQA
                 if field.has_default_value():
                     setattr(self, field_name, field.default)
                     continue
+                if only is not None and field_name not in only:
+                    setattr(self, field_name, None)
+                    continue
                 raise self.ResultKeyError(field_name)
             value = field.get_value_from_index_source_value(
                 es_source[field_name]
@@ -0,0 +1,373 @@
+"""
+時間で分割したインデックス (パーティション) の名前の計算
+
+ElasticDocument.PARTITION が 'daily' / 'monthly' の場合、
+物理インデックスは INDEX + '-2026.10.19' / INDEX + '-2026.10' になる。
+PARTITION_FIELD の値で書き込み先を決め、検索時は query の中の
+PARTITION_FIELD の range から、対象になるパーティションだけに絞る。
+
+'rollover' の場合は INDEX がエイリアスになり、物理インデックスは
+INDEX + '-000001' から ES の rollover API で増えていく。
+"""
+
+import datetime
+import re
+import zoneinfo
+
+DAILY = 'daily'
+MONTHLY = 'monthly'
+ROLLOVER = 'rollover'
+
+SUFFIX_FORMATS = {
+    DAILY: '%Y.%m.%d',
+    MONTHLY: '%Y.%m',
+}
+# 接尾辞の桁ごとにありうる最大の数字 (月の10の位は1, 日の10の位は3)
+_SUFFIX_MAX_DIGITS = {
+    DAILY: '2999.19.39',
+    MONTHLY: '2999.19',
+}
+
+# 検索対象のパーティション名をこの数より多く並べない。
+# 超える場合は月単位のワイルドカードにし、それでも超えれば全パーティション
+MAX_PARTITION_NAMES = 100
+# URL に並べるインデックス名の合計の長さの上限。
+# ES の http.max_initial_line_length (デフォルト 4KB) に、
+# パスの残りとクエリパラメータの分の余裕を持たせる
+MAX_INDEX_EXPRESSION_LENGTH = 3000
+# get_pattern (INDEX-2*) にマッチするパーティションの範囲。
+# これより前・後の日時のドキュメントは書き込まない
+MIN_PARTITION_DATETIME = datetime.datetime(
+    2000, 1, 1, tzinfo=datetime.timezone.utc
+)
+MAX_PARTITION_DATETIME = datetime.datetime(
+    3000, 1, 1, tzinfo=datetime.timezone.utc
+)
+
+_DATE_MATH_RE = re.compile(r'([+-])(\d+)([yMwdhHms])')
+_OFFSET_RE = re.compile(r'([+-])(\d{1,2}):?(\d{2})?')
+_UNIT_SECONDS = {
+    'w': 604800,
+    'd': 86400,
+    'h': 3600,
+    'H': 3600,
+    'm': 60,
+    's': 1,
+}
+_ROUNDING_UNITS = set(_UNIT_SECONDS) | {'y', 'M'}
+# 絞り込みに使える range のキー。format などがあれば絞り込まない
+_RANGE_KEYS = {'gte', 'gt', 'lte', 'lt', 'time_zone', 'boost'}
+
+
+def get_pattern(index, granularity):
+    """
+    全パーティションにマッチするインデックス名
+    INDEX-* だと INDEX-archive のような別のインデックスにもマッチするので、
+    日付 (2026.10.19) や連番 (000001) の先頭の文字まで含める。
+    それでもマッチしうるので、名前は parse_partition_name などで確かめること。
+    """
+    if granularity == ROLLOVER:
+        return '{}-0*'.format(index)
+    return '{}-2*'.format(index)
+
+
+def to_datetime(value, time_zone=None, round_up=False):
+    """
+    ドキュメントや range クエリの日時を UTC の aware な datetime にする
+    datetime, date, ISO8601 の文字列, epoch ミリ秒, now の日付計算 に対応。
+    :param time_zone: タイムゾーンの無い日時と、now の丸めに使う tzinfo
+        (range クエリの time_zone)。None なら UTC
+    :param round_up: range の lte として使う。now/d などの丸めと
+        時刻の無い日付を、その単位の終わりにする
+    """
+    time_zone = time_zone or datetime.timezone.utc
+    if isinstance(value, datetime.datetime):
+        dt = value
+    elif isinstance(value, datetime.date):
+        dt = datetime.datetime(value.year, value.month, value.day)
+    elif isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(
+            value / 1000, datetime.timezone.utc
+        )
+    elif isinstance(value, str):
+        if value.startswith('now'):
+            return _parse_date_math(value, time_zone, round_up)
+        dt = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if round_up and len(value) == 10:
+            # 時刻の無い日付は、ES と同じくその日の終わりまでを含める
+            dt = _round(dt, 'd', round_up=True)
+    else:
+        raise ValueError('Unsupported datetime value: {!r}'.format(value))
+    if dt.tzinfo is None:
+        # ES と同じく、タイムゾーンの無いものは time_zone (デフォルト UTC)
+        dt = dt.replace(tzinfo=time_zone)
+    return dt.astimezone(datetime.timezone.utc)
+
+
+def parse_time_zone(value):
+    """
+    range クエリの time_zone ('+09:00', 'Asia/Tokyo' など) を tzinfo にする
+    """
+    if value is None or value in ('Z', 'UTC'):
+        return datetime.timezone.utc
+    match = _OFFSET_RE.fullmatch(value)
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = datetime.timedelta(
+            hours=int(hours), minutes=int(minutes or 0)
+        )
+        return datetime.timezone(-offset if sign == '-' else offset)
+    try:
+        return zoneinfo.ZoneInfo(value)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValueError('Unsupported time_zone: {}'.format(value))
+
+
+def _add_months(dt, months):
+    month = dt.month - 1 + months
+    year = dt.year + month // 12
+    month = month % 12 + 1
+    return dt.replace(year=year, month=month, day=1)
+
+
+def _round(dt, unit, round_up=False):
+    """
+    日付計算の丸め (/d など)。round_up なら単位の終わり (次の単位の直前)
+    """
+    dt = dt.replace(microsecond=0)
+    if unit in ('y', 'M', 'w', 'd', 'h', 'H', 'm'):
+        dt = dt.replace(second=0)
+    if unit in ('y', 'M', 'w', 'd', 'h', 'H'):
+        dt = dt.replace(minute=0)
+    if unit in ('y', 'M', 'w', 'd'):
+        dt = dt.replace(hour=0)
+    if unit == 'w':
+        dt -= datetime.timedelta(days=dt.weekday())
+    if unit in ('y', 'M'):
+        dt = dt.replace(day=1)
+    if unit == 'y':
+        dt = dt.replace(month=1)
+    if not round_up:
+        return dt
+    if unit in ('y', 'M'):
+        dt = _add_months(dt, 12 if unit == 'y' else 1)
+    else:
+        dt += datetime.timedelta(seconds=_UNIT_SECONDS[unit])
+    return dt - datetime.timedelta(microseconds=1)
+
+
+def _parse_date_math(value, time_zone, round_up):
+    """
+    'now', 'now-7d', 'now-1M/d' など
+    計算と丸めは time_zone で行う
+    """
+    expression, _slash, rounding = value[len('now') :].partition('/')
+    if _slash and rounding not in _ROUNDING_UNITS:
+        raise ValueError('Unsupported date math: {}'.format(value))
+    dt = datetime.datetime.now(time_zone)
+    position = 0
+    for match in _DATE_MATH_RE.finditer(expression):
+        if match.start() != position:
+            break
+        position = match.end()
+        sign, amount, unit = match.groups()
+        amount = int(amount) * (-1 if sign == '-' else 1)
+        if unit in ('y', 'M'):
+            day = dt.day
+            dt = _add_months(dt, amount * 12 if unit == 'y' else amount)
+            # 月末を超えないように
+            while True:
+                try:
+                    dt = dt.replace(day=day)
+                    break
+                except ValueError:
+                    day -= 1
+        else:
+            dt += datetime.timedelta(seconds=amount * _UNIT_SECONDS[unit])
+    if position != len(expression):
+        raise ValueError('Unsupported date math: {}'.format(value))
+    if rounding:
+        dt = _round(dt, rounding, round_up=round_up)
+    return dt.astimezone(datetime.timezone.utc)
+
+
+def truncate(dt, granularity):
+    """
+    dt を含むパーティションの開始日時
+    """
+    dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == MONTHLY:
+        dt = dt.replace(day=1)
+    return dt
+
+
+def next_start(start, granularity):
+    if granularity == MONTHLY:
+        return _add_months(start, 1)
+    return start + datetime.timedelta(days=1)
+
+
+def get_partition_name(index, granularity, value):
+    """
+    日時 value のドキュメントを書き込むインデックス名
+    2000年より前・3000年以降は、検索や削除のパターンから漏れるので ValueError
+    """
+    dt = to_datetime(value)
+    if not MIN_PARTITION_DATETIME <= dt < MAX_PARTITION_DATETIME:
+        raise ValueError(
+            '{!r} is out of the partitioned range (2000-2999).'.format(value)
+        )
+    return '{}-{}'.format(index, dt.strftime(SUFFIX_FORMATS[granularity]))
+
+
+def get_names_from(index, granularity, start):
+    """
+    start を含むパーティションと、それ以降の全パーティションにマッチする名前
+    2026.10.19 からなら 2026.10.19, 2026.10.2*, ..., 2026.2*, ...,
+    2027*, ..., 203*, ..., 29* のように、桁ごとのワイルドカードにする
+    """
+    prefix = '{}-'.format(index)
+    suffix = truncate(start, granularity).strftime(SUFFIX_FORMATS[granularity])
+    max_digits = _SUFFIX_MAX_DIGITS[granularity]
+    names = [prefix + suffix]
+    # 先頭の桁は get_pattern の 2 で固定
+    for i in range(len(suffix) - 1, 0, -1):
+        if not suffix[i].isdigit():
+            continue
+        for digit in range(int(suffix[i]) + 1, int(max_digits[i]) + 1):
+            names.append('{}{}{}*'.format(prefix, suffix[:i], digit))
+    return names
+
+
+def parse_partition_name(index, granularity, name):
+    """
+    get_partition_name の逆。パーティションの開始日時を返す
+    パーティションではない名前なら None
+    """
+    prefix = '{}-'.format(index)
+    if not name.startswith(prefix):
+        return None
+    try:
+        dt = datetime.datetime.strptime(
+            name[len(prefix) :], SUFFIX_FORMATS[granularity]
+        )
+    except ValueError:
+        return None
+    return dt.replace(tzinfo=datetime.timezone.utc)
+
+
+def find_range(query, field):
+    """
+    query の中から、必ず満たされる (filter, must にある) field の range を探す
+    :return: {'gte': ..., 'lt': ...} のような dict。見つからなければ None
+    """
+    if not isinstance(query, dict):
+        return None
+    if 'range' in query:
+        return query['range'].get(field)
+    if 'bool' in query:
+        for key in ('filter', 'must'):
+            clauses = query['bool'].get(key) or []
+            if isinstance(clauses, dict):
+                clauses = [clauses]
+            for clause in clauses:
+                bounds = find_range(clause, field)
+                if bounds:
+                    return bounds
+    if 'constant_score' in query:
+        return find_range(query['constant_score'].get('filter'), field)
+    return None
+
+
+def join_index_names(names, max_length=MAX_INDEX_EXPRESSION_LENGTH):
+    """
+    インデックス名をカンマ区切りで、max_length 以下ずつにまとめる
+    (indices.delete などを、URL が長くなりすぎないよう分けて送るため)
+    :rtype: generator
+    """
+    batch = []
+    length = 0
+    for name in names:
+        if batch and length + 1 + len(name) > max_length:
+            yield ','.join(batch)
+            batch = []
+            length = 0
+        length += len(name) + (1 if batch else 0)
+        batch.append(name)
+    if batch:
+        yield ','.join(batch)
+
+
+def _too_many(names):
+    return (
+        len(names) > MAX_PARTITION_NAMES
+        or sum(len(name) + 1 for name in names) > MAX_INDEX_EXPRESSION_LENGTH
+    )
+
+
+def get_search_index(index, granularity, query, field):
+    """
+    query で検索する必要のあるパーティションの、カンマ区切りのインデックス名
+    range が無い・解釈できない場合は全パーティション (INDEX-2*)
+    上限の無い range は、開始のパーティション以降の全パーティション
+    (未来の日時のドキュメントも含める)。
+    名前が多すぎる・URL が長くなりすぎる場合は、月単位のワイルドカードか
+    全パーティションにする。
+    絞り込みで取りこぼすとヒットが黙って欠けるので、
+    format の指定など、確実に解釈できない range では絞り込まない。
+    """
+    pattern = get_pattern(index, granularity)
+    bounds = find_range(query, field)
+    if not isinstance(bounds, dict) or set(bounds) - _RANGE_KEYS:
+        return pattern
+    try:
+        time_zone = parse_time_zone(bounds.get('time_zone'))
+        start = bounds.get('gte', bounds.get('gt'))
+        if start is None:
+            return pattern
+        start = to_datetime(start, time_zone)
+        if 'lte' in bounds:
+            end = to_datetime(bounds['lte'], time_zone, round_up=True)
+        elif 'lt' in bounds:
+            # lt の丸めは ES でも切り捨て
+            end = to_datetime(bounds['lt'], time_zone)
+            end -= datetime.timedelta(microseconds=1)
+        else:
+            end = None
+    except (TypeError, ValueError):
+        return pattern
+
+    # パーティションの無い範囲は切り詰める
+    last = MAX_PARTITION_DATETIME - datetime.timedelta(microseconds=1)
+    start = min(max(start, MIN_PARTITION_DATETIME), last)
+    if end is None:
+        names = get_names_from(index, granularity, start)
+        return pattern if _too_many(names) else ','.join(names)
+    end = min(end, last)
+
+    starts = []
+    current = truncate(start, granularity)
+    while current <= end:
+        starts.append(current)
+        if len(starts) > MAX_PARTITION_NAMES:
+            break
+        current = next_start(current, granularity)
+    if not starts:
+        # 範囲が空
+        starts = [truncate(start, granularity)]
+
+    names = [get_partition_name(index, granularity, s) for s in starts]
+    if _too_many(names) and granularity == DAILY:
+        # 月単位のワイルドカードにまとめる
+        months = []
+        current = truncate(start, MONTHLY)
+        while current <= end and len(months) <= MAX_PARTITION_NAMES:
+            months.append(current)
+            current = next_start(current, MONTHLY)
+        names = [
+            '{}.*'.format(get_partition_name(index, MONTHLY, m))
+            for m in months
+        ]
+    if _too_many(names):
+        return pattern
+    return ','.join(names)
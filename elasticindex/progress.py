@@ -0,0 +1,208 @@
+"""
+rebuild_index の進捗と内訳の計測
+
+rebuild_index はフェーズごとの時間を RebuildStats に積算する。
+  - fetch: DB からの行の読み出し (クエリセットのイテレート)
+  - build: data_dict_for_index とアクション行の作成
+  - serialize: bulk ボディの JSON シリアライズ
+  - send: client.bulk (bulk を使わない場合は client.index) の往復
+
+progress_callback には送信のたびに RebuildStats が渡され、
+rebuild_index の戻り値も同じ RebuildStats になる。
+"""
+
+import math
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+PHASES = ('fetch', 'build', 'serialize', 'send')
+
+
+def percentile(values, p):
+    """
+    最近傍順位法のパーセンタイル。values が空なら None
+    :param p: 0 〜 100
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(math.ceil(p / 100 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+class RebuildStats(object):
+    """
+    rebuild_index 1回分の計測結果
+
+    :param index: 対象のインデックス名
+    :param total: 読み出す行数の見積もり (ETA の計算に使う)。不明なら None
+    """
+
+    def __init__(self, index, total=None):
+        self.index = index
+        self.total = total
+        self.rows_read = 0
+        self.docs_built = 0
+        self.docs_sent = 0
+        # bulk のレスポンスでエラーになったアイテム数
+        self.failed_docs = 0
+        self.bytes_sent = 0
+        self.requests = 0
+        # フェーズごとの合計時間 (秒)
+        self.phases = OrderedDict((name, 0.0) for name in PHASES)
+        # 送信1回ごとの時間 (秒)
+        self.latencies = []
+        self.started = time.perf_counter()
+        self.finished = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def iterate(self, iterable):
+        """
+        iterable の次の要素を取り出す時間を fetch として数える
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase('fetch'):
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    return
+            self.rows_read += 1
+            yield row
+
+    def record_request(self, docs, size, latency, result=None):
+        """
+        送信1回分を記録する
+        :param size: 送ったボディのバイト数
+        :param result: bulk のレスポンス。エラーのアイテムを数える
+        """
+        self.requests += 1
+        self.docs_sent += docs
+        self.bytes_sent += size
+        self.latencies.append(latency)
+        self.phases['send'] += latency
+        if isinstance(result, dict) and result.get('errors'):
+            for item in result['items']:
+                (op_result,) = item.values()
+                if 'error' in op_result:
+                    self.failed_docs += 1
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def throughput(self):
+        """
+        送信済みドキュメント数 / 秒
+        """
+        elapsed = self.elapsed
+        return self.docs_sent / elapsed if elapsed else 0.0
+
+    @property
+    def eta(self):
+        """
+        残りの見込み秒数。total が不明、またはまだ送っていなければ None
+        """
+        if self.total is None or not self.docs_sent:
+            return None
+        remaining = max(self.total - self.rows_read, 0)
+        return remaining / self.throughput
+
+    def latency_percentile(self, p):
+        """
+        送信時間のパーセンタイル (ミリ秒)
+        """
+        value = percentile(self.latencies, p)
+        return None if value is None else value * 1000
+
+    def as_dict(self):
+        return OrderedDict(
+            [
+                ('index', self.index),
+                ('total', self.total),
+                ('rows_read', self.rows_read),
+                ('docs_built', self.docs_built),
+                ('docs_sent', self.docs_sent),
+                ('failed_docs', self.failed_docs),
+                ('bytes_sent', self.bytes_sent),
+                ('requests', self.requests),
+                ('elapsed', self.elapsed),
+                ('throughput', self.throughput),
+                ('eta', self.eta),
+                ('phases', OrderedDict(self.phases)),
+                ('latency_p50_ms', self.latency_percentile(50)),
+                ('latency_p90_ms', self.latency_percentile(90)),
+                ('latency_p99_ms', self.latency_percentile(99)),
+            ]
+        )
+
+    def format_progress(self):
+        """
+        進捗の1行表示
+        """
+        if self.total:
+            done = '{}/{} ({:.1f}%)'.format(
+                self.rows_read,
+                self.total,
+                min(self.rows_read / self.total * 100, 100.0),
+            )
+        else:
+            done = str(self.rows_read)
+        eta = self.eta
+        return '{} rows:{} docs/s:{:.1f} sent:{:.1f}MB eta:{}'.format(
+            self.index,
+            done,
+            self.throughput,
+            self.bytes_sent / 1e6,
+            '-' if eta is None else '{:.0f}s'.format(eta),
+        )
+
+    def format_summary(self):
+        """
+        最後に表示するための複数行の内訳
+        """
+        lines = [
+            '{}: {} docs sent ({} failed) in {:.2f}s, {:.1f} docs/s, '
+            '{:.1f}MB in {} requests'.format(
+                self.index,
+                self.docs_sent,
+                self.failed_docs,
+                self.elapsed,
+                self.throughput,
+                self.bytes_sent / 1e6,
+                self.requests,
+            )
+        ]
+        elapsed = self.elapsed
+        for name, seconds in self.phases.items():
+            lines.append(
+                '  {:<10}{:>9.3f}s {:>5.1f}%'.format(
+                    name, seconds, seconds / elapsed * 100 if elapsed else 0
+                )
+            )
+        if self.latencies:
+            lines.append(
+                '  send latency p50:{:.1f}ms p90:{:.1f}ms p99:{:.1f}ms '
+                'max:{:.1f}ms'.format(
+                    self.latency_percentile(50),
+                    self.latency_percentile(90),
+                    self.latency_percentile(99),
+                    max(self.latencies) * 1000,
+                )
+            )
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.format_progress()
@@ -0,0 +1,152 @@
+"""
+Elasticsearch クライアントに渡す JSON シリアライザ
+
+settings.ELASTICINDEX_SERIALIZER で選択する。
+  - 'orjson': orjson を使う (要 pip install orjson)
+  - 'ujson': ujson を使う (要 pip install ujson)
+  - 'json' もしくは未指定: 標準 json (Django 型対応のみ追加)
+  - それ以外の文字列: シリアライザクラスのドットパス
+"""
+
+import datetime
+import decimal
+
+from django.utils.functional import Promise
+from django.utils.module_loading import import_string
+from elasticsearch.exceptions import ImproperlyConfigured, SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+
+class DjangoJSONSerializer(JSONSerializer):
+    """
+    標準 json を使うシリアライザ。
+    Django モデルから来る遅延翻訳文字列 (gettext_lazy) も扱える。
+    """
+
+    def default(self, data):
+        if isinstance(data, Promise):
+            return str(data)
+        return super().default(data)
+
+
+class OrjsonSerializer(DjangoJSONSerializer):
+    """
+    orjson を使うシリアライザ
+    datetime, UUID, numpy 配列は orjson 側でネイティブに変換される。
+    """
+
+    def __init__(self):
+        import orjson
+
+        self._orjson = orjson
+        self._option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def default(self, data):
+        if isinstance(data, decimal.Decimal):
+            return float(data)
+        return super().default(data)
+
+    def loads(self, s):
+        try:
+            return self._orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):
+            return data
+        try:
+            # トランスポートは bytes をそのまま送るので、デコードしない。
+            # bulk の行は dumps_bulk_body で bytes のまま join する
+            return self._orjson.dumps(
+                data, default=self.default, option=self._option
+            )
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+
+class UjsonSerializer(DjangoJSONSerializer):
+    """
+    ujson を使うシリアライザ
+    ujson は datetime 等を変換できないため、事前に default で変換する。
+    """
+
+    def __init__(self):
+        import ujson
+
+        self._ujson = ujson
+
+    def _convert(self, data):
+        if isinstance(data, dict):
+            return {k: self._convert(v) for k, v in data.items()}
+        if isinstance(data, (list, tuple)):
+            return [self._convert(v) for v in data]
+        if isinstance(data, (str, int, float, bool)) or data is None:
+            return data
+        if isinstance(data, datetime.time):
+            return data.isoformat()
+        return self.default(data)
+
+    def loads(self, s):
+        try:
+            return self._ujson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):
+            return data
+        try:
+            return self._ujson.dumps(
+                self._convert(data),
+                ensure_ascii=False,
+                escape_forward_slashes=False,
+            )
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+
+def dumps_bytes(serializer, data):
+    """
+    serializer.dumps の結果を bytes にする
+    (orjson は bytes, 標準 json と ujson は str を返す)
+    :rtype: bytes
+    """
+    body = serializer.dumps(data)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return body
+
+
+def dumps_bulk_body(serializer, lines):
+    """
+    bulk の行 (アクションとドキュメントの dict) を、改行区切りのボディにする
+    :rtype: bytes
+    """
+    return b'\n'.join(dumps_bytes(serializer, line) for line in lines) + b'\n'
+
+
+SERIALIZER_ALIASES = {
+    'json': DjangoJSONSerializer,
+    'orjson': OrjsonSerializer,
+    'ujson': UjsonSerializer,
+}
+
+
+def get_serializer(name):
+    """
+    設定値からシリアライザのインスタンスを作る
+    :param name: 'orjson', 'ujson', 'json' またはクラスのドットパス
+    :rtype: JSONSerializer
+    """
+    if not name:
+        name = 'json'
+    serializer_class = SERIALIZER_ALIASES.get(name)
+    if serializer_class is None:
+        serializer_class = import_string(name)
+    try:
+        return serializer_class()
+    except ImportError as e:
+        raise ImproperlyConfigured(
+            'ELASTICINDEX_SERIALIZER={!r} requires: {}'.format(name, e)
+        )
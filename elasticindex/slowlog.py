@@ -0,0 +1,234 @@
+"""
+スロークエリログ
+
+ElasticQuerySet の search / count が閾値を超えたら、
+正規化したクエリ (値を ? に置き換えた形) をログに出し、
+SlowQueryDocument として ES のインデックスに保存する。
+一部 (サンプリング) は "profile": true で再実行し、
+シャードごとのクエリ/コレクタの内訳を圧縮した形で一緒に保存する。
+
+閾値は ElasticDocument.SLOW_QUERY_MS か settings.ELASTICINDEX_SLOW_QUERY_MS
+(ミリ秒)。プロファイルの取得率は ElasticDocument.SLOW_QUERY_PROFILE_RATE か
+settings.ELASTICINDEX_SLOW_QUERY_PROFILE_RATE (0 〜 1)。
+
+集計は manage.py elasticindex_slow_queries で見る。
+"""
+
+import hashlib
+import json
+import logging
+import random
+
+from django.conf import settings
+from django.utils import timezone
+
+from .fields import ElasticDocumentField as F
+from .models import ElasticDocument
+
+logger = logging.getLogger('elasticindex.slow')
+
+# profile の description は長くなりがちなので切り詰める
+PROFILE_DESCRIPTION_LENGTH = 200
+
+
+class SlowQueryDocument(ElasticDocument):
+    """
+    スロークエリ1件
+    body と profile は JSON 文字列で、インデックスはしない
+    """
+
+    INDEX = getattr(
+        settings, 'ELASTICINDEX_SLOW_QUERY_INDEX', 'elasticindex_slow_queries'
+    )
+    # 自分自身の検索はスロークエリ扱いしない
+    SLOW_QUERY_MS = False
+
+    shape_hash = F(mapping={"type": "keyword"})
+    target_index = F(mapping={"type": "keyword"})
+    operation = F(mapping={"type": "keyword"})
+    elapsed_ms = F(mapping={"type": "float"})
+    took = F(mapping={"type": "long"}, default=None)
+    created_at = F(mapping={"type": "date"})
+    profiled = F(mapping={"type": "boolean"}, default=False)
+    body = F(mapping={"type": "keyword", "index": False, "doc_values": False})
+    profile = F(
+        mapping={"type": "keyword", "index": False, "doc_values": False},
+        default=None,
+    )
+
+    @property
+    def body_dict(self):
+        return json.loads(self.body)
+
+    @property
+    def profile_list(self):
+        if not self.profile:
+            return []
+        return json.loads(self.profile)
+
+
+def _get_option(model_cls, attr_name, setting_name):
+    value = getattr(model_cls, attr_name, None)
+    if value is None:
+        value = getattr(settings, setting_name, None)
+    return value
+
+
+def get_threshold_ms(model_cls):
+    """
+    スロークエリの閾値 (ミリ秒)。 None なら無効
+    """
+    threshold = _get_option(
+        model_cls, 'SLOW_QUERY_MS', 'ELASTICINDEX_SLOW_QUERY_MS'
+    )
+    if not threshold:
+        return None
+    return threshold
+
+
+def normalize_body(body):
+    """
+    クエリの値を ? に置き換えて、クエリの形だけを残す
+    """
+    if isinstance(body, dict):
+        return {k: normalize_body(v) for k, v in body.items()}
+    if isinstance(body, (list, tuple)):
+        items = [normalize_body(v) for v in body]
+        if all(not isinstance(v, (dict, list)) for v in items):
+            # 値のリストは長さが違っても同じ形とみなす
+            return ['?'] if items else []
+        return items
+    return '?'
+
+
+def get_shape_hash(normalized_body, index):
+    """
+    クエリの形と対象インデックスごとのハッシュ
+    同じ形でもインデックスが違えば別に集計する
+    """
+    return hashlib.sha1(
+        json.dumps([index, normalized_body], sort_keys=True).encode('utf-8')
+    ).hexdigest()[:16]
+
+
+def _compact_queries(nodes, depth, out):
+    for node in nodes:
+        out.append(
+            [
+                depth,
+                node.get('type'),
+                (node.get('description') or '')[:PROFILE_DESCRIPTION_LENGTH],
+                node.get('time_in_nanos'),
+            ]
+        )
+        _compact_queries(node.get('children', ()), depth + 1, out)
+
+
+def _compact_collectors(nodes, depth, out):
+    for node in nodes:
+        out.append([depth, node.get('name'), node.get('time_in_nanos')])
+        _compact_collectors(node.get('children', ()), depth + 1, out)
+
+
+def compact_profile(profile):
+    """
+    ES の profile レスポンスを、シャードごとの
+    query: [[深さ, type, description, time_in_nanos], ...]
+    collector: [[深さ, name, time_in_nanos], ...]
+    に縮める
+    """
+    shards = []
+    for shard in profile.get('shards', ()):
+        for search in shard.get('searches', ()):
+            queries = []
+            _compact_queries(search.get('query', ()), 0, queries)
+            collectors = []
+            _compact_collectors(search.get('collector', ()), 0, collectors)
+            shards.append(
+                {
+                    'id': shard.get('id'),
+                    'query': queries,
+                    'collector': collectors,
+                }
+            )
+    return shards
+
+
+def _should_profile(model_cls):
+    rate = _get_option(
+        model_cls,
+        'SLOW_QUERY_PROFILE_RATE',
+        'ELASTICINDEX_SLOW_QUERY_PROFILE_RATE',
+    )
+    return bool(rate) and random.random() < rate
+
+
+def _profile(queryset, operation, body):
+    if operation == 'count':
+        # count API は profile できないので、件数0の search で代用する
+        body = {'query': body.get('query', {"match_all": {}}), 'size': 0}
+    body = dict(body, profile=True)
+    result = queryset.es_client.search(
+        index=queryset.search_index, body=body, **queryset.search_kwargs
+    )
+    return compact_profile(result.get('profile', {}))
+
+
+_index_ensured = set()
+
+
+def _ensure_index():
+    if SlowQueryDocument.INDEX in _index_ensured:
+        return
+    if not SlowQueryDocument.index.exists():
+        SlowQueryDocument.index.create()
+    _index_ensured.add(SlowQueryDocument.INDEX)
+
+
+def record_slow_query(queryset, operation, body, event):
+    """
+    event (QueryEvent) が閾値を超えていたら、ログに出して保存する
+    スロークエリログの失敗で本来の検索を失敗させないよう、例外は握りつぶす
+    """
+    model_cls = queryset.model_cls
+    threshold = get_threshold_ms(model_cls)
+    if threshold is None or event.elapsed_ms < threshold:
+        return
+
+    normalized = normalize_body(body)
+    shape_hash = get_shape_hash(normalized, event.index)
+    logger.warning(
+        'slow {} on {}: {:.1f}ms (took:{}) shape:{} body:{}'.format(
+            operation,
+            event.index,
+            event.elapsed_ms,
+            event.took,
+            shape_hash,
+            json.dumps(normalized, sort_keys=True),
+        )
+    )
+    try:
+        profile = None
+        if _should_profile(model_cls):
+            profile = _profile(queryset, operation, body)
+        _ensure_index()
+        SlowQueryDocument.update(
+            None,
+            {
+                'shape_hash': shape_hash,
+                'target_index': event.index,
+                'operation': operation,
+                'elapsed_ms': event.elapsed_ms,
+                'took': event.took,
+                'created_at': timezone.now(),
+                'profiled': profile is not None,
+                'body': json.dumps(normalized, sort_keys=True),
+                'profile': (
+                    json.dumps(profile, separators=(',', ':'))
+                    if profile is not None
+                    else None
+                ),
+            },
+        )
+    except Exception:
+        logger.exception('Failed to record slow query.')
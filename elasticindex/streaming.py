@@ -0,0 +1,241 @@
+"""
+検索結果のストリーミング読み込み
+
+通常の search はレスポンスボディを全部受け取り、全体を1つの dict に
+デコードしてから結果を返すので、大きいドキュメントを多く取ると
+生のバイト列とデコード後の dict の両方がメモリに乗り、最初の1件も遅れる。
+
+ここではレスポンスをチャンクごとに読み、hits.hits の要素を
+1件ずつデコードして返す。それ以外 (took, hits.total, aggregations など)
+は hits.hits を空にした dict (スケルトン) として最後に得られる。
+
+ElasticQuerySet.stream() から使う。
+"""
+
+import datetime
+import re
+import time
+from urllib.parse import quote
+
+from .serializers import dumps_bytes
+
+# 文字列 (閉じているもの) か、括弧か、閉じていない文字列の開始
+_TOKEN_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}"]', re.DOTALL)
+
+
+def _make_path(*parts):
+    """
+    '/index1,index2/_search' のような URL のパス
+    """
+    return '/' + '/'.join(quote(str(part), ',*') for part in parts if part)
+
+
+def _escape(value):
+    """
+    クエリパラメータの値を、ES が受け付ける文字列にする
+    """
+    if isinstance(value, (list, tuple)):
+        return ','.join(_escape(v) for v in value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+class HitsStreamParser(object):
+    """
+    検索レスポンスの JSON を少しずつ受け取り、hits.hits の要素を取り出す
+
+        parser = HitsStreamParser(json.loads)
+        for chunk in chunks:
+            for hit in parser.feed(chunk):
+                ...
+        skeleton = parser.close()
+
+    JSON の構文チェックはしない (ES のレスポンスは正しい前提)。
+    括弧と文字列だけを追って、hits.hits の要素の範囲を切り出して loads する。
+    """
+
+    def __init__(self, loads):
+        self.loads = loads
+        self.buffer = b''
+        # 未処理の位置
+        self.position = 0
+        # 開いている括弧と、それが入っているキー
+        self.stack = []
+        self.last_string = None
+        # hits.hits の中にいるか
+        self.in_hits = False
+        # 読み込み中のヒットの開始位置
+        self.hit_start = None
+        # スケルトンとして、まだコピーしていない部分の開始位置
+        self.copy_from = 0
+        self.skeleton = []
+
+    def feed(self, data):
+        """
+        :param data: レスポンスボディの続き (bytes)
+        :return: このチャンクで読み終わったヒットの list
+        """
+        hits = []
+        buffer = self.buffer + data
+        position = self.position
+        stack = self.stack
+
+        while True:
+            match = _TOKEN_RE.search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                break
+            token = match.group()
+            if token == b'"':
+                # 文字列がチャンクをまたいでいる。続きを待つ
+                position = match.start()
+                break
+            position = match.end()
+            if token[0] == 0x22:  # '"'
+                self.last_string = token
+                continue
+            if token in (b'{', b'['):
+                key = None
+                if stack and stack[-1][0] == b'{':
+                    key = self.last_string
+                if (
+                    token == b'['
+                    and key == b'"hits"'
+                    and len(stack) == 2
+                    and stack[1][1] == b'"hits"'
+                ):
+                    self.in_hits = True
+                    self.skeleton.append(buffer[self.copy_from : position])
+                    self.copy_from = None
+                elif self.in_hits and len(stack) == 3:
+                    self.hit_start = match.start()
+                stack.append((token, key))
+                continue
+            # 閉じ括弧
+            stack.pop()
+            if self.in_hits and len(stack) == 3:
+                hits.append(self.loads(buffer[self.hit_start : position]))
+                self.hit_start = None
+            elif self.in_hits and len(stack) == 2:
+                self.in_hits = False
+                self.copy_from = match.start()
+
+        # 読み終わった部分を捨てる
+        if self.copy_from is not None:
+            self.skeleton.append(buffer[self.copy_from : position])
+            self.copy_from = position
+        keep_from = position if self.hit_start is None else self.hit_start
+        self.buffer = buffer[keep_from:]
+        self.position = position - keep_from
+        if self.hit_start is not None:
+            self.hit_start = 0
+        if self.copy_from is not None:
+            self.copy_from -= keep_from
+        return hits
+
+    def close(self):
+        """
+        :return: hits.hits を空にしたレスポンスの dict
+        """
+        if self.stack or self.buffer[self.position :].strip():
+            raise ValueError('Incomplete search response.')
+        return self.loads(b''.join(self.skeleton))
+
+
+class StreamingSearch(object):
+    """
+    search を1回実行し、ヒットを読めたものから返すイテレータ
+
+    イテレートし終わると、result に hits.hits 以外のレスポンス、
+    elapsed にネットワークとデコードにかかった時間 (秒) が入る。
+    Connection に perform_request_stream が無い場合は、
+    普通の search の結果から返す。
+    トランスポートのリトライやスニッフィングは行わない。
+    """
+
+    def __init__(
+        self,
+        client,
+        index,
+        body,
+        params=None,
+        keep_hits=False,
+        chunk_size=65536,
+    ):
+        self.client = client
+        self.index = index
+        self.body = body
+        self.params = params or {}
+        # True なら result['hits']['hits'] にヒットを残す
+        self.keep_hits = keep_hits
+        self.chunk_size = chunk_size
+
+        self.result = None
+        self.elapsed = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.hit_count = 0
+
+    def __iter__(self):
+        transport = self.client.transport
+        connection = transport.get_connection()
+        if not hasattr(connection, 'perform_request_stream'):
+            yield from self._search()
+            return
+
+        serializer = transport.serializer
+        body = dumps_bytes(serializer, self.body)
+        params = {k: _escape(v) for k, v in self.params.items()}
+        self.request_bytes = len(body)
+
+        kept_hits = []
+        parser = HitsStreamParser(serializer.loads)
+        start = time.perf_counter()
+        _status, _headers, chunks = connection.perform_request_stream(
+            'POST',
+            _make_path(self.index, '_search'),
+            params=params,
+            body=body,
+            headers={'content-type': 'application/json'},
+            chunk_size=self.chunk_size,
+        )
+        try:
+            for chunk in chunks:
+                self.response_bytes += len(chunk)
+                hits = parser.feed(chunk)
+                self.elapsed += time.perf_counter() - start
+                for hit in hits:
+                    self.hit_count += 1
+                    if self.keep_hits:
+                        kept_hits.append(hit)
+                    yield hit
+                start = time.perf_counter()
+            result = parser.close()
+        finally:
+            # 途中でやめた場合も接続を返す
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        self.elapsed += time.perf_counter() - start
+        if self.keep_hits:
+            result['hits']['hits'] = kept_hits
+        self.result = result
+
+    def _search(self):
+        start = time.perf_counter()
+        result = self.client.search(
+            index=self.index, body=self.body, **self.params
+        )
+        self.elapsed = time.perf_counter() - start
+        hits = result['hits']['hits']
+        if not self.keep_hits:
+            result['hits']['hits'] = []
+        self.result = result
+        for hit in hits:
+            self.hit_count += 1
+            yield hit
@@ -65,6 +65,10 @@ def runtests(**test_args):
             if k.isupper():
                 SETTINGS[k] = v
 
+    # ELASTICINDEX_BACKEND=memory make test で、ES 無しで実行できる
+    if os.environ.get('ELASTICINDEX_BACKEND'):
+        SETTINGS['ELASTICINDEX_BACKEND'] = os.environ['ELASTICINDEX_BACKEND']
+
     settings.configure(**SETTINGS)
 
     from django.test.utils import get_runner
@@ -18,7 +18,16 @@ setup(
     author_email='ytyng@live.jp',
     url='https://github.com/ytyng/django-elasticindex',
     keywords='Elasticsearch, Django, Python',
-    packages=['elasticindex'],
-    install_requires=['elasticsearch', 'requests_aws4auth'],
+    packages=[
+        'elasticindex',
+        'elasticindex.management',
+        'elasticindex.management.commands',
+    ],
+    install_requires=['elasticsearch'],
+    extras_require={
+        'orjson': ['orjson'],
+        'ujson': ['ujson'],
+        'numpy': ['numpy'],
+    },
     entry_points={},
 )
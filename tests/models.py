@@ -1,5 +1,6 @@
 from django.db import models
 
+from elasticindex.fields import DenseVectorField
 from elasticindex.models import ElasticDocument
 from elasticindex.models import ElasticDocumentField as F
 
@@ -18,6 +19,20 @@ class DummyESDocument(ElasticDocument):
     value = F(mapping={"type": "text"})
 
 
+class DummyRoutedESDocument(ElasticDocument):
+    INDEX = "elasticindex_test_index_routed"
+    ROUTING_REQUIRED = True
+
+    source_model = DummyModel
+
+    key = F(mapping={"type": "keyword"})
+    value = F(mapping={"type": "text"})
+
+    @classmethod
+    def get_routing_of_source_model(cls, source_model):
+        return source_model.key[0]
+
+
 class DummyESDocumentPresetIndex(ElasticDocument):
     INDEX = "elasticindex_test_index_preset_i"
 
@@ -64,3 +79,42 @@ class DummyESDocumentPresetIndex(ElasticDocument):
             "analyzer": "bigram_analyzer",
         }
     )
+
+
+class DummyEventESDocument(ElasticDocument):
+    INDEX = "elasticindex_test_events"
+    PARTITION = 'daily'
+    PARTITION_FIELD = 'created_at'
+
+    kind = F(mapping={"type": "keyword"})
+    created_at = F(mapping={"type": "date"})
+
+
+class DummyEventArchiveESDocument(ElasticDocument):
+    """
+    DummyEventESDocument のパーティションと名前の先頭が同じ、別のインデックス
+    """
+
+    INDEX = "elasticindex_test_events-archive"
+
+    kind = F(mapping={"type": "keyword"})
+    created_at = F(mapping={"type": "date"})
+
+
+VECTORS = {
+    'quick': [1.0, 0.0, 0.0],
+    'jumps': [0.9, 0.1, 0.0],
+    'lazy': [0.0, 0.0, 1.0],
+}
+
+
+class DummyVectorESDocument(ElasticDocument):
+    INDEX = "elasticindex_test_index_vectors"
+
+    source_model = DummyModel
+
+    key = F(mapping={"type": "keyword"})
+    value = F(mapping={"type": "text"})
+    embedding = DenseVectorField(
+        dims=3, source_value_getter=lambda m: VECTORS[m.key]
+    )
@@ -1,8 +1,41 @@
+import datetime
+import decimal
+import io
+import json
 import time
+from unittest import mock
 
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.translation import gettext_lazy
+from elasticsearch.exceptions import RequestError
 
-from .models import DummyESDocument, DummyESDocumentPresetIndex, DummyModel
+from elasticindex.aws import (
+    AWSSigV4Connection,
+    Credentials,
+    CredentialsChain,
+    sign_request,
+)
+from elasticindex.instrumentation import collect, instrument, query_executed
+from elasticindex.managers import MultiDocumentQuerySet
+from elasticindex.memory import LocalConnection, store
+from elasticindex.serializers import dumps_bulk_body, get_serializer
+from elasticindex.slowlog import (
+    SlowQueryDocument,
+    compact_profile,
+    normalize_body,
+)
+from elasticindex.streaming import HitsStreamParser
+
+from .models import (
+    DummyESDocument,
+    DummyESDocumentPresetIndex,
+    DummyEventArchiveESDocument,
+    DummyEventESDocument,
+    DummyModel,
+    DummyRoutedESDocument,
+    DummyVectorESDocument,
+)
 
 
 class TestESDocumentTest(TestCase):
@@ -157,3 +190,1076 @@ class TestESDocumentPresetIndexTest(TestCase):
 
     def tearDown(self):
         DummyESDocumentPresetIndex.index.delete()
+
+
+class TestSerializers(SimpleTestCase):
+    data = {
+        'dt': datetime.datetime(2020, 1, 2, 3, 4, 5),
+        'd': datetime.date(2020, 1, 2),
+        'price': decimal.Decimal('1.5'),
+        'label': gettext_lazy('spam'),
+        'list': [1, 'eggs'],
+    }
+    expected = {
+        'dt': '2020-01-02T03:04:05',
+        'd': '2020-01-02',
+        'price': 1.5,
+        'label': 'spam',
+        'list': [1, 'eggs'],
+    }
+
+    def _assert_serializer(self, name):
+        serializer = get_serializer(name)
+        dumped = serializer.dumps(self.data)
+        self.assertEqual(json.loads(dumped), self.expected)
+        self.assertEqual(serializer.loads(dumped), self.expected)
+        body = dumps_bulk_body(serializer, [{'index': {}}, self.data])
+        self.assertEqual(
+            [json.loads(line) for line in body.splitlines()],
+            [{'index': {}}, self.expected],
+        )
+
+    def test_json(self):
+        self._assert_serializer('json')
+        self._assert_serializer(None)
+
+    def test_orjson(self):
+        try:
+            import orjson  # NOQA
+        except ImportError:
+            self.skipTest('orjson is not installed')
+        self._assert_serializer('orjson')
+
+    def test_ujson(self):
+        try:
+            import ujson  # NOQA
+        except ImportError:
+            self.skipTest('ujson is not installed')
+        self._assert_serializer('ujson')
+
+
+class TestInstrumentation(SimpleTestCase):
+    def test_collect_search_and_count(self):
+        qs = DummyESDocument.objects.query({"term": {"key": "spam"}})
+        qs.es_client = mock.Mock()
+        qs.es_client.search.return_value = {
+            'took': 3,
+            'hits': {
+                'total': {'value': 1, 'relation': 'eq'},
+                'hits': [
+                    {
+                        '_id': 'a',
+                        '_score': 1.0,
+                        '_source': {'key': 'spam', 'value': 'eggs'},
+                    }
+                ],
+            },
+        }
+        count_qs = DummyESDocument.objects.all()
+        count_qs.es_client = mock.Mock()
+        count_qs.es_client.count.return_value = {'count': 5}
+
+        received = []
+
+        def receiver(sender, event, **kwargs):
+            received.append(event)
+
+        query_executed.connect(receiver)
+        try:
+            with collect() as collector:
+                self.assertEqual(len(qs), 1)
+                self.assertEqual(count_qs.count(), 5)
+        finally:
+            query_executed.disconnect(receiver)
+
+        self.assertEqual(
+            [e.operation for e in collector.events], ['search', 'count']
+        )
+        self.assertEqual(received, collector.events)
+        search_event = collector.events[0]
+        self.assertEqual(search_event.index, DummyESDocument.INDEX)
+        self.assertEqual(search_event.took, 3)
+        self.assertEqual(search_event.hits, 1)
+        self.assertFalse(search_event.error)
+        summary = collector.summary()
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['by_operation']['count']['count'], 1)
+
+    def test_bytes_of_non_ascii_response(self):
+        class _Connection(LocalConnection):
+            def respond(self, method, url, params, body):
+                return 200, '{"value": "日本語"}'
+
+        with instrument('search', DummyESDocument.INDEX) as event:
+            _Connection().perform_request(
+                'POST', '/_search', body='{"q": "犬"}'
+            )
+        # 日本語は1文字3バイト
+        self.assertEqual(event.request_bytes, 12)
+        self.assertEqual(event.response_bytes, 22)
+
+    def test_error_flag(self):
+        qs = DummyESDocument.objects.all()
+        qs.es_client = mock.Mock()
+        qs.es_client.count.side_effect = RuntimeError
+        with collect() as collector:
+            with self.assertRaises(RuntimeError):
+                qs.count()
+        self.assertTrue(collector.events[0].error)
+
+
+class TestSlowQueryLog(SimpleTestCase):
+    def test_normalize_body(self):
+        body1 = {
+            "query": {"terms": {"key": ["a", "b"]}},
+            "size": 10,
+        }
+        body2 = {
+            "query": {"terms": {"key": ["c"]}},
+            "size": 20,
+        }
+        self.assertEqual(normalize_body(body1), normalize_body(body2))
+        self.assertEqual(
+            normalize_body(body1),
+            {"query": {"terms": {"key": ["?"]}}, "size": "?"},
+        )
+
+    def test_compact_profile(self):
+        profile = {
+            'shards': [
+                {
+                    'id': '[node][index][0]',
+                    'searches': [
+                        {
+                            'query': [
+                                {
+                                    'type': 'BooleanQuery',
+                                    'description': 'key:a key:b',
+                                    'time_in_nanos': 2000,
+                                    'children': [
+                                        {
+                                            'type': 'TermQuery',
+                                            'description': 'key:a',
+                                            'time_in_nanos': 1000,
+                                        }
+                                    ],
+                                }
+                            ],
+                            'collector': [
+                                {
+                                    'name': 'SimpleTopScoreDocCollector',
+                                    'time_in_nanos': 500,
+                                }
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+        self.assertEqual(
+            compact_profile(profile),
+            [
+                {
+                    'id': '[node][index][0]',
+                    'query': [
+                        [0, 'BooleanQuery', 'key:a key:b', 2000],
+                        [1, 'TermQuery', 'key:a', 1000],
+                    ],
+                    'collector': [[0, 'SimpleTopScoreDocCollector', 500]],
+                }
+            ],
+        )
+
+    @override_settings(ELASTICINDEX_SLOW_QUERY_MS=0.0001)
+    def test_record_slow_count(self):
+        qs = DummyESDocument.objects.query({"term": {"key": "spam"}})
+        qs.es_client = mock.Mock()
+        qs.es_client.count.return_value = {'count': 5}
+        with (
+            mock.patch('elasticindex.slowlog._ensure_index'),
+            mock.patch(
+                'elasticindex.slowlog.SlowQueryDocument.update'
+            ) as update,
+            self.assertLogs('elasticindex.slow', 'WARNING'),
+        ):
+            qs.count()
+        self.assertEqual(update.call_count, 1)
+        data = update.call_args[0][1]
+        self.assertEqual(data['operation'], 'count')
+        self.assertEqual(data['target_index'], DummyESDocument.INDEX)
+        self.assertEqual(data['body'], '{"query": {"term": {"key": "?"}}}')
+        self.assertFalse(data['profiled'])
+
+    @override_settings(ELASTICINDEX_SLOW_QUERY_MS=0.0001)
+    def test_shape_hash_per_index(self):
+        shapes = []
+        for document_cls in (DummyESDocument, DummyESDocumentPresetIndex):
+            qs = document_cls.objects.query({"term": {"key": "spam"}})
+            qs.es_client = mock.Mock()
+            qs.es_client.count.return_value = {'count': 5}
+            with (
+                mock.patch('elasticindex.slowlog._ensure_index'),
+                mock.patch(
+                    'elasticindex.slowlog.SlowQueryDocument.update'
+                ) as update,
+                self.assertLogs('elasticindex.slow', 'WARNING'),
+            ):
+                qs.count()
+            shapes.append(update.call_args[0][1]['shape_hash'])
+        # 同じ形でも、インデックスが違えば別の行にする
+        self.assertNotEqual(shapes[0], shapes[1])
+
+    @override_settings(ELASTICINDEX_BACKEND='memory')
+    def test_slow_queries_command(self):
+        store.reset()
+        self.addCleanup(store.reset)
+        out = io.StringIO()
+        call_command('elasticindex_slow_queries', stdout=out)
+        self.assertEqual(out.getvalue(), 'No slow queries recorded.\n')
+
+        SlowQueryDocument.index.create()
+        profile = [
+            {
+                'id': '[node][index][0]',
+                'query': [[0, 'TermQuery', 'key:spam', 2500000]],
+                'collector': [[0, 'SimpleTopScoreDocCollector', 500000]],
+            }
+        ]
+        for i, (shape, elapsed_ms, profiled) in enumerate(
+            [
+                ('aaa', 100.0, False),
+                ('aaa', 300.0, True),
+                ('bbb', 500.0, False),
+            ]
+        ):
+            SlowQueryDocument.update(
+                'slow-{}'.format(i),
+                {
+                    'shape_hash': shape,
+                    'target_index': DummyESDocument.INDEX,
+                    'operation': 'search',
+                    'elapsed_ms': elapsed_ms,
+                    'took': 5,
+                    'created_at': '2026-10-19T00:00:00',
+                    'profiled': profiled,
+                    'body': json.dumps({'query': {'term': {'key': i}}}),
+                    'profile': json.dumps(profile) if profiled else None,
+                },
+            )
+
+        out = io.StringIO()
+        call_command('elasticindex_slow_queries', '--profile', stdout=out)
+        self.assertEqual(
+            out.getvalue().splitlines(),
+            [
+                # 件数ではなく合計時間の大きい順
+                'bbb elasticindex_test_index search: total:500.0ms '
+                'count:1 avg:500.0ms max:500.0ms',
+                '    {"query": {"term": {"key": 2}}}',
+                'aaa elasticindex_test_index search: total:400.0ms '
+                'count:2 avg:200.0ms max:300.0ms',
+                '    {"query": {"term": {"key": 1}}}',
+                '    shard [node][index][0]',
+                '      TermQuery 2.50ms key:spam',
+                '      SimpleTopScoreDocCollector 0.50ms',
+            ],
+        )
+
+
+def _index_dummy_models():
+    """
+    DummyModel を3件作り、メモリ上のバックエンドにインデックスする
+    """
+    store.reset()
+    DummyESDocument.index.create()
+    DummyModel.objects.create(key='quick', value='Brown fox')
+    DummyModel.objects.create(key='jumps', value='over the lazy fox')
+    DummyModel.objects.create(key='lazy', value='dogs.')
+    DummyESDocument.rebuild_index()
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestMemoryBackend(TestCase):
+    def setUp(self):
+        _index_dummy_models()
+
+    def tearDown(self):
+        store.reset()
+
+    def test_search(self):
+        qs = DummyESDocument.objects.query({"match": {"value": "fox"}})
+        self.assertEqual(qs.count(), 2)
+        self.assertEqual(
+            [d.key for d in qs.order_by({"key": "desc"})], ['quick', 'jumps']
+        )
+
+        # Text fields are analyzed (lowercased), keyword fields are not.
+        self.assertEqual(
+            DummyESDocument.objects.get({"term": {"value": "brown"}}).key,
+            'quick',
+        )
+        with self.assertRaises(DummyESDocument.DoesNotExist):
+            DummyESDocument.objects.get({"term": {"key": "QUICK"}})
+
+        qs = DummyESDocument.objects.query(
+            {
+                "bool": {
+                    "should": [
+                        {"match": {"value": "dogs"}},
+                        {"match": {"value": "fox"}},
+                    ],
+                    "must_not": [{"term": {"key": "jumps"}}],
+                }
+            }
+        ).order_by(["key"])
+        self.assertEqual([d.key for d in qs], ['lazy', 'quick'])
+        self.assertEqual(qs.latest_total_count, 2)
+
+        qs = DummyESDocument.objects.query(
+            {"range": {"key": {"gte": "k", "lt": "r"}}}
+        ).order_by({"key": "asc"})
+        self.assertEqual([d.key for d in qs[:1]], ['lazy'])
+        self.assertEqual([d.key for d in qs[1:]], ['quick'])
+
+    def test_write_and_delete(self):
+        DummyESDocument.update('manual', {'key': 'spam', 'value': 'eggs'})
+        self.assertEqual(
+            DummyESDocument.objects.get_by_id('manual').key, 'spam'
+        )
+        DummyESDocument.update_bulk(
+            [
+                {'update': {'_id': 'manual'}},
+                {'doc': {'value': 'ham'}},
+                {'delete': {'_id': 'lazy'}},
+            ]
+        )
+        self.assertEqual(
+            DummyESDocument.objects.get({"match": {"value": "ham"}}).key,
+            'spam',
+        )
+        DummyESDocument.objects.delete_by_id('manual')
+        self.assertEqual(DummyESDocument.objects.count(), 2)
+
+        DummyESDocument.index.delete()
+        self.assertFalse(DummyESDocument.index.exists())
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestAggregations(TestCase):
+    def setUp(self):
+        _index_dummy_models()
+
+    def tearDown(self):
+        store.reset()
+
+    def test_aggregate(self):
+        qs = DummyESDocument.objects.query({"match": {"value": "fox"}})
+        result = qs.aggregate(
+            keys={"terms": {"field": "key"}},
+            key_count={"cardinality": {"field": "key"}},
+        )
+        self.assertEqual(
+            result['keys'],
+            [
+                {'key': 'jumps', 'doc_count': 1},
+                {'key': 'quick', 'doc_count': 1},
+            ],
+        )
+        self.assertEqual(result['key_count'], 2)
+        self.assertEqual(qs.latest_total_count, 2)
+        self.assertEqual(qs.latest_raw_result['hits']['hits'], [])
+
+    def test_iter_composite(self):
+        qs = DummyESDocument.objects.all()
+        with collect() as collector:
+            buckets = list(
+                qs.iter_composite(
+                    [{"k": {"terms": {"field": "key"}}}], page_size=2
+                )
+            )
+        self.assertEqual(
+            [b['key']['k'] for b in buckets], ['jumps', 'lazy', 'quick']
+        )
+        # 2件, 1件 の2ページ
+        self.assertEqual(collector.count, 2)
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestSourceModels(TestCase):
+    def setUp(self):
+        _index_dummy_models()
+
+    def tearDown(self):
+        store.reset()
+
+    def test_with_source_models(self):
+        DummyModel.objects.filter(key='lazy').delete()
+        qs = DummyESDocument.objects.order_by({"key": "asc"})
+        with self.assertNumQueries(1):
+            documents = list(qs.with_source_models())
+        self.assertEqual([d.key for d in documents], ['jumps', 'quick'])
+        self.assertEqual(
+            [d.source_instance.value for d in documents],
+            ['over the lazy fox', 'Brown fox'],
+        )
+        documents = list(qs.with_source_models(drop_missing=False))
+        self.assertEqual(
+            [d.source_instance is None for d in documents],
+            [False, True, False],
+        )
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestStream(TestCase):
+    def setUp(self):
+        _index_dummy_models()
+
+    def tearDown(self):
+        store.reset()
+
+    def test_stream(self):
+        qs = DummyESDocument.objects.order_by({"key": "asc"})
+        with collect() as collector:
+            keys = [d.key for d in qs.stream()]
+        self.assertEqual(keys, [d.key for d in qs.all()])
+        self.assertEqual(collector.events[0].hits, 3)
+        self.assertEqual(qs.latest_total_count, 3)
+        self.assertEqual(qs.latest_raw_result['hits']['hits'], [])
+        list(qs.stream(keep_raw_result=True))
+        self.assertEqual(len(qs.latest_raw_result['hits']['hits']), 3)
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestRebuildStats(TestCase):
+    def setUp(self):
+        _index_dummy_models()
+
+    def tearDown(self):
+        store.reset()
+
+    def test_rebuild_stats(self):
+        progress = []
+        stats = DummyESDocument.rebuild_index(
+            bulk_size=2,
+            progress_callback=lambda s: progress.append(s.rows_read),
+        )
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual(stats.total, 3)
+        self.assertEqual(stats.docs_sent, 3)
+        self.assertEqual(stats.failed_docs, 0)
+        self.assertEqual(stats.requests, 2)
+        self.assertGreater(stats.bytes_sent, 0)
+        self.assertEqual(stats.eta, 0)
+        self.assertEqual(
+            list(stats.phases), ['fetch', 'build', 'serialize', 'send']
+        )
+        self.assertIsNotNone(stats.latency_percentile(99))
+
+        stats = DummyESDocument.rebuild_index(bulk_size=0)
+        self.assertIsNone(stats.total)
+        self.assertEqual(stats.docs_sent, 3)
+        self.assertEqual(DummyESDocument.objects.count(), 3)
+
+        out = io.StringIO()
+        call_command(
+            'elasticindex_rebuild', 'tests.models.DummyESDocument', stdout=out
+        )
+        self.assertIn('3 docs sent (0 failed)', out.getvalue())
+
+    def test_rebuild_with_offset_only(self):
+        store.reset()
+        DummyESDocument.index.create()
+        stats = DummyESDocument.rebuild_index(offset=1)
+        self.assertEqual(stats.docs_sent, 2)
+
+        out = io.StringIO()
+        call_command(
+            'elasticindex_rebuild',
+            'tests.models.DummyESDocument',
+            '--offset',
+            '2',
+            stdout=out,
+        )
+        self.assertIn('1 docs sent (0 failed)', out.getvalue())
+
+
+class TestHitsStreamParser(SimpleTestCase):
+    def test_feed(self):
+        response = {
+            "took": 3,
+            "hits": {
+                "total": {"value": 2, "relation": "eq"},
+                "hits": [
+                    {"_id": "1", "_source": {"t": "a \"}] {[ \\"}},
+                    {"_id": "2", "_source": {"hits": {"hits": [1]}}},
+                ],
+            },
+            "aggregations": {"a": {"value": 1}},
+        }
+        raw = json.dumps(response).encode('utf-8')
+        for size in (1, 7, len(raw)):
+            parser = HitsStreamParser(json.loads)
+            hits = []
+            for i in range(0, len(raw), size):
+                hits.extend(parser.feed(raw[i : i + size]))
+            self.assertEqual(hits, response['hits']['hits'])
+            skeleton = parser.close()
+            self.assertEqual(skeleton['hits']['hits'], [])
+            self.assertEqual(skeleton['aggregations'], {"a": {"value": 1}})
+            self.assertEqual(skeleton['took'], 3)
+
+        parser = HitsStreamParser(json.loads)
+        parser.feed(raw[:-1])
+        with self.assertRaises(ValueError):
+            parser.close()
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestBulkWriter(TestCase):
+    def setUp(self):
+        store.reset()
+        DummyESDocument.index.create()
+
+    def tearDown(self):
+        store.reset()
+
+    def test_bulk_writer(self):
+        with DummyESDocument.bulk_writer(max_docs=10) as w:
+            for i in range(25):
+                w.index(DummyModel(key='key{}'.format(i), value='v'))
+            w.index_dict('manual', {'key': 'spam', 'value': 'eggs'})
+            w.update('manual', {'value': 'ham'})
+            w.update('missing', {'value': 'ham'})
+            w.delete('key0')
+        self.assertEqual(w.sent_docs, 29)
+        self.assertEqual(len(w.errors), 1)
+        self.assertEqual(w.errors[0]['update']['_id'], 'missing')
+        self.assertEqual(DummyESDocument.objects.count(), 25)
+        self.assertEqual(
+            DummyESDocument.objects.get_by_id('manual').value, 'ham'
+        )
+
+    def test_flush_interval(self):
+        with DummyESDocument.bulk_writer(flush_interval=0.01) as w:
+            w.index_dict('a', {'key': 'a', 'value': 'b'})
+            for _i in range(100):
+                if w.sent_docs:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(w.sent_docs, 1)
+
+    def test_max_bytes(self):
+        with DummyESDocument.bulk_writer() as w:
+            w.index_dict('a', {'key': 'k', 'value': 'あ' * 100})
+            # 文字数ではなく UTF-8 のバイト数で数える (1文字3バイト)
+            self.assertGreater(w._bytes, 300)
+
+    def test_without_with(self):
+        w = DummyESDocument.bulk_writer(max_docs=1)
+        for i in range(3):
+            w.index_dict('key{}'.format(i), {'key': 'k', 'value': 'v'})
+        w.flush()
+        self.assertEqual(w.sent_docs, 3)
+        w.close()
+        self.assertEqual(DummyESDocument.objects.count(), 3)
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestRouting(TestCase):
+    def setUp(self):
+        store.reset()
+        DummyRoutedESDocument.index.create()
+        DummyModel.objects.create(key='quick', value='brown fox')
+        DummyModel.objects.create(key='jumps', value='over the')
+        DummyRoutedESDocument.rebuild_index()
+
+    def tearDown(self):
+        store.reset()
+
+    def test_routing(self):
+        self.assertEqual(
+            DummyRoutedESDocument.index.mappings['_routing'],
+            {'required': True},
+        )
+        with self.assertRaises(RequestError):
+            DummyRoutedESDocument.objects.get_by_id('quick')
+        self.assertEqual(
+            DummyRoutedESDocument.objects.get_by_id(
+                'quick', routing='q'
+            ).value,
+            'brown fox',
+        )
+        qs = DummyRoutedESDocument.objects.routing('j').query(
+            {"match": {"value": "over"}}
+        )
+        self.assertEqual(qs.kwargs['routing'], 'j')
+        self.assertEqual([d.key for d in qs], ['jumps'])
+        self.assertEqual(qs.get_by_id('jumps').key, 'jumps')
+
+        d3 = DummyModel.objects.create(key='lazy', value='dogs.')
+        DummyRoutedESDocument.rebuild_index_by_source_model(d3)
+        with DummyRoutedESDocument.bulk_writer() as w:
+            w.index(DummyModel(key='spam', value='eggs'))
+            w.delete('quick', routing='q')
+        self.assertEqual(w.errors, [])
+        self.assertEqual(
+            sorted(d.key for d in DummyRoutedESDocument.objects.all()),
+            ['jumps', 'lazy', 'spam'],
+        )
+
+    def test_rebuild_without_bulk(self):
+        calls = []
+
+        def _index(client, index, body, id=None, **kwargs):
+            calls.append((id, kwargs.get('routing')))
+            return {}
+
+        routing = mock.patch.object(
+            DummyESDocument,
+            'get_routing_of_source_model',
+            side_effect=lambda m: 'tenant' if m.key == 'quick' else None,
+        )
+        with routing, mock.patch('elasticsearch.Elasticsearch.index', _index):
+            DummyESDocument.rebuild_index(bulk_size=0)
+        pks = dict(DummyModel.objects.values_list('key', 'pk'))
+        self.assertEqual(
+            calls, [(pks['quick'], 'tenant'), (pks['jumps'], None)]
+        )
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestDenseVector(TestCase):
+    def setUp(self):
+        try:
+            import numpy  # NOQA
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        store.reset()
+        DummyVectorESDocument.index.create()
+        DummyModel.objects.create(key='quick', value='Brown fox')
+        DummyModel.objects.create(key='jumps', value='over the lazy fox')
+        DummyModel.objects.create(key='lazy', value='dogs.')
+        DummyVectorESDocument.rebuild_index()
+
+    def tearDown(self):
+        store.reset()
+
+    def test_mapping(self):
+        self.assertEqual(
+            DummyVectorESDocument.index.mappings['properties']['embedding'],
+            {
+                "type": "dense_vector",
+                "dims": 3,
+                "index": True,
+                "similarity": "cosine",
+            },
+        )
+
+    def test_knn(self):
+        import numpy
+
+        query_vector = numpy.array([1, 0, 0], dtype='float32')
+        documents = list(
+            DummyVectorESDocument.objects.knn('embedding', query_vector, k=2)
+        )
+        self.assertEqual([d.key for d in documents], ['quick', 'jumps'])
+        self.assertEqual(documents[0].embedding.dtype, numpy.float32)
+        numpy.testing.assert_array_equal(documents[0].embedding, [1, 0, 0])
+
+        qs = DummyVectorESDocument.objects.knn(
+            'embedding', query_vector, k=2, filter={"term": {"key": "lazy"}}
+        )
+        self.assertEqual([d.key for d in qs], ['lazy'])
+
+        # query() の条件と kNN のどちらかに合うもの
+        qs = DummyVectorESDocument.objects.query(
+            {"match": {"value": "dogs"}}
+        ).knn('embedding', query_vector, k=1, hybrid=True)
+        self.assertEqual(sorted(d.key for d in qs), ['lazy', 'quick'])
+
+    def test_orjson(self):
+        try:
+            import orjson  # NOQA
+        except ImportError:
+            self.skipTest('orjson is not installed')
+        document = DummyVectorESDocument.objects.get_by_id('jumps')
+        self.assertEqual(
+            get_serializer('orjson').dumps({'v': document.embedding}),
+            b'{"v":[0.9,0.1,0.0]}',
+        )
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestPartitions(SimpleTestCase):
+    def setUp(self):
+        store.reset()
+        DummyEventESDocument.index.create()
+        for i, created_at in enumerate(
+            ['2026-09-30T23:00:00', '2026-10-18T10:00:00', '2026-10-19']
+        ):
+            DummyEventESDocument.update(
+                'event-{}'.format(i),
+                {'kind': 'click', 'created_at': created_at},
+            )
+
+    def tearDown(self):
+        store.reset()
+
+    def test_write_to_partitions(self):
+        self.assertTrue(DummyEventESDocument.index.exists())
+        self.assertEqual(
+            DummyEventESDocument.index.partitions(),
+            [
+                'elasticindex_test_events-2026.09.30',
+                'elasticindex_test_events-2026.10.18',
+                'elasticindex_test_events-2026.10.19',
+            ],
+        )
+        # テンプレートの mappings が適用されている
+        index = store.indices['elasticindex_test_events-2026.10.19']
+        self.assertEqual(index.properties['created_at'], {'type': 'date'})
+        self.assertEqual(
+            DummyEventESDocument.objects.get_by_id('event-1').created_at,
+            '2026-10-18T10:00:00',
+        )
+
+    def test_search_prunes_partitions(self):
+        qs = DummyEventESDocument.objects.query(
+            {
+                "bool": {
+                    "filter": [
+                        {
+                            "range": {
+                                "created_at": {
+                                    "gte": "2026-10-17",
+                                    "lt": "2026-10-19",
+                                }
+                            }
+                        }
+                    ]
+                }
+            }
+        )
+        self.assertEqual(
+            qs.search_index,
+            'elasticindex_test_events-2026.10.17,'
+            'elasticindex_test_events-2026.10.18',
+        )
+        self.assertEqual([d.es_id for d in qs], ['event-1'])
+        self.assertEqual(qs.all().count(), 1)
+        self.assertEqual(
+            DummyEventESDocument.objects.all().search_index,
+            'elasticindex_test_events-2*',
+        )
+        self.assertEqual(DummyEventESDocument.objects.all().count(), 3)
+
+    def test_prune_with_rounding_and_time_zone(self):
+        def _search_index(bounds):
+            return DummyEventESDocument.objects.query(
+                {"range": {"created_at": bounds}}
+            ).search_index
+
+        # 丸めた開始日時 (今月の1日) から
+        first_day = datetime.datetime.now(datetime.timezone.utc).replace(day=1)
+        self.assertTrue(
+            _search_index({"gte": "now/M"}).startswith(
+                first_day.strftime('elasticindex_test_events-%Y.%m.%d,')
+            )
+        )
+        # +09:00 の 10/19 は UTC の 10/18 15:00 から
+        self.assertEqual(
+            _search_index(
+                {
+                    "gte": "2026-10-19",
+                    "lt": "2026-10-20",
+                    "time_zone": "+09:00",
+                }
+            ),
+            'elasticindex_test_events-2026.10.18,'
+            'elasticindex_test_events-2026.10.19',
+        )
+        # 解釈できないものは絞り込まない
+        for bounds in (
+            {"gte": 1760832000, "format": "epoch_second"},
+            {"gte": "now/q"},
+            {"gte": "2026-10-19", "time_zone": "Mars/Olympus"},
+        ):
+            self.assertEqual(
+                _search_index(bounds), 'elasticindex_test_events-2*'
+            )
+
+    def test_drop_partitions(self):
+        dropped = DummyEventESDocument.index.drop_partitions(
+            datetime.datetime(2026, 10, 18, 12)
+        )
+        self.assertEqual(dropped, ['elasticindex_test_events-2026.09.30'])
+        DummyEventESDocument.index.delete()
+        self.assertEqual(store.indices, {})
+        self.assertFalse(DummyEventESDocument.index.exists())
+
+    def test_delete_many_partitions(self):
+        start = datetime.datetime(2026, 1, 1)
+        for i in range(200):
+            DummyEventESDocument.update(
+                'many-{}'.format(i),
+                {'kind': 'click', 'created_at': start + datetime.timedelta(i)},
+            )
+        with collect() as collector:
+            DummyEventESDocument.index.delete()
+        deletes = [
+            e for e in collector.events if e.operation == 'indices.delete'
+        ]
+        self.assertGreater(len(deletes), 1)
+        self.assertEqual(store.indices, {})
+
+    def test_open_range_and_out_of_range(self):
+        # 未来の日時のドキュメントも、上限の無い range で見つかる
+        DummyEventESDocument.update(
+            'scheduled', {'kind': 'click', 'created_at': '2031-01-01'}
+        )
+        qs = DummyEventESDocument.objects.query(
+            {"range": {"created_at": {"gte": "2026-10-18"}}}
+        )
+        self.assertEqual(
+            qs.search_index.split(',')[:3],
+            [
+                'elasticindex_test_events-2026.10.18',
+                'elasticindex_test_events-2026.10.19*',
+                'elasticindex_test_events-2026.10.2*',
+            ],
+        )
+        self.assertEqual(
+            sorted(d.es_id for d in qs), ['event-1', 'event-2', 'scheduled']
+        )
+        # 2000年より前は INDEX-2* から漏れるので書き込まない
+        with self.assertRaises(ValueError):
+            DummyEventESDocument.update(
+                'old', {'kind': 'click', 'created_at': '1999-12-31'}
+            )
+        qs = DummyEventESDocument.objects.query(
+            {
+                "range": {
+                    "created_at": {"gte": "1990-01-01", "lt": "2000-01-02"}
+                }
+            }
+        )
+        self.assertEqual(
+            qs.search_index, 'elasticindex_test_events-2000.01.01'
+        )
+
+    def test_unrelated_index_with_same_prefix(self):
+        DummyEventArchiveESDocument.index.create()
+        DummyEventArchiveESDocument.update(
+            'archived', {'kind': 'click', 'created_at': '2026-01-01'}
+        )
+        self.assertEqual(len(DummyEventESDocument.index.partitions()), 3)
+        self.assertEqual(DummyEventESDocument.objects.all().count(), 3)
+        self.assertEqual(
+            DummyEventESDocument.index.drop_partitions(
+                datetime.datetime(2026, 12, 1)
+            )[-1],
+            'elasticindex_test_events-2026.10.19',
+        )
+        DummyEventESDocument.index.delete()
+        self.assertEqual(
+            list(store.indices), ['elasticindex_test_events-archive']
+        )
+        self.assertEqual(DummyEventArchiveESDocument.objects.count(), 1)
+
+
+@override_settings(ELASTICINDEX_BACKEND='memory')
+class TestMultiDocumentQuerySet(SimpleTestCase):
+    def setUp(self):
+        store.reset()
+        DummyESDocument.index.create()
+        DummyEventESDocument.index.create()
+        DummyESDocument.update('a', {'key': 'click', 'value': 'Brown fox'})
+        DummyESDocument.update('b', {'key': 'view', 'value': 'lazy dogs'})
+        DummyEventESDocument.update(
+            'event-0', {'kind': 'click', 'created_at': '2026-10-19'}
+        )
+
+    def tearDown(self):
+        store.reset()
+
+    def test_search(self):
+        qs = MultiDocumentQuerySet(DummyESDocument, DummyEventESDocument)
+        with collect() as collector:
+            documents = list(
+                qs.query(
+                    {
+                        "bool": {
+                            "should": [
+                                {"term": {"key": "click"}},
+                                {"term": {"kind": "click"}},
+                            ]
+                        }
+                    }
+                )
+            )
+        self.assertEqual(collector.count, 1)
+        self.assertEqual(
+            sorted((type(d).__name__, d.es_id) for d in documents),
+            [('DummyESDocument', 'a'), ('DummyEventESDocument', 'event-0')],
+        )
+        self.assertEqual(qs.count(), 3)
+
+        qs = qs.source(DummyESDocument, ['key'])
+        self.assertEqual(qs.body['_source'], ['key', 'kind', 'created_at'])
+        documents = {
+            type(d): d for d in qs.query({"ids": {"values": ['a', 'event-0']}})
+        }
+        self.assertEqual(documents[DummyESDocument].key, 'click')
+        self.assertIsNone(documents[DummyESDocument].value)
+        self.assertEqual(documents[DummyEventESDocument].kind, 'click')
+
+    def test_get_and_delete_by_id(self):
+        qs = MultiDocumentQuerySet(DummyESDocument, DummyEventESDocument)
+        document = qs.get_by_id('event-0')
+        self.assertIsInstance(document, DummyEventESDocument)
+        self.assertEqual(document.kind, 'click')
+        self.assertIsInstance(qs.get_by_id('b'), DummyESDocument)
+        with self.assertRaises(DummyESDocument.DoesNotExist):
+            qs.get_by_id('missing')
+
+        qs.delete_by_id('event-0')
+        self.assertEqual(DummyEventESDocument.objects.count(), 0)
+        self.assertEqual(DummyESDocument.objects.count(), 2)
+        with self.assertRaises(DummyESDocument.DoesNotExist):
+            qs.delete_by_id('event-0')
+
+    def test_owns_index(self):
+        self.assertTrue(
+            DummyEventESDocument.owns_index(
+                'elasticindex_test_events-2026.10.19'
+            )
+        )
+        self.assertFalse(
+            DummyEventESDocument.owns_index('elasticindex_test_index')
+        )
+        self.assertFalse(
+            DummyESDocument.owns_index('elasticindex_test_events')
+        )
+
+
+@override_settings(
+    ELASTICINDEX_BACKEND=None,
+    ELASTICINDEX_READ_HOSTS=[{'host': 'read-node', 'port': 9200}],
+    ELASTICINDEX_WRITE_HOSTS=[{'host': 'write-node', 'port': 9200}],
+)
+class TestReadWriteSplit(SimpleTestCase):
+    def _hosts(self, client):
+        return [c.host for c in client.transport.connection_pool.connections]
+
+    def test_read_write_split(self):
+        qs = DummyESDocument.objects.all()
+        self.assertEqual(self._hosts(qs.es_client), ['http://read-node:9200'])
+        self.assertEqual(
+            self._hosts(qs.es_write_client), ['http://write-node:9200']
+        )
+        self.assertEqual(
+            self._hosts(qs.read_your_writes().limit(1).es_client),
+            ['http://write-node:9200'],
+        )
+        self.assertEqual(
+            self._hosts(DummyESDocument.get_es_client(role='write')),
+            ['http://write-node:9200'],
+        )
+
+    def test_document_hosts(self):
+        with mock.patch.object(
+            DummyESDocument,
+            'READ_HOSTS',
+            [{'host': 'doc-read-node', 'port': 9200}],
+        ):
+            self.assertEqual(
+                self._hosts(DummyESDocument.objects.all().es_client),
+                ['http://doc-read-node:9200'],
+            )
+
+
+class TestAWS(SimpleTestCase):
+    def test_sign_request(self):
+        # AWS の SigV4 テストスイートの get-vanilla
+        headers = sign_request(
+            Credentials(
+                'AKIDEXAMPLE', 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+            ),
+            'us-east-1',
+            'service',
+            'GET',
+            'example.amazonaws.com',
+            '/',
+            now=datetime.datetime(2015, 8, 30, 12, 36, 0),
+            content_sha256_header=False,
+        )
+        self.assertEqual(
+            headers['authorization'],
+            'AWS4-HMAC-SHA256 '
+            'Credential=AKIDEXAMPLE/20150830/us-east-1/service/aws4_request, '
+            'SignedHeaders=host;x-amz-date, Signature=5fa00fa31553b73ebf1942'
+            '676e86291e8372ff2a2260956d9b8aae1d763fbf31',
+        )
+
+    def test_sign_request_bytes_params(self):
+        credentials = Credentials('AKID', 'secret')
+        now = datetime.datetime(2026, 1, 1)
+        self.assertEqual(
+            sign_request(
+                credentials,
+                'us-east-1',
+                'es',
+                'POST',
+                'example.com',
+                '/i/_refresh',
+                params={'routing': b'a,b'},
+                now=now,
+            ),
+            sign_request(
+                credentials,
+                'us-east-1',
+                'es',
+                'POST',
+                'example.com',
+                '/i/_refresh',
+                params={'routing': 'a,b'},
+                now=now,
+            ),
+        )
+
+    def test_credentials_refresh(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        provider = mock.Mock()
+        provider.load.side_effect = [
+            Credentials('A1', 's', 't', now + datetime.timedelta(minutes=1)),
+            Credentials('A2', 's', 't', now + datetime.timedelta(hours=1)),
+        ]
+        empty = mock.Mock()
+        empty.load.return_value = None
+        chain = CredentialsChain([empty, provider])
+        # 期限が REFRESH_MARGIN 以内なので、次の呼び出しで取り直す
+        self.assertEqual(chain.get_credentials().access_key, 'A1')
+        self.assertEqual(chain.get_credentials().access_key, 'A2')
+        self.assertEqual(chain.get_credentials().access_key, 'A2')
+        self.assertEqual(provider.load.call_count, 2)
+
+    @override_settings(
+        ELASTICINDEX_BACKEND=None,
+        ELASTICINDEX_HOSTS=[
+            {'host': 'xxx.ap-northeast-1.aoss.amazonaws.com', 'port': 443}
+        ],
+        ELASTICINDEX_AWS_IAM={
+            'access_id': 'AKID',
+            'secret_key': 'secret',
+            'region': 'ap-northeast-1',
+        },
+    )
+    def test_client_is_shared(self):
+        client = DummyESDocument.get_es_client()
+        self.assertIs(DummyESDocument.get_es_client(), client)
+        (connection,) = client.transport.connection_pool.connections
+        self.assertIsInstance(connection, AWSSigV4Connection)
+        self.assertEqual(connection.aws_service, 'aoss')
+        self.assertEqual(
+            connection.host_header, 'xxx.ap-northeast-1.aoss.amazonaws.com'
+        )